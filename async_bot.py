@@ -0,0 +1,993 @@
+"""
+Асинхронен режим на бота: AsyncTeleBot + общ httpx.AsyncClient за Airtable.
+Обработва същите команди и callback-и като test.py, но в един asyncio процес,
+така че много заявки към Airtable и Telegram могат да чакат едновременно.
+
+Стартиране: python3 async_bot.py (вместо python3 test.py)
+"""
+import os
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import time
+import random
+from datetime import datetime
+
+import httpx
+from aiohttp import web
+from telebot import types
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+import test as core
+
+# Handler-ът и trace-ът на текущата задача. core.handler_context е threading.local -
+# в event loop-а той е общ за всички задачи, затова тук се използват contextvar-и.
+current_handler = contextvars.ContextVar("current_handler", default=None)
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+async def acquire(bucket):
+    """Async вариант на TokenBucket.acquire - чака, без да блокира event loop-а."""
+    wait = bucket.reserve()
+    if wait > 0:
+        await asyncio.sleep(wait)
+
+asyncio_helper.API_URL = core.TELEGRAM_API_URL + "/bot{0}/{1}"
+bot = AsyncTeleBot(core.TELEGRAM_BOT_TOKEN)
+
+# AsyncTeleBot няма CUSTOM_REQUEST_SENDER - заявките към Telegram минават тук през общия
+# бюджет, а съобщенията и редакциите - през core.telegram_scheduler. _process_request не е
+# публично API, затова версията на pyTelegramBotAPI е фиксирана в requirements.txt, а при
+# промяна на сигнатурата ботът спира при стартиране, вместо тихо да заобиколи лимитите.
+_process_telegram_request = getattr(asyncio_helper, "_process_request", None)
+if _process_telegram_request is None or \
+        list(inspect.signature(_process_telegram_request).parameters)[:5] != ["token", "url", "method", "params", "files"]:
+    raise RuntimeError("❌ Неподдържана версия на pyTelegramBotAPI: asyncio_helper._process_request е променен "
+                       "(виж версията в requirements.txt)")
+
+async def observed_telegram_request(request, url, method, handler, trace, **span):
+    """Изпълнява заявката към Telegram и я записва в метриките (като core.send_telegram_request)."""
+    started = time.monotonic()
+    status = 200
+    try:
+        return await request
+    except asyncio_helper.ApiTelegramException as e:
+        status = e.error_code
+        raise
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        core.observe_outbound("telegram", url, method.upper(), status, time.monotonic() - started,
+                              handler, trace, **span)
+
+async def process_telegram_request(token, url, method='get', params=None, files=None, **kwargs):
+    # send() се изпълнява в нишка на планировчика - запомняме handler-а и trace-а от задачата
+    handler = current_handler.get()
+    trace = current_trace.get()
+    if url not in core.TELEGRAM_SCHEDULED_METHODS:
+        await acquire(core.outbound_budget)
+        request = _process_telegram_request(token, url, method, params, files, **kwargs)
+        return await observed_telegram_request(request, url, method, handler, trace)
+
+    loop = asyncio.get_running_loop()
+    attempts = 0
+    ready = time.monotonic()
+
+    def send():
+        # Изпълнява се в нишка на планировчика: заявката върви в event loop-а
+        nonlocal attempts, ready
+        core.outbound_budget.acquire()
+        attempts += 1
+        span = dict(attempt=attempts, wait_ms=round((time.monotonic() - ready) * 1000, 1))
+        request = _process_telegram_request(token, url, method, dict(params) if params else params, files, **kwargs)
+        try:
+            return asyncio.run_coroutine_threadsafe(
+                observed_telegram_request(request, url, method, handler, trace, **span), loop).result()
+        finally:
+            ready = time.monotonic()
+
+    future = core.telegram_scheduler.submit((params or {}).get("chat_id"), url, params or {}, send, retry=not files)
+    return await asyncio.wrap_future(future)
+
+asyncio_helper._process_request = process_telegram_request
+
+# Настройки на async клиента
+AIRTABLE_MAX_CONNECTIONS = int(os.getenv("AIRTABLE_MAX_CONNECTIONS", "100"))
+
+class AirtableUnavailable(httpx.TransportError):
+    """Заявката не е изпратена: circuit breaker-ът за Airtable е отворен."""
+
+class AsyncAirtableClient:
+    """
+    Async вариант на core.AirtableClient върху httpx.AsyncClient. Използва същия
+    token bucket и circuit breaker като sync клиента, така че лимитът от 5 заявки/сек
+    на база и състоянието на Airtable са общи.
+    """
+
+    def __init__(self, base_id, token, bucket, breaker, timeout=core.AIRTABLE_TIMEOUT,
+                 max_retries=core.AIRTABLE_MAX_RETRIES, max_connections=AIRTABLE_MAX_CONNECTIONS):
+        self.base_id = base_id
+        self.bucket = bucket
+        self.breaker = breaker
+        self.max_retries = max_retries
+        self.client = httpx.AsyncClient(
+            headers={
+                "Authorization": f"Bearer {token}",
+                "Content-Type": "application/json"
+            },
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    async def request(self, method, url, **kwargs):
+        method = method.upper()
+        retry_errors = method in core.AirtableClient.IDEMPOTENT_METHODS
+        table = core.airtable_table_name(self.base_id, url)
+        formula = (kwargs.get("params") or {}).get("filterByFormula")
+
+        attempt = 0
+        ready = time.monotonic()
+        while True:
+            if not self.breaker.allow():
+                raise AirtableUnavailable(f"Airtable е временно недостъпен ({self.breaker.state})")
+            await acquire(self.bucket)
+            await acquire(core.outbound_budget)
+            started = time.monotonic()
+            span = dict(attempt=attempt + 1, wait_ms=round((started - ready) * 1000, 1), formula=formula)
+            try:
+                res = await self.client.request(method, url, **kwargs)
+            except httpx.TransportError:
+                core.observe_outbound("airtable", table, method, "error", time.monotonic() - started,
+                                      current_handler.get(), current_trace.get(), **span)
+                self.breaker.record(False)
+                ready = time.monotonic()
+                if not retry_errors or attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(random.uniform(0, min(core.AIRTABLE_MAX_BACKOFF, 0.5 * 2 ** attempt)))
+                attempt += 1
+                continue
+            except asyncio.CancelledError:
+                # Прекъсване (клиентът затвори връзката, спиране) не е грешка на Airtable
+                self.breaker.release()
+                raise
+            except BaseException:
+                self.breaker.record(False)
+                raise
+            core.observe_outbound("airtable", table, method, res.status_code, time.monotonic() - started,
+                                  current_handler.get(), current_trace.get(), **span)
+            self.breaker.record(res.status_code < 500, time.monotonic() - started)
+            ready = time.monotonic()
+
+            retryable = res.status_code == 429 or (retry_errors and res.status_code in core.AirtableClient.RETRY_STATUSES)
+            if not retryable or attempt >= self.max_retries:
+                return res
+            print(f"⚠️ Airtable {res.status_code} за {method}, повторен опит {attempt + 1}")
+            await asyncio.sleep(core.AirtableClient._backoff(attempt, res))
+            attempt += 1
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def patch(self, url, **kwargs):
+        return await self.request("PATCH", url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request("DELETE", url, **kwargs)
+
+    async def close(self):
+        await self.client.aclose()
+
+airtable = AsyncAirtableClient(core.AIRTABLE_BASE_ID, core.AIRTABLE_PERSONAL_ACCESS_TOKEN, core.airtable.bucket,
+                               core.airtable.breaker)
+
+# Пазим референции към фоновите задачи, за да не ги събере garbage collector-ът
+background_tasks = set()
+
+async def state_call(func, *args):
+    """
+    Извикване към състоянието на разговорите или deduplicator-а на update-ите. При
+    CONVERSATION_BACKEND=sqlite това е заявка към базата (може да чака заключване до
+    SQLITE_BUSY_TIMEOUT), затова минава през нишка и не спира event loop-а.
+    """
+    if core.CONVERSATION_BACKEND == "sqlite":
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
+
+class AsyncConversationField:
+    """core.ConversationField за async handler-ите (get/set/pop през state_call)."""
+
+    def __init__(self, field):
+        self.field = field
+
+    async def get(self, user_id, default=None):
+        return await state_call(self.field.get, user_id, default)
+
+    async def set(self, user_id, value):
+        await state_call(self.field.__setitem__, user_id, value)
+
+    async def pop(self, user_id, default=None):
+        return await state_call(self.field.pop, user_id, default)
+
+user_pending_type = AsyncConversationField(core.user_pending_type)
+pending_transaction_data = AsyncConversationField(core.pending_transaction_data)
+user_records = AsyncConversationField(core.user_records)
+user_editing = AsyncConversationField(core.user_editing)
+
+# AsyncTeleBot няма register_next_step_handler - следващата стъпка се пази в записа
+# на разговора (както при sync бота), така че оцелява рестарт и е обща за процесите
+next_steps = core.ConversationHandlerBackend(core.conversations, lambda name: globals().get(name))
+
+async def register_next_step(chat_id, handler):
+    await state_call(core.conversations.set, chat_id, "next_step",
+                     [{"callback": handler.__name__, "args": [], "kwargs": {}}])
+
+async def has_next_step(chat_id, name=None):
+    steps = await state_call(core.conversations.get, chat_id, "next_step")
+    return bool(steps) and (name is None or steps[0]["callback"] == name)
+
+async def find_account(account_name):
+    """Async вариант на core.find_account: локален каталог или заявка към Airtable."""
+    try:
+        search_terms = core.account_search_terms(account_name)
+        if not search_terms:
+            return None
+
+        if core.account_catalogue_usable():
+            return core.account_catalogue.find(search_terms)
+
+        params = {"filterByFormula": core.account_search_formula(search_terms)}
+        res = await airtable.get(core.url_accounts, params=params)
+        if res.status_code == 200:
+            records = res.json().get("records", [])
+            if records:
+                return records[0]["id"]
+    except httpx.TimeoutException:
+        print(f"⏱️ Timeout при търсене на акаунт: {account_name}")
+    except httpx.HTTPError as e:
+        print(f"❌ Грешка при търсене на акаунт: {e}")
+    except Exception as e:
+        print(f"❌ Неочаквана грешка в find_account: {e}")
+    return None
+
+async def get_account_names(account_ids):
+    """Async вариант на core.get_account_names."""
+    names, missing = core.cached_account_names(account_ids)
+    if not missing:
+        return names
+
+    try:
+        res = await airtable.get(core.url_accounts, params=core.account_names_params(missing))
+        if res.status_code == 200:
+            core.store_account_names(res.json().get("records", []), names)
+        else:
+            print(f"❌ Грешка при извличане на акаунти: {res.status_code}")
+    except httpx.TimeoutException:
+        print(f"⏱️ Timeout при извличане на акаунти")
+    except httpx.HTTPError as e:
+        print(f"❌ Error fetching accounts: {e}")
+    return names
+
+async def get_user_records_from_airtable(user_name, page_size=core.MAX_USER_RECORDS):
+    """Async генератор - вариант на core.get_user_records_from_airtable."""
+    if not user_name or not isinstance(user_name, str):
+        return
+
+    if core.reports_mirror_usable():
+        since = (datetime.now() - core.USER_RECORDS_MAX_AGE).timestamp()
+        for record in await asyncio.to_thread(core.reports_mirror.user_records, user_name, since):
+            yield record
+        return
+
+    params = core.user_records_params(user_name, page_size)
+    try:
+        while True:
+            res = await airtable.get(core.url_reports, params=params)
+            if res.status_code != 200:
+                print(f"❌ Грешка при извличане на записи: {res.status_code}")
+                return
+
+            data = res.json()
+            for record in data.get("records", []):
+                yield record
+
+            offset = data.get("offset")
+            if not offset:
+                return
+            params["offset"] = offset
+    except httpx.TimeoutException:
+        print(f"⏱️ Timeout при извличане на записи за: {user_name}")
+    except httpx.HTTPError as e:
+        print(f"❌ Грешка при връзка с Airtable: {e}")
+
+async def load_transaction_types():
+    """Async вариант на core.load_transaction_types. Връща None при грешка."""
+    url_types = core.airtable.table_url(core.TABLE_TRANSACTION_TYPES)
+    params = {"fields[]": ["ТРАНЗАКЦИЯ"], "pageSize": 100}
+    records = []
+
+    try:
+        while True:
+            res = await airtable.get(url_types, params=params)
+            if res.status_code != 200:
+                print(f"⚠️ Неуспешна заявка към Airtable: {res.status_code}")
+                return None
+            data = res.json()
+            records.extend(data.get("records", []))
+            if not data.get("offset"):
+                return core.parse_transaction_types(records)
+            params["offset"] = data["offset"]
+    except httpx.TimeoutException:
+        print(f"⏱️ Timeout при зареждане на типове транзакции")
+    except httpx.HTTPError as e:
+        print(f"❌ Грешка при зареждане на типове транзакции: {e}")
+    return None
+
+async def refresh_transaction_types_cache():
+    core.transaction_types_cache.store(await load_transaction_types())
+
+async def _background_types_refresh():
+    try:
+        await refresh_transaction_types_cache()
+    finally:
+        core.transaction_types_cache.end_refresh()
+
+async def get_transaction_types_snapshot():
+    """Stale-while-revalidate върху общия core.transaction_types_cache."""
+    cache = core.transaction_types_cache
+    if cache.snapshot is None:
+        await refresh_transaction_types_cache()
+        return cache.snapshot or core.EMPTY_TRANSACTION_TYPES
+
+    if cache.is_stale() and core.airtable.available() and cache.begin_refresh():
+        task = asyncio.create_task(_background_types_refresh())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    return cache.snapshot
+
+async def send_transaction_type_page(chat_id, page=0, filtered_types=None, filter_key=None):
+    version, _, markup = core.transaction_type_page(
+        await get_transaction_types_snapshot(), page, filtered_types, filter_key
+    )
+
+    msg = await bot.send_message(chat_id, "📌 Моля, изберете ВИД на транзакцията:", reply_markup=markup)
+
+    await user_pending_type.set(chat_id, core.pending_type_state(msg.message_id, page, filtered_types, filter_key, version))
+
+async def turn_transaction_type_page(chat_id, page):
+    """Сменя страницата на вече изпратеното съобщение с един edit_message_reply_markup."""
+    state = await user_pending_type.get(chat_id)
+    if state is None:
+        return  # разговорът е изтекъл междувременно
+    snapshot = await get_transaction_types_snapshot()
+    last_page = max(0, (len(core.pending_type_options(state, snapshot)) - 1) // core.TYPE_PAGE_SIZE)
+    page = min(max(page, 0), last_page)
+    if page == state.get("page", 0):
+        return  # стар бутон - страницата не се променя
+    version, _, markup = core.transaction_type_page(
+        snapshot, page,
+        state.get("filtered"), state.get("filter_key"), state.get("version")
+    )
+    try:
+        await bot.edit_message_reply_markup(chat_id, state["msg_id"], reply_markup=markup)
+    except Exception as e:
+        print(f"⚠️ Cannot edit keyboard: {e}")
+        await send_transaction_type_page(chat_id, page, state.get("filtered"), state.get("filter_key"))
+        return
+
+    state["page"] = page
+    state["version"] = version
+    await user_pending_type.set(chat_id, state)
+
+async def handle_filter_input(message):
+    keyword = message.text.strip().lower()
+    user_id = message.chat.id
+
+    filtered = (await get_transaction_types_snapshot()).filter(keyword)
+
+    if not filtered:
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("🔍 Опитай нова дума", callback_data="__filter"))
+        markup.add(types.InlineKeyboardButton("📜 Покажи всички", callback_data="__reset"))
+
+        await bot.send_message(user_id, "❌ Няма резултати за тази дума. Опитай отново:", reply_markup=markup)
+        return
+
+    await send_transaction_type_page(chat_id=user_id, page=0, filtered_types=filtered, filter_key=core.search_form(keyword))
+
+async def awaits_next_step(message):
+    # AsyncTeleBot изчаква func филтъра само ако е async функция (не lambda, която връща корутина)
+    return await has_next_step(message.chat.id)
+
+@bot.message_handler(func=awaits_next_step)
+async def run_next_step(message):
+    for handler in await state_call(next_steps.get_handlers, message.chat.id) or []:
+        await handler["callback"](message, *handler["args"], **handler["kwargs"])
+
+@bot.message_handler(commands=['settype'])
+async def ask_transaction_type(message):
+    await send_transaction_type_page(chat_id=message.chat.id, page=0)
+
+@bot.message_handler(commands=['refresh'])
+async def refresh_transaction_types(message):
+    """Изчиства кеша и обновява типовете транзакции."""
+    user_id = message.chat.id
+
+    if not core.rate_limiter.is_allowed(user_id):
+        await bot.reply_to(message, "⏸️ Твърде много заявки. Моля, изчакайте малко.")
+        return
+
+    try:
+        await refresh_transaction_types_cache()
+        types_dict = (await get_transaction_types_snapshot()).types
+        await asyncio.to_thread(core.account_catalogue.refresh, True)
+        await bot.reply_to(message, f"✅ Кешът е обновен! Намерени са {len(types_dict)} типа транзакции и {len(core.account_catalogue)} акаунта.")
+    except Exception as e:
+        print(f"❌ Error in refresh_transaction_types: {e}")
+        await bot.reply_to(message, "❌ Грешка при обновяване на типовете транзакции.")
+
+async def post_reports(items):
+    """Async вариант на core.post_reports (вкл. преминаването без ключ, ако полето липсва)."""
+    method, payload = core.reports_create_request(items)
+    res = await airtable.request(method, core.url_reports, json=payload)
+    if core.is_unknown_idempotency_field(res):
+        core.disable_reports_idempotency()
+        method, payload = core.reports_create_request(items)
+        res = await airtable.request(method, core.url_reports, json=payload)
+    return res
+
+async def save_transaction(user_id, selected_label, selected_id):
+    """Записва чакащата транзакция с избрания ВИД."""
+    txs = core.pending_transactions(await pending_transaction_data.get(user_id))
+    account_ids = {}
+    fields_list = []
+    for tx in txs:
+        account_name = tx.get("account_name", "")
+        if account_name not in account_ids:
+            account_ids[account_name] = await find_account(account_name)
+        fields_list.append(core.build_report_fields(tx, selected_id, account_ids[account_name]))
+    keys = core.report_keys(txs)
+    items = list(zip(fields_list, keys))
+
+    try:
+        # Write-behind или недостъпен Airtable: записваме в журнала и отговаряме веднага
+        if core.report_writer is not None or not core.airtable.healthy():
+            accepted = await asyncio.to_thread(core.queue_reports, user_id, fields_list, keys, core.report_writer is None)
+            await bot.send_message(user_id, f"✅ Избра вид: {selected_label}\n{accepted}")
+            return
+
+        try:
+            saved = 0
+            queued, queued_text = 0, None
+            for start in range(0, len(items), core.REPORTS_BATCH_SIZE):
+                try:
+                    res_post = await post_reports(items[start:start + core.REPORTS_BATCH_SIZE])
+                except AirtableUnavailable:
+                    # Веригата се е отворила: незаписаните отиват в журнала
+                    queued_text = await asyncio.to_thread(core.queue_reports, user_id, fields_list[start:], keys[start:], True)
+                    queued = len(items) - start
+                    break
+                if res_post.status_code not in (200, 201):
+                    print(f"❌ Airtable error: {res_post.status_code}")
+                    break
+                created = res_post.json().get("records", [])
+                await asyncio.to_thread(core.mirror_reports, created)
+                for record in created:
+                    await state_call(core.remember_user_record, user_id, record.get("id"))
+                    saved += 1
+
+            if saved:
+                await bot.send_message(user_id, f"✅ Избра вид: {selected_label}\n{core.saved_reports_text(saved + queued, len(fields_list))}")
+            elif queued:
+                await bot.send_message(user_id, f"✅ Избра вид: {selected_label}\n{queued_text}")
+            else:
+                await bot.send_message(user_id, "❌ Грешка при записването в базата.")
+        except httpx.TimeoutException:
+            print(f"⏱️ Timeout при записване на транзакция")
+            await bot.send_message(user_id, "⏱️ Заявката отне твърде много време.")
+        except httpx.HTTPError as e:
+            print(f"❌ Request error: {e}")
+            await bot.send_message(user_id, "❌ Грешка при връзка с базата.")
+    finally:
+        await pending_transaction_data.pop(user_id)
+        await user_pending_type.pop(user_id)
+
+@bot.callback_query_handler(func=lambda call: True)
+async def handle_transaction_type_selection(call):
+    user_id = None
+    try:
+        user_id = call.message.chat.id
+
+        if not core.rate_limiter.is_allowed(user_id):
+            await bot.answer_callback_query(call.id, "⏸️ Твърде много заявки.")
+            return
+
+        selected_label = call.data
+
+        state = await user_pending_type.get(user_id)
+        if state is None:
+            await bot.answer_callback_query(call.id, "❌ Няма очаквана транзакция.")
+            return
+
+        if selected_label in ("__prev", "__next"):
+            current_page = state.get("page", 0)
+            new_page = max(current_page - 1, 0) if selected_label == "__prev" else current_page + 1
+            await turn_transaction_type_page(user_id, new_page)
+            return
+
+        elif selected_label == "__filter":
+            await bot.answer_callback_query(call.id)
+            await bot.send_message(user_id, "🔍 Въведи дума за търсене:")
+            await register_next_step(user_id, handle_filter_input)
+            return
+
+        elif selected_label == "__reset":
+            await bot.answer_callback_query(call.id)
+            await send_transaction_type_page(chat_id=user_id, page=0)
+            return
+
+        user_options = core.pending_type_options(state, await get_transaction_types_snapshot())
+        if selected_label not in user_options:
+            await bot.answer_callback_query(call.id, "❌ Невалиден избор.")
+            return
+
+        selected_id = user_options.get(selected_label)
+        state["selected"] = selected_id
+        state["selected_label"] = selected_label
+        await user_pending_type.set(user_id, state)
+
+        try:
+            await bot.edit_message_text(chat_id=user_id, message_id=state["msg_id"], text=f"✅ Избра вид: {selected_label}")
+        except Exception as e:
+            print(f"⚠️ Cannot edit message: {e}")
+
+        if await pending_transaction_data.get(user_id) is not None:
+            await save_transaction(user_id, selected_label, selected_id)
+
+    except Exception as e:
+        print(f"❌ Грешка в handle_transaction_type_selection: {e}")
+        if user_id:
+            try:
+                await bot.answer_callback_query(call.id, "❌ Възникна грешка.")
+            except Exception as inner_e:
+                print(f"❌ Cannot answer callback: {inner_e}")
+
+async def send_records_listing(message, title, prompt, next_step):
+    """Общата част на /edit и /delete: извлича записите и показва списъка."""
+    user_id = message.chat.id
+
+    if not core.rate_limiter.is_allowed(user_id):
+        await bot.reply_to(message, "⏸️ Твърде много заявки. Моля, изчакайте малко.")
+        return
+
+    user_name = message.from_user.first_name if message.from_user.first_name else "Unknown"
+    records = []
+    async for record in get_user_records_from_airtable(user_name):
+        records.append(record)
+        if len(records) >= core.MAX_USER_RECORDS:
+            break
+
+    if not records:
+        await bot.reply_to(message, f"❌ Няма записи за {title}.")
+        return
+
+    await user_records.set(user_id, [r["id"] for r in records])
+
+    account_ids = core.listing_account_ids(records)
+    account_names = await get_account_names(account_ids) if account_ids else {}
+    reply_text = core.render_records_listing(records, account_names)
+
+    await bot.reply_to(message, reply_text + prompt)
+    await register_next_step(user_id, next_step)
+
+@bot.message_handler(commands=['edit'])
+async def handle_edit(message):
+    await send_records_listing(message, "редактиране",
+                               "Изберете номер на запис за редактиране (напр. /edit 1):", process_edit_choice)
+
+@bot.message_handler(commands=['delete'])
+async def handle_delete(message):
+    await send_records_listing(message, "изтриване",
+                               "Изберете номер на запис за изтриване (напр. /delete 1):", process_delete_choice)
+
+async def patch_report(message, record_id, new_data, success_text, error_text):
+    """PATCH на запис с отговор към потребителя. Връща True при успех."""
+    try:
+        res_put = await airtable.patch(f"{core.url_reports}/{record_id}", json=new_data)
+    except httpx.TimeoutException:
+        print(f"⏱️ Timeout при актуализиране на запис")
+        await bot.reply_to(message, "⏱️ Заявката отне твърде много време. Опитайте отново.")
+        return False
+    except httpx.HTTPError as e:
+        print(f"❌ Request error: {e}")
+        await bot.reply_to(message, "❌ Грешка при връзка с базата.")
+        return False
+
+    if res_put.status_code == 200:
+        await asyncio.to_thread(core.mirror_reports, [res_put.json()])
+        await bot.reply_to(message, success_text)
+        return True
+    print(f"❌ Airtable error: {res_put.status_code} - {res_put.text}")
+    await bot.reply_to(message, error_text)
+    return False
+
+async def process_delete_choice(message):
+    """Обработва избора на запис за изтриване."""
+    user_id = message.chat.id
+
+    if not message.text:
+        await bot.reply_to(message, "❌ Невалидно съобщение.")
+        return
+
+    try:
+        parts = message.text.split()
+        if len(parts) < 2:
+            await bot.reply_to(message, "❌ Моля, въведете валиден номер на запис.")
+            return
+
+        record_index = int(parts[1]) - 1
+
+        user_record_list = await user_records.get(user_id)
+        if user_record_list is None:
+            await bot.reply_to(message, "❌ Няма записи за изтриване.")
+            return
+
+        if not isinstance(user_record_list, list) or not (0 <= record_index < len(user_record_list)):
+            await bot.reply_to(message, "❌ Невалиден номер на запис.")
+            return
+
+        record_id = user_record_list[record_index]
+
+        try:
+            res_delete = await airtable.delete(f"{core.url_reports}/{record_id}")
+            if res_delete.status_code == 200:
+                await asyncio.to_thread(core.mirror_report_deleted, record_id)
+                await bot.reply_to(message, "✅ Записът беше изтрит успешно.")
+                await state_call(core.forget_user_record, user_id, record_id)
+            else:
+                print(f"❌ Delete error: {res_delete.status_code}")
+                await bot.reply_to(message, "❌ Грешка при изтриването на записа.")
+        except httpx.TimeoutException:
+            print(f"⏱️ Timeout при изтриване на запис")
+            await bot.reply_to(message, "⏱️ Заявката отне твърде много време.")
+        except httpx.HTTPError as e:
+            print(f"❌ Request error in delete: {e}")
+            await bot.reply_to(message, "❌ Грешка при връзка с базата.")
+
+    except (ValueError, IndexError) as e:
+        print(f"❌ Parse error in process_delete_choice: {e}")
+        await bot.reply_to(message, "❌ Моля, въведете валиден номер на запис.")
+
+async def process_edit_choice(message):
+    """Обработва избора на запис за редактиране."""
+    user_id = message.chat.id
+    try:
+        record_index = int(message.text.split()[1]) - 1
+        record_ids = await user_records.get(user_id)
+        if record_ids is not None and 0 <= record_index < len(record_ids):
+            record_id = record_ids[record_index]
+            await user_editing.set(user_id, {'record_id': record_id, 'field': None})
+            await bot.reply_to(message, "Моля, въведете какво искате да промените: описание, сума или акаунт.")
+            await register_next_step(user_id, process_edit_field)
+        else:
+            await bot.reply_to(message, "❌ Невалиден номер на запис. Моля, въведете валиден номер.")
+    except (ValueError, IndexError, AttributeError):
+        await bot.reply_to(message, "❌ Моля, въведете валиден номер на запис.")
+
+async def process_edit_field(message):
+    user_id = message.chat.id
+    field_to_edit = (message.text or "").lower()
+    steps = {
+        "описание": ("Моля, въведете новото описание за този запис:", process_new_description),
+        "сума": ("Моля, въведете новата стойност за сумата:", update_amount),
+        "акаунт": ("Моля, въведете новия акаунт:", process_new_account),
+    }
+
+    if field_to_edit in steps and await user_editing.get(user_id) is not None:
+        prompt, handler = steps[field_to_edit]
+        await state_call(core.set_editing_field, user_id, field_to_edit)
+        await bot.reply_to(message, prompt)
+        await register_next_step(user_id, handler)
+    else:
+        await bot.reply_to(message, "❌ Моля, въведете една от следните опции: описание, сума, акаунт.")
+        await register_next_step(user_id, process_edit_field)
+
+async def process_new_description(message):
+    """Обновява описание в Airtable."""
+    user_id = message.chat.id
+    editing = await user_editing.pop(user_id)
+    if editing is None:
+        await bot.reply_to(message, "❌ Не намерихме избрания запис за редактиране.")
+        return
+
+    record_id = editing['record_id']
+    new_data = {"fields": {"Описание": (message.text or "").strip()}}
+    await patch_report(message, record_id, new_data,
+                       "✅ Записът е редактиран успешно.", "❌ Грешка при редактирането на записа.")
+
+async def update_amount(message):
+    """Обработва новата стойност на сумата и актуализира запис в Airtable."""
+    user_id = message.chat.id
+
+    if not core.rate_limiter.is_allowed(user_id):
+        await bot.reply_to(message, "⏸️ Твърде много заявки. Моля, изчакайте малко.")
+        return
+
+    editing = await user_editing.get(user_id)
+    if editing is None or not editing.get('record_id'):
+        await bot.reply_to(message, "❌ Не намерихме избрания запис за редактиране.")
+        return
+
+    new_amount_str = message.text.strip() if message.text else ""
+    if not new_amount_str or len(new_amount_str) > 50:
+        await bot.reply_to(message, "❌ Невалидна дължина на сумата.")
+        return
+
+    new_data, error = core.build_amount_update(new_amount_str)
+    if error:
+        await bot.reply_to(message, error)
+        return
+
+    await user_editing.pop(user_id)
+    await patch_report(message, editing['record_id'], new_data,
+                       "✅ Сумата и валутата са успешно актуализирани.",
+                       "❌ Грешка при актуализирането на сумата и валутата.")
+
+async def process_new_account(message):
+    """Обновява акаунта в Airtable с частично съвпадение на името."""
+    user_id = message.chat.id
+    editing = await user_editing.get(user_id)
+    if editing is None or editing['field'] != 'акаунт':
+        await bot.reply_to(message, "❌ Не намерихме избрания запис за редактиране.")
+        return
+
+    record_id = editing['record_id']
+    account_id = await find_account((message.text or "").strip())
+    if not account_id:
+        await bot.reply_to(message, "❌ Не намерихме акаунт с това име.")
+        return
+
+    await patch_report(message, record_id, {"fields": {"Акаунт": [account_id]}},
+                       "✅ Акаунтът е актуализиран успешно.", "❌ Грешка при актуализирането на акаунта.")
+
+def import_file(importer, file_path, source=None):
+    """Изпълнява импорта в нишка (core.ReportImporter работи със sync клиента)."""
+    res, lines = core.open_telegram_file(file_path)
+    with res:
+        ok = importer.run(lines, source)
+    importer.close()
+    return ok
+
+async def run_import(chat_id, file_id, status_msg_id, user_name):
+    loop = asyncio.get_running_loop()
+
+    def on_progress(importer):
+        asyncio.run_coroutine_threadsafe(
+            bot.edit_message_text(core.import_progress_text(importer), chat_id=chat_id, message_id=status_msg_id), loop)
+
+    importer = None
+    try:
+        importer = await asyncio.to_thread(core.ReportImporter, user_name, on_progress)
+        file_info = await bot.get_file(file_id)
+        if not await asyncio.to_thread(import_file, importer, file_info.file_path, file_info.file_unique_id):
+            await bot.edit_message_text("❌ Липсват колони \"Вид\" и \"Сума\" (или \"Транзакция\").\n\n" + core.IMPORT_HELP,
+                                        chat_id=chat_id, message_id=status_msg_id)
+            return
+        await bot.edit_message_text(core.import_progress_text(importer, done=True), chat_id=chat_id, message_id=status_msg_id)
+        if importer.failed_path:
+            with open(importer.failed_path, "rb") as f:
+                await bot.send_document(chat_id, f, visible_file_name="import_errors.csv",
+                                        caption="📎 Редовете, които не бяха записани. Поправете ги и ги изпратете отново с /import.")
+        print(f"📥 Импорт за {chat_id}: {importer.saved} записани, {importer.failed} с грешка")
+    except core.requests.exceptions.RequestException as e:
+        print(f"❌ Грешка при изтегляне на файла за импорт: {e}")
+        await bot.send_message(chat_id, "❌ Файлът не можа да бъде изтеглен.")
+    except Exception as e:
+        print(f"❌ Неочаквана грешка в run_import: {e}")
+        await bot.send_message(chat_id, "❌ Възникна грешка при импорта.")
+    finally:
+        if importer is not None:
+            importer.cleanup()
+        core.active_imports.discard(chat_id)
+
+@bot.message_handler(commands=['import'])
+async def handle_import(message):
+    user_id = message.chat.id
+    if not core.rate_limiter.is_allowed(user_id):
+        await bot.reply_to(message, "⏸️ Твърде много заявки. Моля, изчакайте малко.")
+        return
+    if user_id in core.active_imports:
+        await bot.reply_to(message, "⏳ Вече тече импорт. Моля, изчакайте да приключи.")
+        return
+    await bot.reply_to(message, core.IMPORT_HELP)
+    await register_next_step(user_id, handle_import_document)
+
+async def handle_import_document(message):
+    user_id = message.chat.id
+    error = core.check_import_document(message)
+    if error:
+        await bot.reply_to(message, error)
+        return
+    if user_id in core.active_imports:
+        await bot.reply_to(message, "⏳ Вече тече импорт. Моля, изчакайте да приключи.")
+        return
+
+    core.active_imports.add(user_id)
+    try:
+        status = await bot.reply_to(message, "⏳ Импортът започна...")
+        user_name = message.from_user.first_name if message.from_user.first_name else "Unknown"
+        task = asyncio.create_task(run_import(user_id, message.document.file_id, status.message_id, user_name))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    except Exception as e:
+        core.active_imports.discard(user_id)
+        print(f"❌ Грешка при стартиране на импорт: {e}")
+        await bot.reply_to(message, "❌ Възникна грешка при импорта.")
+
+# Next-step handler-ите са само за текст; документът за /import идва тук
+@bot.message_handler(content_types=['document'])
+async def handle_document(message):
+    if await has_next_step(message.chat.id, "handle_import_document"):
+        await state_call(next_steps.clear_handlers, message.chat.id)
+    elif not (message.caption or "").startswith("/import"):
+        return
+    await handle_import_document(message)
+
+@bot.message_handler(func=lambda message: True)
+async def handle_message(message):
+    user_id = None
+    try:
+        user_id = message.chat.id
+
+        if not core.rate_limiter.is_allowed(user_id):
+            await bot.reply_to(message, "⏸️ Твърде много заявки. Моля, изчакайте малко.")
+            return
+
+        if not message.text or len(message.text) > core.MAX_TRANSACTION_LENGTH * core.MAX_BATCH_TRANSACTIONS:
+            await bot.reply_to(message, "⚠️ Съобщението е празно или твърде дълго.")
+            return
+
+        user_name = message.from_user.first_name if message.from_user.first_name else "Unknown"
+        current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        pending, reply_text, parse_mode = core.build_pending_transactions(message.text, user_name, current_datetime)
+        if pending is None:
+            await bot.reply_to(message, reply_text, parse_mode=parse_mode)
+            return
+
+        state = await user_pending_type.get(user_id)
+        if state is None or not state.get("selected"):
+            core.assign_report_keys(pending, user_id, message.message_id)
+            await pending_transaction_data.set(user_id, pending)
+            await send_transaction_type_page(chat_id=user_id, page=0)
+
+    except Exception as e:
+        print(f"❌ Грешка в handle_message: {e}")
+        if user_id:
+            try:
+                await bot.reply_to(message, "❌ Възникна грешка при обработка на съобщението.")
+            except Exception as inner_e:
+                print(f"❌ Cannot reply to message: {inner_e}")
+
+def timed_handler(fn):
+    """Async вариант на core.timed_handler: мери handler-а и го отбелязва като текущ за задачата."""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        token = current_handler.set(fn.__name__)
+        started = time.monotonic()
+        error = None
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            duration = time.monotonic() - started
+            core.HANDLER_LATENCY.observe(duration, handler=fn.__name__)
+            trace = current_trace.get()
+            if trace is not None:
+                trace.add_span("handler", started, duration, handler=fn.__name__, error=error)
+            current_handler.reset(token)
+    return wrapper
+
+for _handler in bot.message_handlers + bot.callback_query_handlers:
+    _handler["function"] = timed_handler(_handler["function"])
+
+# Update-ите от един чат се обработват по ред, различните чатове - паралелно
+chat_locks = {}  # chat_id -> [asyncio.Lock, брой чакащи update-и]
+
+async def process_update(update, trace):
+    chat_id = trace.chat_id
+    entry = chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    # Задачата има собствено копие на контекста - trace-ът не се вижда от другите update-и
+    current_trace.set(trace)
+    try:
+        async with entry[0]:
+            # "queue": чакането за предходните update-и от същия чат
+            trace.add_span("queue", trace.started, time.monotonic() - trace.started)
+            await bot.process_new_updates([update])
+    except Exception as e:
+        print(f"❌ Грешка при обработка на update {update.update_id} (trace {trace.trace_id}): {e}")
+        # Необработеният update трябва да мине, когато дойде отново
+        await state_call(core.update_deduplicator.forget, update.update_id)
+    finally:
+        core.UPDATES_IN_FLIGHT.dec()
+        core.slow_traces.record(trace)
+        entry[1] -= 1
+        if entry[1] == 0:
+            chat_locks.pop(chat_id, None)
+
+async def receive_update(request):
+    try:
+        update = types.Update.de_json(await request.text())
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"⚠️ Невалиден update: {e}")
+        return web.Response(status=400, text="Bad Request")
+    if update is None:
+        return web.Response(status=400, text="Bad Request")
+    if await state_call(core.update_deduplicator.seen, update.update_id):
+        core.UPDATES.inc(result="duplicate")
+        print(f"♻️ Повторен update {update.update_id} - пропускаме го")
+        return web.Response(text="OK")
+
+    core.UPDATES.inc(result="accepted")
+    core.UPDATES_IN_FLIGHT.inc()
+    trace = core.Trace(update.update_id, core.get_update_chat_id(update))
+    task = asyncio.create_task(process_update(update, trace))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return web.Response(text="OK")
+
+
+async def metrics_endpoint(request):
+    if core.METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {core.METRICS_TOKEN}":
+        return web.Response(status=401, text="Unauthorized")
+    return web.Response(text=core.metrics.render(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def admin_traces(request):
+    """Последните бавни update-и: ?limit=20&chat_id=123 (като /admin/traces в test.py)"""
+    if not core.ADMIN_TOKEN:
+        return web.Response(status=404, text="Not Found")
+    if request.headers.get("Authorization") != f"Bearer {core.ADMIN_TOKEN}":
+        return web.Response(status=401, text="Unauthorized")
+    try:
+        limit = int(request.query["limit"]) if "limit" in request.query else None
+        chat_id = int(request.query["chat_id"]) if "chat_id" in request.query else None
+    except ValueError:
+        return web.Response(status=400, text="Bad Request")
+    return web.json_response({
+        "threshold_ms": round(core.slow_traces.threshold * 1000, 1),
+        "traces": core.slow_traces.recent(limit, chat_id),
+    }, dumps=lambda data: json.dumps(data, ensure_ascii=False))
+
+async def on_startup(app):
+    # Мрежовите стъпки са във фонов режим, за да не забавят приемането на заявки
+    core.start_services()
+    task = asyncio.create_task(asyncio.to_thread(core.ensure_webhook))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def on_cleanup(app):
+    await airtable.close()
+    try:
+        await bot.close_session()
+    except AttributeError:
+        pass  # сесията към Telegram не е била отваряна
+
+def create_app():
+    app = web.Application()
+    app.router.add_post(f"/bot{core.TELEGRAM_BOT_TOKEN}", receive_update)
+    app.router.add_get("/metrics", metrics_endpoint)
+    app.router.add_get("/admin/traces", admin_traces)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
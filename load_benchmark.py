@@ -0,0 +1,540 @@
+"""
+Benchmark на целия бот с локални заместители на Telegram Bot API и Airtable.
+
+Пуска два фалшиви HTTP сървъра (с настройваемо закъснение, процент грешки и 429),
+насочва test.py към тях (TELEGRAM_API_URL, AIRTABLE_API_URL) и изпраща синтетични
+update-и в receive_update от много виртуални потребители. Всеки потребител минава
+през: транзакция със свободен текст, страниране на видовете, избор на вид, /edit
+(списък, избор, поле, нова сума) и /delete (списък, избор). Отчита пропускателна
+способност, p50/p95/p99 латентност (от POST на update-а до края на обработката) и
+изходящите заявки по поток.
+
+Стартиране:
+    python3 load_benchmark.py --users 20 --duration 30
+    python3 load_benchmark.py --latency 0.1 --error-rate 0.02 --throttle-rate 0.05
+    python3 load_benchmark.py --save baseline.json
+    python3 load_benchmark.py --baseline baseline.json
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from collections import Counter, defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+
+BOT_TOKEN = "123456:BENCHMARK"
+BASE_ID = "appBenchmark"
+FLOWS = ("transaction", "pagination", "select_type", "edit", "delete")
+
+class FakeService(ThreadingHTTPServer):
+    """
+    Локален HTTP заместител. Всяка заявка чака latency ± jitter секунди и с
+    вероятност throttle_rate получава 429, а с error_rate - 500.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, handler, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.lock = threading.Lock()
+        self.calls = Counter()  # (метод, код) -> брой
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def fault(self):
+        """Решава дали заявката да върне грешка: 429, 500 или None."""
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        roll = random.random()
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 500
+        return None
+
+    def count(self, name, status):
+        with self.lock:
+            self.calls[(name, status)] += 1
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def reply(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+class FakeTelegram(FakeService):
+    """Bot API: помни последната клавиатура за всеки чат, за да може "потребителят" да натисне бутон."""
+
+    def __init__(self, **kwargs):
+        super().__init__(TelegramHandler, **kwargs)
+        self.message_ids = iter(range(1, 10 ** 9))
+        self.keyboards = {}  # chat_id -> [callback_data]
+
+class TelegramHandler(FakeHandler):
+
+    def do_GET(self):
+        self.handle_method()
+
+    def do_POST(self):
+        self.handle_method()
+
+    def handle_method(self):
+        server = self.server
+        parts = urlsplit(self.path)
+        method = parts.path.rsplit("/", 1)[-1]
+        params = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        body = self.read_body()
+        if body and self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            params.update({k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()})
+
+        status = server.fault()
+        server.count(method, status or 200)
+        if status == 429:
+            self.reply(429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                             "parameters": {"retry_after": 1}})
+            return
+        if status == 500:
+            self.reply(500, {"ok": False, "error_code": 500, "description": "Internal Server Error"})
+            return
+
+        chat_id = params.get("chat_id")
+        if "reply_markup" in params and chat_id is not None:
+            markup = json.loads(params["reply_markup"])
+            buttons = [b.get("callback_data") for row in markup.get("inline_keyboard", []) for b in row]
+            with server.lock:
+                server.keyboards[chat_id] = [b for b in buttons if b]
+
+        if method in ("sendMessage", "editMessageText", "editMessageReplyMarkup", "sendDocument"):
+            message_id = params.get("message_id") or next(server.message_ids)
+            result = {"message_id": int(message_id), "date": int(time.time()),
+                      "chat": {"id": int(chat_id or 0), "type": "private"}, "text": params.get("text", "")}
+        elif method == "getWebhookInfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        elif method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+        else:
+            result = True
+        self.reply(200, {"ok": True, "result": result})
+
+class FakeAirtable(FakeService):
+    """Airtable REST API в паметта: видове транзакции, акаунти и отчети."""
+
+    def __init__(self, types_count=45, accounts_count=200, **kwargs):
+        super().__init__(AirtableHandler, **kwargs)
+        self.ids = iter(range(1, 10 ** 9))
+        self.tables = {
+            "ВИД ТРАНЗАКЦИЯ": {f"typ{i}": {"ТРАНЗАКЦИЯ": f"Вид {i:02d}"} for i in range(types_count)},
+            "ВСИЧКИ АКАУНТИ": {f"acc{i}": {"REG": f"Wise {i} Bank"} for i in range(accounts_count)},
+            "Отчет Телеграм": {},
+        }
+
+class AirtableHandler(FakeHandler):
+    USER_RE = re.compile(r"\{Име на потребителя\} = '((?:[^'\\]|\\.)*)'")
+    RECORD_ID_RE = re.compile(r"RECORD_ID\(\)='([^']+)'")
+
+    def route(self):
+        parts = urlsplit(self.path)
+        segments = [unquote(s) for s in parts.path.split("/") if s]
+        # /v0/<base>/<table>[/<record_id>]
+        table = segments[2] if len(segments) > 2 else None
+        record_id = segments[3] if len(segments) > 3 else None
+        return table, record_id, parse_qs(parts.query)
+
+    def guarded(self, name):
+        status = self.server.fault()
+        self.server.count(name, status or 200)
+        if status == 429:
+            self.reply(429, {"errors": [{"error": "RATE_LIMIT_REACHED"}]}, {"Retry-After": "1"})
+        elif status == 500:
+            self.reply(500, {"error": {"type": "SERVER_ERROR"}})
+        return status is None
+
+    def do_GET(self):
+        table, _, query = self.route()
+        if not self.guarded("GET"):
+            return
+        records = self.server.tables.get(table)
+        if records is None:
+            self.reply(404, {"error": "NOT_FOUND"})
+            return
+        with self.server.lock:
+            items = [{"id": rid, "createdTime": "2024-01-01T00:00:00.000Z", "fields": dict(fields)}
+                     for rid, fields in records.items()]
+
+        formula = (query.get("filterByFormula") or [""])[0]
+        user = self.USER_RE.search(formula)
+        if user:
+            name = user.group(1).replace("\\'", "'")
+            items = [r for r in items if r["fields"].get("Име на потребителя") == name][::-1]
+        record_ids = set(self.RECORD_ID_RE.findall(formula))
+        if record_ids:
+            items = [r for r in items if r["id"] in record_ids]
+
+        page_size = int((query.get("pageSize") or ["100"])[0])
+        offset = int((query.get("offset") or ["0"])[0])
+        page = items[offset:offset + page_size]
+        data = {"records": page}
+        if offset + page_size < len(items):
+            data["offset"] = str(offset + page_size)
+        self.reply(200, data)
+
+    def do_POST(self):
+        table, _, _ = self.route()
+        payload = json.loads(self.read_body() or b"{}")
+        if not self.guarded("POST"):
+            return
+        created = []
+        with self.server.lock:
+            for item in payload.get("records", []):
+                rid = f"rec{next(self.server.ids)}"
+                self.server.tables.setdefault(table, {})[rid] = dict(item.get("fields", {}))
+                created.append({"id": rid, "createdTime": "2024-01-01T00:00:00.000Z", "fields": item.get("fields", {})})
+        self.reply(200, {"records": created})
+
+    def do_PATCH(self):
+        table, record_id, _ = self.route()
+        payload = json.loads(self.read_body() or b"{}")
+        if not self.guarded("PATCH"):
+            return
+        if record_id is None and "performUpsert" in payload:
+            self.upsert(table, payload)
+            return
+        with self.server.lock:
+            fields = self.server.tables.get(table, {}).get(record_id)
+            if fields is not None:
+                fields.update(payload.get("fields", {}))
+                fields = dict(fields)
+        if fields is None:
+            self.reply(404, {"error": "NOT_FOUND"})
+        else:
+            self.reply(200, {"id": record_id, "fields": fields})
+
+    def upsert(self, table, payload):
+        """PATCH с performUpsert: обновява записа със същите fieldsToMergeOn или създава нов."""
+        merge_on = payload["performUpsert"]["fieldsToMergeOn"]
+        result, created_ids, updated_ids = [], [], []
+        with self.server.lock:
+            records = self.server.tables.setdefault(table, {})
+            for item in payload.get("records", []):
+                fields = item.get("fields", {})
+                key = tuple(fields.get(name) for name in merge_on)
+                rid = next((rid for rid, existing in records.items()
+                            if tuple(existing.get(name) for name in merge_on) == key), None)
+                if rid is None:
+                    rid = f"rec{next(self.server.ids)}"
+                    records[rid] = {}
+                    created_ids.append(rid)
+                else:
+                    updated_ids.append(rid)
+                records[rid].update(fields)
+                result.append({"id": rid, "createdTime": "2024-01-01T00:00:00.000Z", "fields": dict(records[rid])})
+        self.reply(200, {"records": result, "createdRecords": created_ids, "updatedRecords": updated_ids})
+
+    def do_DELETE(self):
+        table, record_id, _ = self.route()
+        if not self.guarded("DELETE"):
+            return
+        with self.server.lock:
+            found = self.server.tables.get(table, {}).pop(record_id, None) is not None
+        if found:
+            self.reply(200, {"id": record_id, "deleted": True})
+        else:
+            self.reply(404, {"error": "NOT_FOUND"})
+
+def percentile(values, p):
+    """Percentile по метода nearest-rank (values е сортиран)."""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+class LoadGenerator:
+    """
+    Виртуални потребители, които изпращат update-и към receive_update през Flask test
+    client-а и чакат обработката им, преди да продължат (както истински потребител чака
+    отговора). Латентността е от POST-а до края на обработката в UpdateDispatcher.
+    """
+
+    def __init__(self, core, telegram, users, duration, think_time):
+        self.core = core
+        self.telegram = telegram
+        self.users = users
+        self.duration = duration
+        self.think_time = think_time
+        self.lock = threading.Lock()
+        self.update_ids = iter(range(1, 10 ** 9))
+        self.message_ids = iter(range(10 ** 6, 10 ** 9))
+        self.waiting = {}  # update_id -> (flow, threading.Event)
+        self.local = threading.local()
+        self.latencies = defaultdict(list)  # flow -> [ms]
+        self.rejected = Counter()
+        self.timeouts = Counter()
+        self.error_replies = Counter()
+        self.outbound = Counter()  # (flow, "airtable"/"telegram") -> брой
+        self.instrument()
+
+    def instrument(self):
+        """Отбелязва края на обработката и брои изходящите заявки по поток (в нишката на handler-а)."""
+        core = self.core
+        process = core.update_dispatcher.process
+
+        def tracked_process(update):
+            flow, done = self.waiting.get(update.update_id, ("other", None))
+            self.local.flow = flow
+            try:
+                process(update)
+            finally:
+                self.local.flow = None
+                if done is not None:
+                    done.set()
+
+        core.update_dispatcher.process = tracked_process
+
+        airtable_request = core.airtable.request
+
+        def counted_airtable(method, url, **kwargs):
+            self.count(getattr(self.local, "flow", None), "airtable")
+            return airtable_request(method, url, **kwargs)
+
+        core.airtable.request = counted_airtable
+
+        send = core.telebot.apihelper.CUSTOM_REQUEST_SENDER
+
+        def counted_telegram(method, url, params=None, files=None, **kwargs):
+            flow = getattr(self.local, "flow", None)
+            self.count(flow, "telegram")
+            text = (params or {}).get("text") or (params or {}).get("caption") or ""
+            if flow and text.startswith(("❌", "⏱️", "⏸️")):
+                with self.lock:
+                    self.error_replies[flow] += 1
+            return send(method, url, params=params, files=files, **kwargs)
+
+        core.telebot.apihelper.CUSTOM_REQUEST_SENDER = counted_telegram
+
+    def count(self, flow, service):
+        with self.lock:
+            self.outbound[(flow or "background", service)] += 1
+
+    def make_update(self, user, text=None, callback_data=None):
+        update_id = next(self.update_ids)
+        chat = {"id": user["chat_id"], "type": "private"}
+        sender = {"id": user["chat_id"], "is_bot": False, "first_name": user["name"]}
+        if callback_data is not None:
+            message = {"message_id": next(self.message_ids), "date": int(time.time()), "chat": chat, "text": "..."}
+            return update_id, {"update_id": update_id, "callback_query": {
+                "id": str(update_id), "from": sender, "message": message, "chat_instance": "1", "data": callback_data}}
+        message = {"message_id": next(self.message_ids), "date": int(time.time()), "chat": chat, "from": sender, "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return update_id, {"update_id": update_id, "message": message}
+
+    def send(self, client, user, flow, text=None, callback_data=None, timeout=30):
+        update_id, payload = self.make_update(user, text, callback_data)
+        done = threading.Event()
+        self.waiting[update_id] = (flow, done)
+        started = time.perf_counter()
+        res = client.post(f"/bot{BOT_TOKEN}", data=json.dumps(payload, ensure_ascii=False),
+                          content_type="application/json")
+        try:
+            if res.status_code != 200:
+                with self.lock:
+                    self.rejected[flow] += 1
+                return False
+            if not done.wait(timeout):
+                with self.lock:
+                    self.timeouts[flow] += 1
+                return False
+            elapsed = (time.perf_counter() - started) * 1000
+            with self.lock:
+                self.latencies[flow].append(elapsed)
+            return True
+        finally:
+            self.waiting.pop(update_id, None)
+            if self.think_time:
+                time.sleep(random.uniform(0, 2 * self.think_time))
+
+    def keyboard(self, user):
+        with self.telegram.lock:
+            return list(self.telegram.keyboards.get(str(user["chat_id"]), []))
+
+    def scenario(self, user, deadline):
+        client = self.core.app.test_client()
+        rng = random.Random(user["chat_id"])
+        while time.monotonic() < deadline:
+            amount = rng.randint(1, 500)
+            account = rng.randint(0, 199)
+            self.send(client, user, "transaction", text=f"{amount}.50 лв за обяд №{amount} от Wise {account} Bank")
+
+            if "__next" in self.keyboard(user):
+                self.send(client, user, "pagination", callback_data="__next")
+            choices = [b for b in self.keyboard(user) if not b.startswith("__")]
+            if choices:
+                self.send(client, user, "select_type", callback_data=rng.choice(choices))
+
+            for text in ("/edit", "/edit 1", "сума", f"{amount} eur"):
+                self.send(client, user, "edit", text=text)
+            for text in ("/delete", "/delete 1"):
+                self.send(client, user, "delete", text=text)
+
+    def run(self):
+        deadline = time.monotonic() + self.duration
+        users = [{"chat_id": 100000 + i, "name": f"Bench{i}"} for i in range(self.users)]
+        threads = [threading.Thread(target=self.scenario, args=(user, deadline), daemon=True) for user in users]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+def summarize(generator, elapsed, telegram, airtable):
+    flows = {}
+    for flow in FLOWS:
+        values = sorted(generator.latencies.get(flow, []))
+        flows[flow] = {
+            "updates": len(values),
+            "per_sec": round(len(values) / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(percentile(values, 50), 1),
+            "p95_ms": round(percentile(values, 95), 1),
+            "p99_ms": round(percentile(values, 99), 1),
+            "rejected": generator.rejected[flow],
+            "timeouts": generator.timeouts[flow],
+            "error_replies": generator.error_replies[flow],
+            "airtable_calls": generator.outbound[(flow, "airtable")],
+            "telegram_calls": generator.outbound[(flow, "telegram")],
+        }
+    total = sum(f["updates"] for f in flows.values())
+
+    def server_totals(service):
+        totals = Counter()
+        for (_, status), n in service.calls.items():
+            totals["total"] += n
+            if status != 200:
+                totals[str(status)] += n
+        return dict(totals)
+
+    return {
+        "elapsed_s": round(elapsed, 2),
+        "updates": total,
+        "updates_per_sec": round(total / elapsed, 2) if elapsed else 0.0,
+        "transactions_per_sec": flows["select_type"]["per_sec"],
+        "flows": flows,
+        "background": {"airtable_calls": generator.outbound[("background", "airtable")],
+                       "telegram_calls": generator.outbound[("background", "telegram")]},
+        "servers": {"telegram": server_totals(telegram), "airtable": server_totals(airtable)},
+    }
+
+def print_report(result, baseline=None):
+    print(f"\n⏱️ {result['elapsed_s']} s, {result['updates']} update-а, "
+          f"{result['updates_per_sec']} update-а/s, {result['transactions_per_sec']} записани транзакции/s")
+    header = f"{'поток':<12}{'бр.':>7}{'/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'грешки':>8}{'Airtable':>10}{'Telegram':>10}"
+    print(header)
+    for flow, stats in result["flows"].items():
+        updates = stats["updates"] or 1
+        errors = stats["rejected"] + stats["timeouts"] + stats["error_replies"]
+        line = (f"{flow:<12}{stats['updates']:>7}{stats['per_sec']:>8}{stats['p50_ms']:>9}{stats['p95_ms']:>9}"
+                f"{stats['p99_ms']:>9}{errors:>8}{stats['airtable_calls'] / updates:>10.2f}{stats['telegram_calls'] / updates:>10.2f}")
+        if baseline and flow in baseline.get("flows", {}):
+            before = baseline["flows"][flow]
+            if before["p95_ms"]:
+                line += f"   p95 {100 * (stats['p95_ms'] - before['p95_ms']) / before['p95_ms']:+.0f}%"
+            if before["per_sec"]:
+                line += f", /s {100 * (stats['per_sec'] - before['per_sec']) / before['per_sec']:+.0f}%"
+        print(line)
+    print("(Airtable/Telegram: заявки на update от handler-а; грешки: отказани + timeout + отговори с ❌/⏱️/⏸️)")
+    print(f"Фонови заявки: {result['background']}")
+    print(f"Заместители: Telegram {result['servers']['telegram']}, Airtable {result['servers']['airtable']}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end benchmark на бота с локални Telegram и Airtable")
+    parser.add_argument("--users", type=int, default=20, help="виртуални потребители (едновременни чатове)")
+    parser.add_argument("--duration", type=float, default=30, help="секунди натоварване")
+    parser.add_argument("--think-time", type=float, default=0.05, help="средна пауза между update-ите на потребител")
+    parser.add_argument("--latency", type=float, default=0.03, help="закъснение на заместителите (s)")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="дял отговори 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="дял отговори 429")
+    parser.add_argument("--airtable-rate", type=float, default=None, help="лимит към Airtable (заявки/s, по подразбиране като в test.py)")
+    parser.add_argument("--outbound-rate", type=int, default=None, help="OUTBOUND_RATE_LIMIT за изпълнението")
+    parser.add_argument("--user-rate-limit", action="store_true", help="запазва лимита на заявки на потребител")
+    parser.add_argument("--save", help="записва резултата като JSON (базова линия)")
+    parser.add_argument("--baseline", help="сравнява с предишен резултат (JSON)")
+    args = parser.parse_args(argv)
+
+    faults = dict(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, throttle_rate=args.throttle_rate)
+    telegram = FakeTelegram(**faults).start()
+    airtable = FakeAirtable(**faults).start()
+
+    # test.py чете настройките при импорт
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": BOT_TOKEN,
+        "AIRTABLE_PERSONAL_ACCESS_TOKEN": "benchmark",
+        "AIRTABLE_BASE_ID": BASE_ID,
+        "TELEGRAM_API_URL": telegram.url,
+        "AIRTABLE_API_URL": f"{airtable.url}/v0",
+    })
+    if args.outbound_rate:
+        os.environ["OUTBOUND_RATE_LIMIT"] = str(args.outbound_rate)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import test as core
+
+    if args.airtable_rate:
+        core.airtable.bucket = core.TokenBucket(args.airtable_rate)
+    if not args.user_rate_limit:
+        # Виртуалните потребители пишат много по-често от истинските
+        core.rate_limiter = core.RateLimiter(max_requests=10 ** 6)
+
+    generator = LoadGenerator(core, telegram, args.users, args.duration, args.think_time)
+
+    core.start_services()
+    deadline = time.monotonic() + 30
+    while not (core.account_catalogue.is_fresh() and core.transaction_types_cache.snapshot) and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    print(f"🚀 {args.users} потребители за {args.duration} s, заместители: {faults}")
+    elapsed = generator.run()
+    result = summarize(generator, elapsed, telegram, airtable)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 Резултатът е записан в {args.save}")
+
+if __name__ == "__main__":
+    main()
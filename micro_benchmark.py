@@ -0,0 +1,246 @@
+"""
+Micro-benchmark на горещите чисто Python функции на бота с праг за регресии.
+
+Мери ops/s и пикова алокирана памет на извикване (tracemalloc) за парсера,
+нормализацията на текст, търсенето на акаунти и кешовете на състоянието върху
+детерминиран корпус от смесени кирилица/латиница съобщения, включително
+невалидни и почти 500-символни. Резултатите се нормализират спрямо кратко
+калибриращо натоварване, за да са сравними между машини.
+
+Стартиране:
+    python3 micro_benchmark.py --save micro_baseline.json   # запис на базова линия
+    python3 micro_benchmark.py --check micro_baseline.json  # exit 1 при регресия
+    python3 micro_benchmark.py --only parse_transaction
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("AIRTABLE_PERSONAL_ACCESS_TOKEN", "benchmark")
+os.environ.setdefault("AIRTABLE_BASE_ID", "appBenchmark")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import test as core
+
+DEFAULT_THRESHOLD = 0.25  # допустимо забавяне / повече памет спрямо базовата линия
+ALLOC_SLACK_BYTES = 64  # разлики в паметта под толкова байта не са регресия
+
+AMOUNTS = ("100", "12.50", "10,50", "1 000", "0.99", "250", "7", "-20", "abc", "1e3", "99999999")
+CURRENCIES = ("лв", "лв.", "lv", "лева", "BGN", "EUR", "евро", "€", "GBP", "£", "паунда", "USD", "$",
+              "долара", "щатски долари", "xyz", "")
+DESCRIPTIONS = ("храна", "наем за апартамент", "coffee", "hrana i napitki", "такси до летището",
+                "razhod ток", "prihod заплата", "подарък за мама", "кола за ремонт", "photo shooting",
+                "Интернет A1 - месечна такса", "zakuska 🥐 в botanika", "ЗА ГОРИВО", "обяд за екипа от офиса")
+ACCOUNTS = ("ДСК", "Revolut", "Wise", "каса", "Пощенска банка", "UniCredit Bulbank", "карта Visa",
+            "WISE EUR", "revolut-gbp", "Fibank (фирмена)")
+KEYWORDS = (("за", "от"), ("for", "from"), ("za", "ot"), ("ЗА", "ОТ"), ("за", "ot"))
+# Гранични случаи на парсера: ключови думи в името на акаунта, частично разпознати суми
+EDGE_CASES = ("100 usd за pizza от Ot bank", "5 евро за кафе от OT BANK", "20 лв за такси from ot bank",
+              "1e5 лв за кола от DSK", "1.2.3 лв за x от y", "1e5.5 лв за x от y", "1 000 лв за наем от DSK")
+
+def build_corpus(size=2000, seed=42):
+    """Детерминиран корпус: ~80% валидни транзакции, невалидни, почти 500-символни и EDGE_CASES."""
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(size):
+        kind = rng.random()
+        za, ot = rng.choice(KEYWORDS)
+        amount, currency = rng.choice(AMOUNTS), rng.choice(CURRENCIES)
+        description, account = rng.choice(DESCRIPTIONS), rng.choice(ACCOUNTS)
+        if kind < 0.8:
+            text = f"{amount} {currency} {za} {description} {ot} {account}"
+        elif kind < 0.9:
+            # Невалидни: липсваща сума/валута/описание, само шум
+            text = rng.choice((
+                f"{za} {description} {ot} {account}",
+                f"{amount} {currency}",
+                f"{amount}{currency}{za}{description}",
+                "".join(rng.choice("абвгд xyz!?.,-€$ 0123") for _ in range(rng.randint(1, 60))),
+                f"{ot} {account} {za}",
+                "",
+            ))
+        else:
+            # Почти на лимита: дълго описание до ~MAX_TRANSACTION_LENGTH символа
+            prefix = f"{amount} {currency} {za} "
+            suffix = f" {ot} {account}"
+            filler = " ".join(rng.choice(DESCRIPTIONS) for _ in range(60))
+            room = core.MAX_TRANSACTION_LENGTH - len(prefix) - len(suffix)
+            text = prefix + filler[:max(0, room)] + suffix
+        corpus.append(text)
+    corpus.extend(EDGE_CASES)
+    return corpus
+
+def calibrate(text):
+    """Фиксирано натоварване (низове, dict, цикли) за нормализиране между машини."""
+    counts = {}
+    for word in text.lower().split():
+        counts[word] = counts.get(word, 0) + 1
+    return len(counts)
+
+def catalogue_with_accounts(count=1000):
+    """AccountCatalogue с count акаунта в паметта (без Airtable)."""
+    catalogue = core.AccountCatalogue(core.url_accounts)
+    rng = random.Random(7)
+    for i in range(count):
+        reg = f"{rng.choice(ACCOUNTS)} {i} {rng.choice(('BGN', 'EUR', 'GBP', 'USD'))}"
+        catalogue._accounts[f"acc{i}"] = (reg, reg.lower())
+    catalogue._last_sync = time.monotonic()
+    return catalogue
+
+def benchmarks(corpus):
+    """{име: (функция на една операция, входове)} - всяка функция приема един вход."""
+    catalogue = catalogue_with_accounts()
+    queries = [core.account_search_terms(account) for account in ACCOUNTS] + [["липсващ"], ["wise", "999"]]
+    ttl_cache = core.TTLCache(maxsize=1000, ttl=600)
+    store = core.ConversationStore(ttl=600)
+    keys = [random.Random(i).randint(0, 5000) for i in range(len(corpus))]
+    account_names = [ACCOUNTS[i % len(ACCOUNTS)] + text[:20] for i, text in enumerate(corpus)]
+
+    def account_search_formula(account_name):
+        terms = core.account_search_terms(account_name)
+        if terms:
+            core.account_search_formula(terms)
+
+    def account_catalogue_find(terms):
+        catalogue._lookup_cache.clear()  # без кеша на заявките - търсене в целия каталог
+        catalogue.find(terms)
+
+    def ttl_cache_churn(key):
+        # 5000 ключа в кеш от 1000: постоянно изхвърляне на най-старите
+        if ttl_cache.get(key) is None:
+            ttl_cache.set(key, key)
+
+    def conversation_store_churn(key):
+        store.set(key, "pending_tx", {"amount": key})
+        store.get(key, "pending_tx")
+        if key % 7 == 0:
+            store.pop(key, "pending_tx")
+
+    return {
+        "parse_transaction": (core.parse_transaction, corpus),
+        "normalize_text": (core.normalize_text, corpus),
+        "clean_string": (core.clean_string, corpus),
+        "account_search_formula": (account_search_formula, account_names),
+        "account_catalogue_find": (account_catalogue_find, queries),
+        "ttl_cache_churn": (ttl_cache_churn, keys),
+        "conversation_store_churn": (conversation_store_churn, keys),
+    }
+
+def measure(fn, inputs, min_time=0.3, repeat=5):
+    """Най-добрите ops/s от repeat серии по поне min_time секунди."""
+    for item in inputs:  # загряване (компилирани regex-и, кешове)
+        fn(item)
+    best = 0.0
+    for _ in range(repeat):
+        calls, started = 0, time.perf_counter()
+        while True:
+            for item in inputs:
+                fn(item)
+            calls += len(inputs)
+            elapsed = time.perf_counter() - started
+            if elapsed >= min_time:
+                break
+        best = max(best, calls / elapsed)
+    return best
+
+def measure_alloc(fn, inputs, sample=500):
+    """Средна пикова памет (байтове), алокирана от едно извикване, върху първите sample входа."""
+    inputs = inputs[:sample]
+    total = 0
+    tracemalloc.start()
+    try:
+        for item in inputs:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            fn(item)
+            total += tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return total / len(inputs)
+
+def run(only=None, min_time=0.3, repeat=5):
+    corpus = build_corpus()
+    calibrations = []
+    results = {}
+    for name, (fn, inputs) in benchmarks(corpus).items():
+        if only and name not in only:
+            continue
+        # Паметта първо - върху още недокоснатото състояние на кешовете, за да е повторима
+        alloc = measure_alloc(fn, inputs)
+        # Калибрираме непосредствено преди всяка функция - компенсира промени в натоварването на машината
+        calibration = measure(calibrate, corpus, min_time, repeat)
+        calibrations.append(calibration)
+        ops_per_sec = measure(fn, inputs, min_time, repeat)
+        results[name] = {
+            "ops_per_sec": round(ops_per_sec, 1),
+            "us_per_op": round(1e6 / ops_per_sec, 3),
+            "score": round(ops_per_sec / calibration, 6),  # относително спрямо калибрирането
+            "alloc_bytes_per_op": round(alloc, 1),
+        }
+    calibration = sum(calibrations) / len(calibrations) if calibrations else 0.0
+    return {"python": sys.version.split()[0], "calibration_ops_per_sec": round(calibration, 1), "benchmarks": results}
+
+def regressions(result, baseline, threshold=DEFAULT_THRESHOLD):
+    """Списък с описания на регресиите спрямо базовата линия."""
+    found = []
+    for name, stats in result["benchmarks"].items():
+        before = baseline.get("benchmarks", {}).get(name)
+        if not before:
+            continue
+        if stats["score"] < before["score"] * (1 - threshold):
+            found.append(f"{name}: {100 * (stats['score'] / before['score'] - 1):+.0f}% скорост")
+        limit = max(before["alloc_bytes_per_op"] * (1 + threshold), before["alloc_bytes_per_op"] + ALLOC_SLACK_BYTES)
+        if stats["alloc_bytes_per_op"] > limit:
+            found.append(f"{name}: {stats['alloc_bytes_per_op']:.0f} B/op памет (беше {before['alloc_bytes_per_op']:.0f})")
+    return found
+
+def print_report(result, baseline=None):
+    print(f"Python {result['python']}, калибриране {result['calibration_ops_per_sec']:.0f} ops/s")
+    print(f"{'функция':<26}{'ops/s':>12}{'µs/op':>10}{'B/op':>10}")
+    for name, stats in result["benchmarks"].items():
+        line = f"{name:<26}{stats['ops_per_sec']:>12.0f}{stats['us_per_op']:>10.2f}{stats['alloc_bytes_per_op']:>10.0f}"
+        before = (baseline or {}).get("benchmarks", {}).get(name)
+        if before:
+            line += f"   {100 * (stats['score'] / before['score'] - 1):+.0f}% спрямо базата"
+        print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmark на парсера, търсенето и кешовете")
+    parser.add_argument("--save", help="записва резултата като базова линия (JSON)")
+    parser.add_argument("--check", help="сравнява с базова линия и връща 1 при регресия")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="допустима регресия (0.25 = 25%%)")
+    parser.add_argument("--only", nargs="*", help="само тези функции")
+    parser.add_argument("--min-time", type=float, default=0.3, help="секунди на серия")
+    parser.add_argument("--repeat", type=int, default=5, help="брой серии (взема се най-добрата)")
+    args = parser.parse_args(argv)
+
+    result = run(args.only, args.min_time, args.repeat)
+
+    baseline = None
+    if args.check:
+        with open(args.check, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 Базовата линия е записана в {args.save}")
+
+    if baseline is not None:
+        found = regressions(result, baseline, args.threshold)
+        if found:
+            print("❌ Регресии над прага:")
+            for item in found:
+                print(f"  - {item}")
+            return 1
+        print("✅ Няма регресии над прага")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
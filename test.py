@@ -1,13 +1,332 @@
 import os
+import sys
 import re
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
 import telebot
 from telebot import types
+from telebot.handler_backends import HandlerBackend
 import time
 import threading
+import itertools
+import random
+import json
+import uuid
+import queue
+import csv
+import io
+import tempfile
+import heapq
+import bisect
 import functools
-from collections import OrderedDict
+import inspect
+import sqlite3
+from collections import OrderedDict, Counter, defaultdict, deque
+from concurrent.futures import Future
+from urllib.parse import unquote
+from transliterate import translit
+
+PROCESS_STARTED = time.monotonic()  # за отчитане на времето за стартиране
+
+# Метрики във формата на Prometheus (GET /metrics)
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # ако е зададен, /metrics изисква Authorization: Bearer
+
+def format_metric_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class BoundMetric:
+    """Метрика с фиксирани етикети - за горещи места, без да се строи ключът при всяко извикване."""
+
+    def __init__(self, metric, key):
+        self.metric = metric
+        self.key = key
+
+    def inc(self, amount=1):
+        self.metric._add(self.key, amount)
+
+    def dec(self, amount=1):
+        self.metric._add(self.key, -amount)
+
+    def observe(self, value):
+        self.metric._observe(self.key, value)
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels):
+        return BoundMetric(self, tuple(str(labels[name]) for name in self.labels_names))
+
+    def _add(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name + format_metric_labels(self.labels_names, key), value
+
+class MetricCounter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        self._add(tuple(str(labels[name]) for name in self.labels_names), amount)
+
+class MetricGauge(Metric):
+    """Gauge; с function стойността се чете при всяко изобразяване."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=(), function=None):
+        super().__init__(name, help_text, labels)
+        self.function = function
+
+    def inc(self, amount=1, **labels):
+        self._add(tuple(str(labels[name]) for name in self.labels_names), amount)
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.function is None:
+            yield from super().samples()
+            return
+        try:
+            yield self.name, self.function()
+        except Exception as e:
+            print(f"⚠️ Cannot read metric {self.name}: {e}")
+
+class MetricHistogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=METRICS_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        self._observe(tuple(str(labels[name]) for name in self.labels_names), value)
+
+    def _observe(self, key, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield self.name + "_bucket" + format_metric_labels(self.labels_names, key, [("le", le)]), cumulative
+            yield self.name + "_sum" + format_metric_labels(self.labels_names, key), total
+            yield self.name + "_count" + format_metric_labels(self.labels_names, key), cumulative
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(MetricCounter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=(), function=None):
+        return self._register(MetricGauge(name, help_text, labels, function))
+
+    def histogram(self, name, help_text, labels=(), buckets=METRICS_BUCKETS):
+        return self._register(MetricHistogram(name, help_text, labels, buckets))
+
+    def render(self):
+        """Текстовият формат на Prometheus (version 0.0.4)."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample, value in metric.samples():
+                lines.append(f"{sample} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.histogram("bot_handler_duration_seconds", "Време за изпълнение на handler-ите", ["handler"])
+HANDLER_OUTBOUND = metrics.counter("bot_handler_outbound_requests_total",
+                                   "Изходящи заявки, направени от handler-ите", ["handler", "service"])
+OUTBOUND_LATENCY = metrics.histogram("bot_outbound_request_duration_seconds",
+                                     "Изходящи заявки към Airtable (по таблица) и Telegram (по метод)",
+                                     ["service", "target", "method", "status"])
+CACHE_EVENTS = metrics.counter("bot_cache_events_total", "Попадения, пропуски и изхвърляния в кешовете", ["cache", "event"])
+RATE_LIMITED = metrics.counter("bot_rate_limited_total", "Заявки, отказани от лимита на потребител")
+UPDATES = metrics.counter("bot_updates_total", "Получени update-и по резултат", ["result"])
+UPDATES_IN_FLIGHT = metrics.gauge("bot_updates_in_flight", "Приети update-и, които още не са обработени")
+
+SLOW_UPDATES = metrics.counter("bot_slow_updates_total", "Update-и, обработвани по-дълго от TRACE_SLOW_THRESHOLD")
+
+# Handler-ът и trace-ът на update-а, които се изпълняват в текущата нишка
+handler_context = threading.local()
+
+# Трасиране на update-ите: бавните се логват и последните се пазят за /admin/traces
+TRACE_SLOW_THRESHOLD = float(os.getenv("TRACE_SLOW_THRESHOLD", "2.0"))  # секунди
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "100"))
+TRACE_MAX_SPANS = 200  # при безкрайни повторни опити trace-ът не расте неограничено
+
+class Trace:
+    """
+    Пътят на един update от приемането му до края на обработката: изчакване в опашката,
+    handler-ите и всяка изходяща заявка (с повторните опити) като span-ове с отместване
+    от началото. Span-ове идват и от нишките на планировчика на Telegram, затова има lock.
+    """
+
+    def __init__(self, update_id=None, chat_id=None):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.update_id = update_id
+        self.chat_id = chat_id
+        self.received_at = datetime.now()
+        self.started = time.monotonic()
+        self.duration = None
+        self.spans = []
+        self.dropped_spans = 0
+        self._lock = threading.Lock()
+
+    def add_span(self, name, started, duration, **attrs):
+        with self._lock:
+            if len(self.spans) >= TRACE_MAX_SPANS:
+                self.dropped_spans += 1
+                return
+            self.spans.append((name, started - self.started, duration, attrs))
+
+    def finish(self):
+        self.duration = time.monotonic() - self.started
+        return self.duration
+
+    def to_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span[1])
+            dropped = self.dropped_spans
+        return {
+            "trace_id": self.trace_id,
+            "update_id": self.update_id,
+            "chat_id": self.chat_id,
+            "received_at": self.received_at.isoformat(timespec="milliseconds"),
+            "duration_ms": round(self.duration * 1000, 1) if self.duration is not None else None,
+            "spans": [
+                {"name": name, "start_ms": round(offset * 1000, 1), "duration_ms": round(duration * 1000, 1),
+                 **{key: value for key, value in attrs.items() if value is not None}}
+                for name, offset, duration, attrs in spans
+            ],
+            "dropped_spans": dropped,
+        }
+
+class SlowTraceLog:
+    """Логва trace-овете над прага като JSON и пази последните size от тях."""
+
+    def __init__(self, threshold=TRACE_SLOW_THRESHOLD, size=TRACE_BUFFER_SIZE):
+        self.threshold = threshold
+        self._traces = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, trace):
+        duration = trace.finish()
+        if duration < self.threshold:
+            return False
+        data = trace.to_dict()
+        with self._lock:
+            self._traces.append(data)
+        SLOW_UPDATES.inc()
+        print(f"🐢 Бавен update {trace.update_id} ({duration:.2f} s): {json.dumps(data, ensure_ascii=False)}")
+        return True
+
+    def recent(self, limit=None, chat_id=None):
+        """Най-новите първи; по избор само за един чат."""
+        with self._lock:
+            traces = list(self._traces)
+        traces.reverse()
+        if chat_id is not None:
+            traces = [trace for trace in traces if trace["chat_id"] == chat_id]
+        return traces[:limit] if limit else traces
+
+slow_traces = SlowTraceLog()
+
+def current_trace():
+    return getattr(handler_context, "trace", None)
+
+def traced(fn):
+    """
+    Добавя span за функцията към trace-а на текущия update (ако има такъв). За
+    генератор span-ът започва с първата стъпка и е сумата от времето в самия
+    генератор (без времето на извикващия между стъпките), записва се при изчерпването
+    или затварянето му.
+    """
+    if inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def generator_wrapper(*args, **kwargs):
+            trace = current_trace()
+            if trace is None:
+                return (yield from fn(*args, **kwargs))
+            generator = fn(*args, **kwargs)
+            started, busy = None, 0.0
+            try:
+                while True:
+                    step = time.monotonic()
+                    if started is None:
+                        started = step
+                    try:
+                        item = next(generator)
+                    except StopIteration as stop:
+                        return stop.value
+                    finally:
+                        busy += time.monotonic() - step
+                    yield item
+            finally:
+                generator.close()
+                trace.add_span(fn.__name__, started, busy)
+        return generator_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        trace = current_trace()
+        if trace is None:
+            return fn(*args, **kwargs)
+        started = time.monotonic()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            trace.add_span(fn.__name__, started, time.monotonic() - started)
+    return wrapper
+
+def observe_outbound(service, target, method, status, seconds, handler=None, trace=None, **attrs):
+    """
+    Записва изходяща заявка в метриките и като span в trace-а. handler и trace по
+    подразбиране са тези от текущата нишка; attrs (опит, изчакване...) отиват в span-а.
+    """
+    OUTBOUND_LATENCY.observe(seconds, service=service, target=target, method=method, status=status)
+    handler = handler or getattr(handler_context, "name", None)
+    if handler is not None:
+        HANDLER_OUTBOUND.inc(handler=handler, service=service)
+    trace = trace or current_trace()
+    if trace is not None:
+        trace.add_span(f"{service}.{target}", time.monotonic() - seconds, seconds,
+                       method=method, status=status, handler=handler, **attrs)
+
 
 
 # Validate credentials on startup
@@ -22,108 +341,905 @@ TABLE_ACCOUNTS = "ВСИЧКИ АКАУНТИ"
 TABLE_REPORTS = "Отчет Телеграм"
 TABLE_TRANSACTION_TYPES = "ВИД ТРАНЗАКЦИЯ"
 
-# Подготовка на URL и headers за Airtable API
-url_accounts = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{TABLE_ACCOUNTS}"
-url_reports = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{TABLE_REPORTS}"
-headers = {
-    "Authorization": f"Bearer {AIRTABLE_PERSONAL_ACCESS_TOKEN}",
-    "Content-Type": "application/json"
-}
+# Настройки на клиента за Airtable
+AIRTABLE_RATE_LIMIT = 5  # заявки в секунда на база (лимитът на Airtable)
+AIRTABLE_TIMEOUT = 10
+AIRTABLE_MAX_RETRIES = 3
+AIRTABLE_MAX_BACKOFF = 30
+AIRTABLE_POOL_SIZE = 10
+AIRTABLE_API_URL = os.getenv("AIRTABLE_API_URL", "https://api.airtable.com/v0")  # друг адрес - локален заместител
+
+class TokenBucket:
+    """Thread-safe token bucket: rate токена в секунда, до capacity натрупани."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Взема токен и връща колко секунди трябва да се изчака преди заявката."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """Блокира, докато има свободен токен."""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+# Общ бюджет за всички изходящи заявки (Airtable + Telegram API), за всички потребители
+OUTBOUND_RATE_LIMIT = int(os.getenv("OUTBOUND_RATE_LIMIT", "30"))  # заявки в секунда
+TELEGRAM_POOL_SIZE = 10
+
+outbound_budget = TokenBucket(OUTBOUND_RATE_LIMIT)
+
+# Circuit breaker за Airtable: при поредица от грешки заявките се отказват веднага,
+# вместо всеки handler да чака timeout
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("AIRTABLE_CIRCUIT_FAILURES", "5"))  # поредни грешки до отваряне
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("AIRTABLE_CIRCUIT_RESET", "30"))  # секунди до пробна заявка
+CIRCUIT_SLOW_CALL = float(os.getenv("AIRTABLE_CIRCUIT_SLOW_CALL", "5"))  # по-бавен отговор се брои за грешка
+
+CIRCUIT_REJECTED = metrics.counter("bot_airtable_circuit_rejected_total", "Заявки към Airtable, отказани от circuit breaker-а")
+
+class AirtableUnavailable(requests.exceptions.ConnectionError):
+    """Заявката не е изпратена: circuit breaker-ът е отворен."""
+
+class CircuitBreaker:
+    """
+    closed - заявките минават и поредните грешки (timeout, връзка, 5xx, по-бавен от
+    slow_call отговор) се броят; failure_threshold поредни грешки отварят веригата.
+    open - заявките се отказват веднага за reset_timeout секунди.
+    half_open - минава една пробна заявка: успех затваря веригата, грешка я отваря отново.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout=CIRCUIT_RESET_TIMEOUT, slow_call=CIRCUIT_SLOW_CALL):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call = slow_call
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Дали заявката може да се изпрати (в half_open заема пробата)."""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probing = False
+                print(f"🟡 {self.name}: пробна заявка след {self.reset_timeout:.0f} s")
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+        CIRCUIT_REJECTED.inc()
+        return False
+
+    def available(self):
+        """Дали следваща заявка би минала (без да заема пробата)."""
+        with self._lock:
+            if self.state == self.OPEN:
+                return time.monotonic() - self._opened_at >= self.reset_timeout
+            return self.state == self.CLOSED or not self._probing
+
+    def release(self):
+        """Прекъсната заявка (cancel): освобождава пробата, без да се брои като грешка."""
+        with self._lock:
+            self._probing = False
+
+    def record(self, ok, seconds=0.0):
+        """Резултатът от изпратена заявка."""
+        ok = ok and seconds <= self.slow_call
+        with self._lock:
+            self._probing = False
+            if ok:
+                if self.state != self.CLOSED:
+                    print(f"🟢 {self.name}: отново достъпен")
+                self.state = self.CLOSED
+                self._failures = 0
+                return
+            self._failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                print(f"🔴 {self.name}: {self._failures} поредни грешки - заявките спират за {self.reset_timeout:.0f} s")
+
+def airtable_table_name(base_id, url):
+    """Името на таблицата от URL на заявка към Airtable (етикет за метриките)."""
+    return unquote(url.split(f"/{base_id}/", 1)[-1].split("/", 1)[0].split("?", 1)[0])
+
+class AirtableClient:
+    """
+    Общ клиент за всички заявки към Airtable: keep-alive connection pool,
+    лимит от AIRTABLE_RATE_LIMIT заявки/сек на база, еднакви timeouts и retry
+    на 429/5xx с jittered backoff, който спазва Retry-After.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    IDEMPOTENT_METHODS = ("GET", "PATCH", "DELETE")
+
+    def __init__(self, base_id, token, rate=AIRTABLE_RATE_LIMIT, timeout=AIRTABLE_TIMEOUT,
+                 max_retries=AIRTABLE_MAX_RETRIES, pool_size=AIRTABLE_POOL_SIZE, budget=outbound_budget):
+        self.base_id = base_id
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate)
+        self.budget = budget
+        self.breaker = CircuitBreaker("Airtable")
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json"
+        })
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount(AIRTABLE_API_URL, adapter)
+
+    def table_url(self, table):
+        return f"{AIRTABLE_API_URL}/{self.base_id}/{table}"
+
+    def available(self):
+        """Дали следваща заявка би минала (вкл. пробната) - за фоновите задачи."""
+        return self.breaker.available()
+
+    def healthy(self):
+        """Веригата е затворена. Заявките на потребителите не чакат пробите - те са за фоновите задачи."""
+        return self.breaker.state == CircuitBreaker.CLOSED
+
+    @staticmethod
+    def _backoff(attempt, res=None):
+        """Изчакване преди следващия опит: Retry-After или експоненциален backoff с jitter."""
+        if res is not None:
+            retry_after = res.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    return min(float(retry_after), AIRTABLE_MAX_BACKOFF)
+                except ValueError:
+                    pass
+        return random.uniform(0, min(AIRTABLE_MAX_BACKOFF, 0.5 * 2 ** attempt))
+
+    def request(self, method, url, **kwargs):
+        method = method.upper()
+        kwargs.setdefault("timeout", self.timeout)
+        retry_errors = method in self.IDEMPOTENT_METHODS
+
+        table = airtable_table_name(self.base_id, url)
+        formula = (kwargs.get("params") or {}).get("filterByFormula")
+        attempt = 0
+        ready = time.monotonic()
+        while True:
+            if not self.breaker.allow():
+                raise AirtableUnavailable(f"Airtable е временно недостъпен ({self.breaker.state})")
+            self.bucket.acquire()
+            if self.budget is not None:
+                self.budget.acquire()
+            started = time.monotonic()
+            # wait_ms: лимитите на заявките и backoff-ът преди този опит
+            span = dict(attempt=attempt + 1, wait_ms=round((started - ready) * 1000, 1), formula=formula)
+            try:
+                res = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                observe_outbound("airtable", table, method, "error", time.monotonic() - started, **span)
+                self.breaker.record(False)
+                if not retry_errors or attempt >= self.max_retries:
+                    raise
+                ready = time.monotonic()
+                time.sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+            except Exception:
+                self.breaker.record(False)  # иначе пробата в half_open остава заета
+                raise
+            observe_outbound("airtable", table, method, res.status_code, time.monotonic() - started, **span)
+            self.breaker.record(res.status_code < 500, time.monotonic() - started)
+            ready = time.monotonic()
+
+            # POST се повтаря само при 429 - тогава Airtable със сигурност не е записал нищо
+            retryable = res.status_code == 429 or (retry_errors and res.status_code in self.RETRY_STATUSES)
+            if not retryable or attempt >= self.max_retries:
+                return res
+            print(f"⚠️ Airtable {res.status_code} за {method}, повторен опит {attempt + 1}")
+            time.sleep(self._backoff(attempt, res))
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+airtable = AirtableClient(AIRTABLE_BASE_ID, AIRTABLE_PERSONAL_ACCESS_TOKEN)
+
+# Подготовка на URL за Airtable API
+url_accounts = airtable.table_url(TABLE_ACCOUNTS)
+url_reports = airtable.table_url(TABLE_REPORTS)
+
+# Изпращане към Telegram: общ планировчик с лимити на чат и глобален лимит
+TELEGRAM_GLOBAL_RATE = 30  # съобщения в секунда за бота
+TELEGRAM_CHAT_RATE = 1  # съобщения в секунда в личен чат
+TELEGRAM_GROUP_RATE = 20 / 60  # съобщения в секунда в група
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_SEND_WORKERS = 8
+TELEGRAM_MAX_RETRIES = 3
+TELEGRAM_MAX_RETRY_AFTER = 60
+
+# Методи, които минават през планировчика; answerCallbackQuery е с предимство
+TELEGRAM_SCHEDULED_METHODS = {"sendMessage", "sendDocument", "editMessageText", "editMessageReplyMarkup",
+                              "deleteMessage", "answerCallbackQuery"}
+TELEGRAM_URGENT_METHODS = {"answerCallbackQuery"}
+TELEGRAM_COALESCED_METHODS = {"editMessageText", "editMessageReplyMarkup"}
+
+def telegram_retry_after(result=None, error=None):
+    """retry_after (секунди) от 429 отговор на Telegram (Response или ApiTelegramException) или None."""
+    try:
+        if error is not None:
+            if getattr(error, "error_code", None) != 429:
+                return None
+            data = error.result_json
+        elif result is not None and getattr(result, "status_code", None) == 429:
+            data = result.json()
+        else:
+            return None
+        return min(float(data.get("parameters", {}).get("retry_after", 1)), TELEGRAM_MAX_RETRY_AFTER)
+    except (ValueError, AttributeError, TypeError):
+        return 1.0
+
+class TelegramSendJob:
+    def __init__(self, chat_id, method_name, params, send, retry=True):
+        self.chat_id = str(chat_id) if chat_id is not None else None  # telebot подава chat_id и като str, и като int
+        self.urgent = method_name in TELEGRAM_URGENT_METHODS or chat_id is None
+        self.key = (method_name, params.get("message_id")) if method_name in TELEGRAM_COALESCED_METHODS else None
+        self.send = send
+        self.retry = retry
+        self.attempts = 0
+        self.future = Future()
+
+class TelegramSendScheduler:
+    """
+    Централно изпращане към Telegram. Заявките на всеки чат се изпращат по ред
+    (FIFO) през token bucket на чата (~1/сек в личен чат, 20/мин в група), а всички
+    заедно - през глобален bucket от TELEGRAM_GLOBAL_RATE в секунда. Отговорите на
+    callback-и (answerCallbackQuery) не чакат лимита на чата и минават първи.
+    Поредни редакции на едно и също съобщение, които още чакат, се сливат в една
+    (изпраща се само последната). При 429 заявката се повтаря след retry_after,
+    а чатът се паузира за това време.
+    """
+
+    def __init__(self, workers=TELEGRAM_SEND_WORKERS, global_rate=TELEGRAM_GLOBAL_RATE):
+        self.workers = workers
+        self.global_bucket = TokenBucket(global_rate)
+        self._cond = threading.Condition()
+        self._urgent = deque()
+        self._delayed = []  # heap от (кога, seq, заявка) за спешните заявки, чакащи retry_after
+        self._chats = {}  # chat_id -> deque от чакащи заявки
+        self._ready = []  # heap от (кога, seq, chat_id) за чатовете, чиято първа заявка чака ред
+        self._busy = set()  # чатове със заявка в момента
+        self._buckets = {}
+        self._paused_until = {}
+        self._seq = itertools.count()
+        self._next_sweep = time.monotonic() + 60
+        self._threads = []
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"telegram-sender-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            rate = TELEGRAM_GROUP_RATE if chat_id.startswith("-") else TELEGRAM_CHAT_RATE
+            bucket = self._buckets[chat_id] = TokenBucket(rate, TELEGRAM_CHAT_BURST)
+        return bucket
+
+    def _schedule(self, chat_id, now):
+        """Нарежда първата заявка на чата според лимита му и евентуална пауза след 429."""
+        ready_at = max(now + self._bucket(chat_id).reserve(), self._paused_until.get(chat_id, 0))
+        heapq.heappush(self._ready, (ready_at, next(self._seq), chat_id))
+
+    def _sweep(self, now):
+        """Премахва лимитите на неактивните чатове (веднъж в минута)."""
+        for chat_id in [c for c in self._buckets if c not in self._chats and c not in self._busy]:
+            if self._paused_until.get(chat_id, 0) <= now:
+                del self._buckets[chat_id]
+                self._paused_until.pop(chat_id, None)
+        self._next_sweep = now + 60
+
+    def submit(self, chat_id, method_name, params, send, retry=True):
+        """Нарежда заявката; връща Future с резултата на send()."""
+        if not self._threads:
+            self.start()
+        job = TelegramSendJob(chat_id, method_name, params, send, retry)
+        chat_id = job.chat_id
+        with self._cond:
+            now = time.monotonic()
+            if now >= self._next_sweep:
+                self._sweep(now)
+            if job.urgent:
+                self._urgent.append(job)
+            else:
+                pending = self._chats.get(chat_id)
+                if pending and job.key is not None and pending[-1].key == job.key:
+                    # Поредна редакция на същото съобщение: изпращаме само последната
+                    pending[-1].send = send
+                    return pending[-1].future
+                if pending is None:
+                    pending = self._chats[chat_id] = deque()
+                pending.append(job)
+                if len(pending) == 1 and chat_id not in self._busy:
+                    self._schedule(chat_id, now)
+            self._cond.notify()
+        return job.future
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    self._urgent.append(heapq.heappop(self._delayed)[2])
+                if self._urgent:
+                    return self._urgent.popleft()
+                if self._ready and self._ready[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self._ready)
+                    self._busy.add(chat_id)
+                    return self._chats[chat_id].popleft()
+                wake_at = min([heap[0][0] for heap in (self._ready, self._delayed) if heap], default=None)
+                self._cond.wait(wake_at - now if wake_at is not None else None)
+
+    def _release(self, job, retry_after=None):
+        """Освобождава чата след заявката; при retry_after връща заявката първа в опашката."""
+        with self._cond:
+            if job.urgent:
+                if retry_after is not None:
+                    # Не спим в нишката на изпращача - заявката чака в _delayed
+                    heapq.heappush(self._delayed, (time.monotonic() + retry_after, next(self._seq), job))
+                    self._cond.notify()
+                return
+            now = time.monotonic()
+            chat_id = job.chat_id
+            self._busy.discard(chat_id)
+            pending = self._chats.get(chat_id)
+            if retry_after is not None:
+                self._paused_until[chat_id] = now + retry_after
+                if pending is None:
+                    pending = self._chats[chat_id] = deque()
+                pending.appendleft(job)
+            if pending:
+                self._schedule(chat_id, now)
+            else:
+                self._chats.pop(chat_id, None)
+            self._cond.notify()
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            self.global_bucket.acquire()
+            result, error = None, None
+            try:
+                result = job.send()
+            except Exception as e:
+                error = e
+
+            retry_after = telegram_retry_after(result, error)
+            if retry_after is not None and job.retry and job.attempts < TELEGRAM_MAX_RETRIES:
+                job.attempts += 1
+                print(f"⚠️ Telegram 429 за чат {job.chat_id}, повторен опит след {retry_after} сек.")
+                self._release(job, retry_after)
+                continue
+
+            self._release(job)
+            if error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+
+telegram_scheduler = TelegramSendScheduler()
+
+# Заявките към Telegram API минават през същия общ бюджет
+# Друг адрес на Bot API: локален Bot API сървър или заместител при benchmark
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+telebot.apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+
+telegram_session = requests.Session()
+telegram_session.mount(TELEGRAM_API_URL, HTTPAdapter(pool_connections=1, pool_maxsize=TELEGRAM_POOL_SIZE))
+
+def send_telegram_request(method, url, params=None, files=None, nowait=False, **kwargs):
+    """
+    CUSTOM_REQUEST_SENDER на telebot. С nowait=True (само от *_nowait помощниците по-долу)
+    връща Future, вместо да чака реда на чата в планировчика.
+    """
+    method_name = url.rsplit("/", 1)[-1]
+    # send() може да се изпълни в нишка на планировчика - запомняме handler-а и trace-а от тази
+    handler = getattr(handler_context, "name", None)
+    trace = current_trace()
+    attempts = 0
+    ready = time.monotonic()
+
+    def send():
+        nonlocal attempts, ready
+        outbound_budget.acquire()
+        started = time.monotonic()
+        attempts += 1
+        # wait_ms: опашката на планировчика, лимитите и паузата след 429 преди този опит
+        span = dict(attempt=attempts, wait_ms=round((started - ready) * 1000, 1))
+        try:
+            res = telegram_session.request(method, url, params=params, files=files, **kwargs)
+        except requests.exceptions.RequestException:
+            observe_outbound("telegram", method_name, method.upper(), "error", time.monotonic() - started,
+                             handler, trace, **span)
+            raise
+        finally:
+            ready = time.monotonic()
+        observe_outbound("telegram", method_name, method.upper(), res.status_code, time.monotonic() - started,
+                         handler, trace, **span)
+        return res
+
+    if method_name not in TELEGRAM_SCHEDULED_METHODS:
+        if nowait:
+            future = Future()
+            future.set_result(send())
+            return future
+        return send()
+    params = params or {}
+    # Файловете не могат да се изпратят повторно (вече са прочетени)
+    future = telegram_scheduler.submit(params.get("chat_id"), method_name, params, send, retry=not files)
+    return future if nowait else future.result()
+
+telebot.apihelper.CUSTOM_REQUEST_SENDER = send_telegram_request
 
 # Инициализиране на Telegram бота
-bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
+# threaded=False: handler-ите се изпълняват в нашия UpdateDispatcher, който пази реда по чат
+bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN, threaded=False)
+
+# Информационни съобщения и редакции, чийто резултат не ни трябва: handler-ът не чака
+# лимита на чата в планировчика и не държи worker-а на UpdateDispatcher (а с него и
+# другите чатове в същата опашка). Редът в чата се запазва - заявките минават през
+# същата FIFO опашка. Грешките само се логват.
+def _log_nowait_result(method_name, future):
+    try:
+        res = future.result()
+    except Exception as e:
+        print(f"❌ Telegram {method_name}: {e}")
+        return
+    if res.status_code != 200:
+        print(f"⚠️ Telegram {method_name}: {res.status_code} - {res.text[:200]}")
+
+def telegram_nowait(method_name, **params):
+    params = {key: value.to_json() if hasattr(value, "to_json") else value
+              for key, value in params.items() if value is not None}
+    url = telebot.apihelper.API_URL.format(TELEGRAM_BOT_TOKEN, method_name)
+    # Същият timeout като при bot.send_message - иначе блокирала връзка държи нишка на планировчика
+    timeout = (telebot.apihelper.CONNECT_TIMEOUT, telebot.apihelper.READ_TIMEOUT)
+    future = telebot.apihelper.CUSTOM_REQUEST_SENDER("post", url, params=params, timeout=timeout, nowait=True)
+    future.add_done_callback(functools.partial(_log_nowait_result, method_name))
+    return future
+
+def send_message_nowait(chat_id, text, **kwargs):
+    return telegram_nowait("sendMessage", chat_id=chat_id, text=text, **kwargs)
+
+def reply_to_nowait(message, text, **kwargs):
+    reply_parameters = json.dumps({"message_id": message.message_id, "allow_sending_without_reply": True})
+    return telegram_nowait("sendMessage", chat_id=message.chat.id, text=text, reply_parameters=reply_parameters, **kwargs)
+
+def edit_message_text_nowait(text, chat_id, message_id, **kwargs):
+    return telegram_nowait("editMessageText", chat_id=chat_id, message_id=message_id, text=text, **kwargs)
 
 # Constants for memory limits
 MAX_USER_RECORDS = 10
-MAX_USERS_IN_MEMORY = 100
 MAX_STATE_AGE_MINUTES = 30
 
-# LRU cache implementation for user data
-class LRUCache(OrderedDict):
-    def __init__(self, maxsize=128):
+# TTL cache: записите изтичат след ttl секунди, при препълване се изхвърлят най-старите
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=600, name="ttl"):
         self.maxsize = maxsize
-        super().__init__()
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self._hits = CACHE_EVENTS.labels(cache=name, event="hit")
+        self._misses = CACHE_EVENTS.labels(cache=name, event="miss")
+        self._expired = CACHE_EVENTS.labels(cache=name, event="expired")
+        self._evictions = CACHE_EVENTS.labels(cache=name, event="eviction")
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self._misses.inc()
+                return default
+            if item[1] <= time.monotonic():
+                del self._data[key]
+                self._expired.inc()
+                self._misses.inc()
+                return default
+            self._hits.inc()
+            return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._evictions.inc()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+# Състояние на разговорите: един запис на потребител с изтичане
+CONVERSATIONS_EXPIRED = CACHE_EVENTS.labels(cache="conversations", event="expired")
+CONVERSATION_STRIPES = 64
+CONVERSATION_WHEEL_RESOLUTION = 60  # секунди на слот в timer wheel-а
+
+class ConversationEntry:
+    def __init__(self):
+        self.fields = {}
+        self.expires_at = 0
+        self.slot = None
+
+class ConversationStripe:
+    def __init__(self, slots):
+        self.lock = threading.Lock()
+        self.entries = {}  # user_id -> ConversationEntry
+        self.wheel = [set() for _ in range(slots)]  # слот -> user_id-та, които изтичат в него
+
+class ConversationBackend:
+    """
+    Интерфейс на хранилищата за състоянието на разговорите: get/set/pop/clear по
+    (user_id, поле), tick() за изтриване на изтеклите записи и __len__.
+    """
 
-    def __getitem__(self, key):
-        value = super().__getitem__(key)
-        self.move_to_end(key)
-        return value
+    resolution = CONVERSATION_WHEEL_RESOLUTION
+    _thread = None
 
-    def __setitem__(self, key, value):
-        if key in self:
-            self.move_to_end(key)
-        super().__setitem__(key, value)
-        if len(self) > self.maxsize:
-            oldest = next(iter(self))
-            del self[oldest]
+    def _run(self):
+        while True:
+            time.sleep(self.resolution)
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"❌ Грешка при изчистване на състоянията: {e}")
 
-# Словар за запазване на всички записи на потребителя с ограничен размер
-user_records = LRUCache(maxsize=MAX_USERS_IN_MEMORY)
-user_pending_type = LRUCache(maxsize=MAX_USERS_IN_MEMORY)
-pending_transaction_data = LRUCache(maxsize=MAX_USERS_IN_MEMORY)
-user_editing = LRUCache(maxsize=MAX_USERS_IN_MEMORY)
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="conversation-expiry", daemon=True)
+            self._thread.start()
 
-# State timestamps for cleanup
-user_state_timestamps = LRUCache(maxsize=MAX_USERS_IN_MEMORY)
+    def field(self, name):
+        return ConversationField(self, name)
 
-# Rate limiting
-class RateLimiter:
-    def __init__(self, max_requests=30, time_window=60):
-        self.max_requests = max_requests
-        self.time_window = time_window
-        self.requests = LRUCache(maxsize=MAX_USERS_IN_MEMORY)
+class ConversationStore(ConversationBackend):
+    """
+    Състоянието на разговорите (чакаща транзакция, избор на ВИД, редакция, последни
+    записи) в един запис на потребител. Потребителите са разпределени в
+    CONVERSATION_STRIPES ленти, всяка със собствен lock, така че различни
+    потребители не се чакат. Всеки запис изтича ttl секунди след последната
+    промяна: при достъп изтеклият запис се изтрива веднага, а фонова нишка обхожда
+    само слота от timer wheel-а, чието време е минало, вместо всички потребители.
+    """
 
-    def is_allowed(self, user_id):
-        now = datetime.now()
-        if user_id not in self.requests:
-            self.requests[user_id] = []
+    def __init__(self, ttl=MAX_STATE_AGE_MINUTES * 60, stripes=CONVERSATION_STRIPES,
+                 resolution=CONVERSATION_WHEEL_RESOLUTION):
+        self.ttl = ttl
+        self.resolution = resolution
+        self.slots = int(ttl // resolution) + 2
+        self._stripes = [ConversationStripe(self.slots) for _ in range(stripes)]
+        self._last_tick = int(time.monotonic() // resolution)
+
+    def _stripe(self, user_id):
+        return self._stripes[hash(user_id) % len(self._stripes)]
+
+    def _live_entry(self, stripe, user_id, now):
+        entry = stripe.entries.get(user_id)
+        if entry is not None and entry.expires_at <= now:
+            self._drop(stripe, user_id)
+            CONVERSATIONS_EXPIRED.inc()
+            return None
+        return entry
+
+    def _drop(self, stripe, user_id):
+        entry = stripe.entries.pop(user_id, None)
+        if entry is not None:
+            stripe.wheel[entry.slot].discard(user_id)
+
+    def _touch(self, stripe, user_id, entry, now):
+        entry.expires_at = now + self.ttl
+        slot = int(entry.expires_at // self.resolution) % self.slots
+        if slot != entry.slot:
+            if entry.slot is not None:
+                stripe.wheel[entry.slot].discard(user_id)
+            stripe.wheel[slot].add(user_id)
+            entry.slot = slot
+
+    def get(self, user_id, field, default=None):
+        stripe = self._stripe(user_id)
+        with stripe.lock:
+            entry = self._live_entry(stripe, user_id, time.monotonic())
+            if entry is None:
+                return default
+            return entry.fields.get(field, default)
+
+    def set(self, user_id, field, value):
+        """Записва полето и удължава живота на записа."""
+        stripe = self._stripe(user_id)
+        with stripe.lock:
+            now = time.monotonic()
+            entry = self._live_entry(stripe, user_id, now)
+            if entry is None:
+                entry = stripe.entries[user_id] = ConversationEntry()
+            entry.fields[field] = value
+            self._touch(stripe, user_id, entry, now)
+
+    def pop(self, user_id, field, default=None):
+        stripe = self._stripe(user_id)
+        with stripe.lock:
+            entry = self._live_entry(stripe, user_id, time.monotonic())
+            if entry is None:
+                return default
+            value = entry.fields.pop(field, default)
+            if not entry.fields:
+                self._drop(stripe, user_id)
+            return value
+
+    def clear(self, user_id):
+        stripe = self._stripe(user_id)
+        with stripe.lock:
+            self._drop(stripe, user_id)
+
+    def tick(self):
+        """Изтрива записите от изминалите слотове на timer wheel-а."""
+        now = time.monotonic()
+        current = int(now // self.resolution)
+        # Обработваме само изцяло изминалите слотове (най-много една пълна обиколка)
+        for tick in range(max(self._last_tick, current - self.slots), current):
+            slot = tick % self.slots
+            for stripe in self._stripes:
+                with stripe.lock:
+                    for user_id in list(stripe.wheel[slot]):
+                        entry = stripe.entries.get(user_id)
+                        if entry is None or entry.expires_at <= now:
+                            self._drop(stripe, user_id)
+                            stripe.wheel[slot].discard(user_id)
+                            if entry is not None:
+                                CONVERSATIONS_EXPIRED.inc()
+        self._last_tick = current
+
+    def __len__(self):
+        return sum(len(stripe.entries) for stripe in self._stripes)
+
+class ConversationField:
+    """Речников изглед към едно поле от записите в ConversationStore (user_id -> стойност)."""
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def get(self, user_id, default=None):
+        return self.store.get(user_id, self.name, default)
+
+    def pop(self, user_id, default=None):
+        return self.store.pop(user_id, self.name, default)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __getitem__(self, user_id):
+        value = self.get(user_id)
+        if value is None:
+            raise KeyError(user_id)
+        return value
 
-        # Remove old requests
-        self.requests[user_id] = [ts for ts in self.requests[user_id] if (now - ts).total_seconds() < self.time_window]
+    def __setitem__(self, user_id, value):
+        self.store.set(user_id, self.name, value)
 
-        if len(self.requests[user_id]) >= self.max_requests:
-            return False
+    def __delitem__(self, user_id):
+        if self.pop(user_id) is None:
+            raise KeyError(user_id)
 
-        self.requests[user_id].append(now)
-        return True
+class SQLiteConversationStore(ConversationBackend):
+    """
+    Същият интерфейс като ConversationStore, но върху SQLite в WAL режим: състоянието
+    е общо за всички процеси (gunicorn worker-и) на машината и оцелява рестарт.
+    Всяко поле е отделен ред (JSON), а изтичането е по стенен часовник, за да е
+    еднакво между процесите. Изтеклите редове се трият от фонова нишка по индекса
+    на expires_at и се пренебрегват при четене.
+    """
 
-rate_limiter = RateLimiter()
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS conversation_state ("
+        " user_id TEXT NOT NULL, field TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL NOT NULL,"
+        " PRIMARY KEY (user_id, field)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS conversation_state_expires ON conversation_state (expires_at)",
+    )
+
+    def __init__(self, path, ttl=MAX_STATE_AGE_MINUTES * 60, resolution=CONVERSATION_WHEEL_RESOLUTION):
+        self.path = path
+        self.ttl = ttl
+        self.resolution = resolution
+        self._local = threading.local()
+        conn = self._conn()
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+
+    def _conn(self):
+        """Отделна връзка за всяка нишка (sqlite3 връзките не се споделят между нишки)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, user_id, field, default=None):
+        row = self._conn().execute(
+            "SELECT value FROM conversation_state WHERE user_id = ? AND field = ? AND expires_at > ?",
+            (str(user_id), field, time.time())).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set(self, user_id, field, value):
+        """Записва полето и удължава живота на целия запис на потребителя."""
+        user_id, now = str(user_id), time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # Изтеклите полета не бива да "оживеят" с удължаването
+            conn.execute("DELETE FROM conversation_state WHERE user_id = ? AND expires_at <= ?", (user_id, now))
+            conn.execute("INSERT INTO conversation_state (user_id, field, value, expires_at) VALUES (?, ?, ?, ?) "
+                         "ON CONFLICT (user_id, field) DO UPDATE SET value = excluded.value",
+                         (user_id, field, json.dumps(value, ensure_ascii=False), now + self.ttl))
+            conn.execute("UPDATE conversation_state SET expires_at = ? WHERE user_id = ?", (now + self.ttl, user_id))
+
+    def pop(self, user_id, field, default=None):
+        user_id = str(user_id)
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT value FROM conversation_state WHERE user_id = ? AND field = ? AND expires_at > ?",
+                (user_id, field, time.time())).fetchone()
+            conn.execute("DELETE FROM conversation_state WHERE user_id = ? AND field = ?", (user_id, field))
+        return default if row is None else json.loads(row[0])
+
+    def clear(self, user_id):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM conversation_state WHERE user_id = ?", (str(user_id),))
+
+    def tick(self):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM conversation_state WHERE expires_at <= ?", (time.time(),))
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(DISTINCT user_id) FROM conversation_state WHERE expires_at > ?",
+                                    (time.time(),)).fetchone()[0]
+
+class ConversationHandlerBackend(HandlerBackend):
+    """
+    Next-step handler-ите на telebot в записа на разговора (поле "next_step"). Пазят се
+    имената на функциите, така че всеки процес може да продължи разговора.
+    """
 
-# Cleanup thread reference
-cleanup_thread = None
+    def __init__(self, store, resolve):
+        super().__init__()
+        self.store = store
+        self.resolve = resolve
 
-# Функция за изчистване на стари user states (предотвратява memory leaks)
-def cleanup_old_user_data():
-    """Изчиства user data по-стари от 30 минути"""
-    global cleanup_thread
+    def register_handler(self, handler_group_id, handler):
+        steps = self.store.get(handler_group_id, "next_step") or []
+        steps.append({"callback": handler["callback"].__name__, "args": list(handler["args"]), "kwargs": handler["kwargs"]})
+        self.store.set(handler_group_id, "next_step", steps)
 
-    try:
-        current_time = datetime.now()
-        cutoff_time = current_time - timedelta(minutes=MAX_STATE_AGE_MINUTES)
-
-        # Изчистваме стари записи
-        for user_id in list(user_records.keys()):
-            if isinstance(user_records[user_id], list) and len(user_records[user_id]) > MAX_USER_RECORDS:
-                user_records[user_id] = user_records[user_id][-MAX_USER_RECORDS:]
-
-        # Изчистваме pending states по timestamps
-        for user_id in list(user_state_timestamps.keys()):
-            if user_state_timestamps[user_id] < cutoff_time:
-                user_state_timestamps.pop(user_id, None)
-                pending_transaction_data.pop(user_id, None)
-                user_pending_type.pop(user_id, None)
-                user_editing.pop(user_id, None)
+    def clear_handlers(self, handler_group_id):
+        self.store.pop(handler_group_id, "next_step")
 
-    except Exception as e:
-        print(f"❌ Грешка при cleanup: {e}")
-    finally:
-        # Повтаряме всеки 30 минути
-        cleanup_thread = threading.Timer(1800, cleanup_old_user_data)
-        cleanup_thread.daemon = True
-        cleanup_thread.start()
+    def get_handlers(self, handler_group_id):
+        steps = self.store.pop(handler_group_id, "next_step")
+        if not steps:
+            return None
+        handlers = []
+        for step in steps:
+            callback = self.resolve(step["callback"])
+            if callback is None:
+                print(f"⚠️ Непознат next-step handler: {step['callback']}")
+                continue
+            handlers.append({"callback": callback, "args": step["args"], "kwargs": step["kwargs"]})
+        return handlers
+
+# Къде се пази състоянието: "memory" (един процес) или "sqlite" (общо за процесите, оцелява рестарт)
+CONVERSATION_BACKEND = os.getenv("CONVERSATION_BACKEND", "memory")
+CONVERSATION_DB_PATH = os.getenv("CONVERSATION_DB_PATH", "conversations.db")
+SQLITE_BUSY_TIMEOUT = 5  # секунди чакане на заключена база
+
+def create_conversation_store(backend=CONVERSATION_BACKEND):
+    if backend == "memory":
+        return ConversationStore()
+    if backend == "sqlite":
+        return SQLiteConversationStore(CONVERSATION_DB_PATH)
+    raise ValueError(f"Unknown conversation backend: {backend}")
+
+conversations = create_conversation_store()
+conversations.start()
+bot.next_step_backend = ConversationHandlerBackend(conversations, lambda name: resolve_next_step(name))
+
+# Полетата на състоянието. Стойностите са копия по смисъл: след промяна се записват
+# обратно (user_editing[user_id] = state), за да удължат живота на записа.
+user_records = conversations.field("records")
+user_pending_type = conversations.field("pending_type")
+pending_transaction_data = conversations.field("pending_tx")
+user_editing = conversations.field("editing")
+
+# Rate limiting
+class RateLimiter:
+    """
+    Лимит на заявките на потребител по GCRA върху time.monotonic. За всеки потребител
+    пазим само едно число - теоретичното време на следващата заявка (TAT), така че
+    проверката е O(1). Позволява до max_requests заявки наведнъж и по една на
+    time_window / max_requests секунди след това. Записът се изтрива едва когато
+    лимитът на потребителя е напълно възстановен, т.е. активните не се "забравят".
+    """
+
+    def __init__(self, max_requests=30, time_window=60):
+        self.max_requests = max_requests
+        self.time_window = time_window
+        self.interval = time_window / max_requests
+        self.tolerance = time_window - self.interval
+        self._tat = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + time_window
+
+    def is_allowed(self, user_id):
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._next_sweep:
+                self._sweep(now)
+            tat = max(self._tat.get(user_id, now), now)
+            if tat - now > self.tolerance:
+                RATE_LIMITED.inc()
+                return False
+            self._tat[user_id] = tat + self.interval
+            return True
+
+    def _sweep(self, now):
+        """Премахва потребителите с възстановен лимит (веднъж на time_window)."""
+        self._tat = {user_id: tat for user_id, tat in self._tat.items() if tat > now}
+        self._next_sweep = now + self.time_window
+
+    def __len__(self):
+        return len(self._tat)
 
-# Стартираме cleanup thread
-cleanup_old_user_data()
+rate_limiter = RateLimiter()
 
 def normalize_text(text):
     """Привежда текста в малки букви и премахва специални символи."""
@@ -136,29 +1252,203 @@ def normalize_text(text):
     text = re.sub(r'[^a-zа-я0-9\s]', '', text)
     return text
 
-def find_account(account_name):
-    """Търси акаунт по ключови думи, независимо от големи/малки букви и тирета."""
+# Настройки на локалния каталог с акаунти
+ACCOUNTS_SYNC_INTERVAL = 60  # секунди между инкременталните синхронизации
+ACCOUNTS_MAX_STALENESS = 300  # след толкова секунди без синхронизация търсим директно в Airtable
+ACCOUNTS_FULL_RESYNC_INTERVAL = 3600  # пълно презареждане (хваща и изтритите акаунти)
+ACCOUNTS_LOOKUP_CACHE_SIZE = 1000
+
+class AccountCatalogue:
+    """
+    Локално копие на таблицата "ВСИЧКИ АКАУНТИ".
+    Зарежда цялата таблица веднъж (с пагинация по offset), след това на фонов таймер
+    дърпа само променените записи по LAST_MODIFIED_TIME(). find_account отговаря
+    локално, докато копието е по-ново от max_staleness секунди.
+    """
+
+    def __init__(self, url, sync_interval=ACCOUNTS_SYNC_INTERVAL,
+                 max_staleness=ACCOUNTS_MAX_STALENESS,
+                 full_resync_interval=ACCOUNTS_FULL_RESYNC_INTERVAL):
+        self.url = url
+        self.sync_interval = sync_interval
+        self.max_staleness = max_staleness
+        self.full_resync_interval = full_resync_interval
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._accounts = OrderedDict()  # record_id -> (REG, REG с малки букви)
+        self._lookup_cache = {}
+        self._cursor = None  # UTC ISO време на последната синхронизация за LAST_MODIFIED_TIME()
+        self._last_sync = None  # time.monotonic() на последната успешна синхронизация
+        self._last_full_sync = None
+        self._timer = None
+
+    def __len__(self):
+        return len(self._accounts)
+
+    def _fetch(self, formula=None):
+        """Изтегля всички страници от таблицата (по избор с filterByFormula)."""
+        records = []
+        params = {"pageSize": 100, "fields[]": ["REG"]}
+        if formula:
+            params["filterByFormula"] = formula
+
+        while True:
+            res = airtable.get(self.url, params=params)
+            res.raise_for_status()
+            data = res.json()
+            records.extend(data.get("records", []))
+            offset = data.get("offset")
+            if not offset:
+                return records
+            params["offset"] = offset
+
+    @staticmethod
+    def _reg(record):
+        reg = record.get("fields", {}).get("REG", "")
+        reg = str(reg) if reg else ""
+        return reg, reg.lower()
+
+    def refresh(self, full=False):
+        """Синхронизира каталога. full=True презарежда цялата таблица."""
+        with self._sync_lock:
+            now = time.monotonic()
+            if (self._cursor is None or self._last_full_sync is None or
+                    now - self._last_full_sync >= self.full_resync_interval):
+                full = True
+
+            # Вземаме курсора преди заявката, с малък толеранс за разлика в часовниците
+            cursor = (datetime.utcnow() - timedelta(seconds=5)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+            try:
+                if full:
+                    records = self._fetch()
+                    accounts = OrderedDict((r["id"], self._reg(r)) for r in records)
+                else:
+                    records = self._fetch(f"IS_AFTER(LAST_MODIFIED_TIME(), '{self._cursor}')")
+                    accounts = None
+                    if records:
+                        accounts = OrderedDict(self._accounts)
+                        for r in records:
+                            accounts[r["id"]] = self._reg(r)
+            except requests.exceptions.Timeout:
+                print("⏱️ Timeout при синхронизация на акаунтите")
+                return False
+            except requests.exceptions.RequestException as e:
+                print(f"❌ Грешка при синхронизация на акаунтите: {e}")
+                return False
+            except Exception as e:
+                print(f"❌ Неочаквана грешка при синхронизация на акаунтите: {e}")
+                return False
+
+            with self._lock:
+                if accounts is not None:
+                    self._accounts = accounts
+                    self._lookup_cache = {}
+                self._cursor = cursor
+                self._last_sync = now
+                if full:
+                    self._last_full_sync = now
+
+            if full:
+                print(f"📦 Каталогът с акаунти е зареден: {len(self._accounts)} акаунта")
+            elif records:
+                print(f"🔄 Каталогът с акаунти е обновен: {len(records)} променени")
+            return True
+
+    def is_fresh(self):
+        """Дали локалното копие е в рамките на допустимата остарялост."""
+        last_sync = self._last_sync
+        return last_sync is not None and time.monotonic() - last_sync <= self.max_staleness
+
+    def find(self, search_terms):
+        """Връща ID на първия акаунт, чийто REG съдържа всички термини, или None."""
+        key = tuple(search_terms)
+        with self._lock:
+            if key in self._lookup_cache:
+                CACHE_EVENTS.inc(cache="account_lookup", event="hit")
+                return self._lookup_cache[key]
+            accounts = self._accounts
+        CACHE_EVENTS.inc(cache="account_lookup", event="miss")
+
+        account_id = None
+        for record_id, (_, reg) in accounts.items():
+            if all(term in reg for term in key):
+                account_id = record_id
+                break
+
+        with self._lock:
+            if accounts is self._accounts:
+                if len(self._lookup_cache) >= ACCOUNTS_LOOKUP_CACHE_SIZE:
+                    CACHE_EVENTS.inc(len(self._lookup_cache), cache="account_lookup", event="eviction")
+                    self._lookup_cache.clear()
+                self._lookup_cache[key] = account_id
+        return account_id
+
+    def name(self, record_id):
+        """Връща REG на акаунта по ID или None, ако го няма в каталога."""
+        item = self._accounts.get(record_id)
+        return item[0] if item else None
+
+    def _run(self):
+        try:
+            self.refresh()
+        finally:
+            self._timer = threading.Timer(self.sync_interval, self._run)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def start(self, delay=0):
+        """Стартира периодичната синхронизация във фонов режим (първата след delay секунди)."""
+        if self._timer is not None:
+            return
+        self._timer = threading.Timer(delay, self._run)
+        self._timer.daemon = True
+        self._timer.start()
+
+account_catalogue = AccountCatalogue(url_accounts)
+
+def account_catalogue_usable():
+    """Каталогът е свеж или Airtable е недостъпен и има поне последната му снимка."""
+    return account_catalogue.is_fresh() or (len(account_catalogue) > 0 and not airtable.healthy())
+
+def account_search_terms(account_name):
+    """Разделя името на акаунт на нормализирани ключови думи (None при невалиден вход)."""
     if not account_name or not isinstance(account_name, str):
         return None
 
+    # Нормализиране на акаунта
+    normalized_account_name = normalize_text(account_name)
+    if not normalized_account_name:
+        return None
+
+    # Разделяме нормализирания акаунт на ключови думи
+    search_terms = normalized_account_name.strip().split()
+    if not search_terms or len(search_terms) > 10:  # Ограничаваме броя термини
+        return None
+    return [term[:50] for term in search_terms]
+
+def account_search_formula(search_terms):
+    """filterByFormula с AND за търсене на всички ключови думи в REG."""
+    conditions = [f'SEARCH("{term}", LOWER({{REG}})) > 0' for term in search_terms]
+    return f'AND({",".join(conditions)})'
+
+@traced
+def find_account(account_name):
+    """Търси акаунт по ключови думи, независимо от големи/малки букви и тирета."""
     try:
-        # Нормализиране на акаунта
-        normalized_account_name = normalize_text(account_name)
-        if not normalized_account_name:
+        search_terms = account_search_terms(account_name)
+        if not search_terms:
             return None
 
-        # Разделяме нормализирания акаунт на ключови думи
-        search_terms = normalized_account_name.strip().split()
-        if not search_terms or len(search_terms) > 10:  # Ограничаваме броя термини
-            return None
+        # Отговаряме локално, ако каталогът е достатъчно свеж (или Airtable е недостъпен)
+        if account_catalogue_usable():
+            return account_catalogue.find(search_terms)
+        CACHE_EVENTS.inc(cache="account_catalogue", event="miss")
 
-        # Изграждаме filterByFormula с AND за търсене на всички ключови думи
-        conditions = [f'SEARCH("{term[:50]}", LOWER({{REG}})) > 0' for term in search_terms]
-        formula = f'AND({",".join(conditions)})'
-        params = {"filterByFormula": formula}
+        params = {"filterByFormula": account_search_formula(search_terms)}
 
         # Изпращаме заявка към Airtable API
-        res = requests.get(url_accounts, headers=headers, params=params, timeout=10)
+        res = airtable.get(url_accounts, params=params)
         if res.status_code == 200:
             data = res.json()
             records = data.get("records", [])
@@ -173,47 +1463,440 @@ def find_account(account_name):
         print(f"❌ Неочаквана грешка в find_account: {e}")
     return None
 
-def get_user_records_from_airtable(user_name):
-    """Извлича записите от последните 60 минути от Airtable за конкретен потребител."""
-    if not user_name or not isinstance(user_name, str):
-        return []
+# Споделен кеш ID -> REG за показване на акаунтите в списъците
+ACCOUNT_NAME_TTL = 600
+account_name_cache = TTLCache(maxsize=2000, ttl=ACCOUNT_NAME_TTL, name="account_names")
+
+def cached_account_names(account_ids):
+    """Връща ({ID: REG} от кеша и каталога, [ID-та, които трябва да се изтеглят])."""
+    names = {}
+    missing = []
+    for account_id in dict.fromkeys(account_ids):
+        name = account_name_cache.get(account_id)
+        if name is None and account_catalogue.is_fresh():
+            name = account_catalogue.name(account_id)
+            if name is not None:
+                account_name_cache.set(account_id, name)
+        if name is None:
+            missing.append(account_id)
+        else:
+            names[account_id] = name
+    return names, missing
+
+def account_names_params(account_ids):
+    """Една заявка за всички акаунти: OR(RECORD_ID()='...', ...)."""
+    conditions = [f"RECORD_ID()='{account_id}'" for account_id in account_ids]
+    return {"filterByFormula": f"OR({','.join(conditions)})", "fields[]": ["REG"]}
+
+def store_account_names(records, names):
+    """Добавя изтеглените акаунти в names и в споделения кеш."""
+    for record in records:
+        name = str(record.get("fields", {}).get("REG", "") or "?")
+        account_name_cache.set(record["id"], name)
+        names[record["id"]] = name
+
+def get_account_names(account_ids):
+    """Връща {ID: REG} за подадените акаунти с най-много една заявка към Airtable."""
+    names, missing = cached_account_names(account_ids)
+    if not missing:
+        return names
+
+    try:
+        res = airtable.get(url_accounts, params=account_names_params(missing))
+        if res.status_code == 200:
+            store_account_names(res.json().get("records", []), names)
+        else:
+            print(f"❌ Грешка при извличане на акаунти: {res.status_code}")
+    except requests.exceptions.Timeout:
+        print(f"⏱️ Timeout при извличане на акаунти")
+    except requests.exceptions.RequestException as e:
+        print(f"❌ Error fetching accounts: {e}")
+    return names
+
+def listing_account_ids(records):
+    """ID-тата на акаунтите, които трябва да се покажат в списъка."""
+    account_ids = []
+    for record in records:
+        ids = record.get("fields", {}).get("Акаунт", [])
+        if isinstance(ids, list) and ids:
+            account_ids.append(ids[0])
+    return account_ids
+
+def format_records_listing(records):
+    """Форматира списък със записи за /edit и /delete (имената на акаунтите с една заявка)."""
+    account_ids = listing_account_ids(records)
+    account_names = get_account_names(account_ids) if account_ids else {}
+    return render_records_listing(records, account_names)
+
+def render_records_listing(records, account_names):
+    """Текстът на списъка при вече известни имена на акаунтите."""
+    lines = []
+    for i, record in enumerate(records, 1):
+        fields = record.get("fields", {})
+        description = fields.get("Описание", "Без описание")[:100]
+        amount = fields.get("Сума (лв.)", fields.get("Сума (EUR)", fields.get("Сума (GBP)", fields.get("Сума (USD)", "?"))))
+        account_name = "?"
+
+        ids = fields.get("Акаунт", [])
+        if isinstance(ids, list) and ids:
+            account_name = account_names.get(ids[0], "?")[:50]
 
+        full_text = f"{amount} {description} от {account_name}"
+        lines.append(f"{i}. {full_text[:150]}\n")
+    return "".join(lines)
+
+# Локално SQLite копие на "Отчет Телеграм" (по избор)
+REPORTS_MIRROR = os.getenv("REPORTS_MIRROR", "0") == "1"
+REPORTS_MIRROR_PATH = os.getenv("REPORTS_MIRROR_PATH", "reports_mirror.db")
+REPORTS_MIRROR_SYNC_INTERVAL = 30  # секунди между инкременталните синхронизации
+REPORTS_MIRROR_MAX_STALENESS = 300  # след толкова секунди без синхронизация четем директно от Airtable
+REPORTS_MIRROR_FULL_RESYNC_INTERVAL = 3600  # пълно презареждане (хваща и изтритите записи)
+USER_RECORDS_MAX_AGE = timedelta(minutes=60)  # колко назад показваме записите в /edit и /delete
+
+def parse_report_date(value):
+    """
+    "Дата" като Unix време. Airtable връща ISO в UTC ("...T10:00:00.000Z"), а ботът
+    записва местно време ("%Y-%m-%d %H:%M:%S"). None при липсваща или невалидна дата.
+    """
+    if not value or not isinstance(value, str):
+        return None
     try:
-        now = datetime.now()
-        one_hour_ago = now - timedelta(minutes=60)
-        now_iso = now.isoformat()
-        hour_ago_iso = one_hour_ago.isoformat()
-
-        # Escape single quotes in user_name
-        safe_user_name = user_name.replace("'", "\\'")[:100]
-
-        # Airtable filterByFormula търси по Име на потребителя и Дата (ISO формат)
-        formula = (
-            f"AND("
-            f"{{Име на потребителя}} = '{safe_user_name}',"
-            f"IS_AFTER({{Дата}}, '{hour_ago_iso}')"
-            f")"
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+class ReportsMirror:
+    """
+    Локално копие на таблицата "Отчет Телеграм" в SQLite (WAL), с индекси по
+    потребител, дата, акаунт и вид. Поддържа се от фонова инкрементална
+    синхронизация по LAST_MODIFIED_TIME() и от write-through при собствените
+    create/PATCH/DELETE заявки на бота. Курсорът е във файла, така че след рестарт
+    се дърпат само промените. Списъците за /edit и /delete се четат локално,
+    докато копието е по-ново от max_staleness секунди.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS reports ("
+        " id TEXT PRIMARY KEY, user_name TEXT, date REAL, account TEXT, type TEXT,"
+        " record TEXT NOT NULL, synced_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS reports_user_date ON reports (user_name, date)",
+        "CREATE INDEX IF NOT EXISTS reports_date ON reports (date)",
+        "CREATE INDEX IF NOT EXISTS reports_account ON reports (account)",
+        "CREATE INDEX IF NOT EXISTS reports_type ON reports (type)",
+        "CREATE TABLE IF NOT EXISTS reports_sync (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+    )
+
+    def __init__(self, path, sync_interval=REPORTS_MIRROR_SYNC_INTERVAL,
+                 max_staleness=REPORTS_MIRROR_MAX_STALENESS,
+                 full_resync_interval=REPORTS_MIRROR_FULL_RESYNC_INTERVAL):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.max_staleness = max_staleness
+        self.full_resync_interval = full_resync_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._syncing = False
+        self._deleted = set()  # изтрити по време на синхронизация - не бива да "оживеят"
+        self._last_sync = None  # time.monotonic() на последната успешна синхронизация
+        self._timer = None
+        conn = self._conn()
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+
+    def _conn(self):
+        """Отделна връзка за всяка нишка (sqlite3 връзките не се споделят между нишки)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM reports").fetchone()[0]
+
+    def _get_state(self, key):
+        row = self._conn().execute("SELECT value FROM reports_sync WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _row(record, synced_at):
+        fields = record.get("fields", {})
+        account = fields.get("Акаунт")
+        report_type = fields.get("ВИД")
+        return (
+            record["id"],
+            fields.get("Име на потребителя"),
+            parse_report_date(fields.get("Дата")),
+            account[0] if isinstance(account, list) and account else None,
+            report_type[0] if isinstance(report_type, list) and report_type else None,
+            json.dumps(record, ensure_ascii=False),
+            synced_at,
         )
 
-        params = {"filterByFormula": formula}
-        res = requests.get(url_reports, headers=headers, params=params, timeout=10)
+    def _upsert(self, conn, records, synced_at):
+        conn.executemany(
+            "INSERT INTO reports (id, user_name, date, account, type, record, synced_at) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET user_name = excluded.user_name, date = excluded.date,"
+            " account = excluded.account, type = excluded.type, record = excluded.record, synced_at = excluded.synced_at",
+            [self._row(record, synced_at) for record in records if record.get("id")])
 
-        if res.status_code == 200:
+    def upsert(self, records):
+        """Write-through: записва създадени или променени записи (отговорите на Airtable)."""
+        try:
+            with self._conn() as conn:
+                self._upsert(conn, records, time.time())
+        except sqlite3.Error as e:
+            print(f"❌ Грешка при запис в локалното копие на отчетите: {e}")
+
+    def delete(self, record_id):
+        """Write-through: премахва изтрит запис."""
+        with self._lock:
+            if self._syncing:
+                self._deleted.add(record_id)
+        try:
+            with self._conn() as conn:
+                conn.execute("DELETE FROM reports WHERE id = ?", (record_id,))
+        except sqlite3.Error as e:
+            print(f"❌ Грешка при изтриване от локалното копие на отчетите: {e}")
+
+    def _pages(self, formula=None):
+        """
+        Изтегля таблицата страница по страница (по избор с filterByFormula), само с
+        полетата, които се пазят в копието.
+        """
+        params = {"pageSize": 100, "fields[]": MIRROR_FIELDS}
+        if formula:
+            params["filterByFormula"] = formula
+
+        while True:
+            res = airtable.get(url_reports, params=params)
+            res.raise_for_status()
             data = res.json()
-            records = data.get("records", [])
-            return records[:50]  # Ограничаваме броя записи
-        else:
-            print(f"❌ Грешка при извличане на записи: {res.status_code}")
-            return []
+            yield data.get("records", [])
+            offset = data.get("offset")
+            if not offset:
+                return
+            params["offset"] = offset
+
+    def refresh(self, full=False):
+        """Синхронизира копието. full=True презарежда цялата таблица и трие изчезналите записи."""
+        with self._sync_lock:
+            cursor = self._get_state("cursor")
+            last_full_sync = float(self._get_state("last_full_sync") or 0)
+            started = time.time()
+            if cursor is None or started - last_full_sync >= self.full_resync_interval:
+                full = True
+
+            # Вземаме курсора преди заявката, с малък толеранс за разлика в часовниците
+            new_cursor = (datetime.utcnow() - timedelta(seconds=5)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+            with self._lock:
+                self._syncing = True
+                self._deleted = set()
+            synced = 0
+            try:
+                formula = None if full else f"IS_AFTER(LAST_MODIFIED_TIME(), '{cursor}')"
+                conn = self._conn()
+                # Всяка страница се записва в отделна кратка транзакция - в паметта
+                # никога няма повече от една страница и писането не чака мрежата
+                for records in self._pages(formula):
+                    with conn:
+                        conn.execute("BEGIN IMMEDIATE")
+                        with self._lock:
+                            records = [r for r in records if r.get("id") not in self._deleted]
+                        self._upsert(conn, records, time.time())
+                    synced += len(records)
+
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    if full:
+                        # Всичко, което не е дошло с пълното зареждане и не е записано
+                        # от бота по време на зареждането, е изтрито в Airtable
+                        removed = conn.execute("DELETE FROM reports WHERE synced_at < ?", (started,)).rowcount
+                        conn.execute("INSERT OR REPLACE INTO reports_sync (key, value) VALUES ('last_full_sync', ?)",
+                                     (str(started),))
+                    conn.execute("INSERT OR REPLACE INTO reports_sync (key, value) VALUES ('cursor', ?)", (new_cursor,))
+            except requests.exceptions.Timeout:
+                print("⏱️ Timeout при синхронизация на отчетите")
+                return False
+            except requests.exceptions.RequestException as e:
+                print(f"❌ Грешка при синхронизация на отчетите: {e}")
+                return False
+            except Exception as e:
+                print(f"❌ Неочаквана грешка при синхронизация на отчетите: {e}")
+                return False
+            finally:
+                with self._lock:
+                    self._syncing = False
+
+            self._last_sync = time.monotonic()
+            if full:
+                print(f"📦 Отчетите са заредени локално: {synced} записа ({removed} премахнати)")
+            elif synced:
+                print(f"🔄 Локалните отчети са обновени: {synced} променени")
+            return True
+
+    def is_fresh(self):
+        """Дали локалното копие е в рамките на допустимата остарялост."""
+        last_sync = self._last_sync
+        return last_sync is not None and time.monotonic() - last_sync <= self.max_staleness
+
+    def user_records(self, user_name, since, limit=MAX_USER_RECORDS):
+        """Записите на потребителя след since (Unix време), най-новите първи, във формата на Airtable."""
+        rows = self._conn().execute(
+            "SELECT record FROM reports WHERE user_name = ? AND date > ? ORDER BY date DESC LIMIT ?",
+            (user_name, since, limit)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _run(self):
+        try:
+            self.refresh()
+        finally:
+            self._timer = threading.Timer(self.sync_interval, self._run)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def start(self):
+        """Стартира първоначалната синхронизация и периодичното обновяване във фонов режим."""
+        if self._timer is not None:
+            return
+        self._timer = threading.Timer(0, self._run)
+        self._timer.daemon = True
+        self._timer.start()
+
+# Полетата, които се пазят в локалното копие: индексираните колони и полетата за
+# списъците на /edit и /delete (LISTING_FIELDS)
+MIRROR_FIELDS = ["Име на потребителя", "Дата", "ВИД", "Акаунт", "Описание",
+                 "Сума (лв.)", "Сума (EUR)", "Сума (GBP)", "Сума (USD)"]
+
+reports_mirror = None
+if REPORTS_MIRROR:
+    reports_mirror = ReportsMirror(REPORTS_MIRROR_PATH)
+
+def reports_mirror_usable():
+    """Локалното копие е актуално или Airtable е недостъпен (тогава и остаряло е по-добре от нищо)."""
+    return reports_mirror is not None and (reports_mirror.is_fresh() or not airtable.healthy())
+
+def mirror_reports(records):
+    """Write-through на създадени или променени отчети към локалното копие (ако е включено)."""
+    if reports_mirror is not None and records:
+        reports_mirror.upsert(records)
+
+def mirror_report_deleted(record_id):
+    if reports_mirror is not None:
+        reports_mirror.delete(record_id)
+
+def user_records_formula(user_name):
+    """filterByFormula за записите на потребителя от последните 60 минути."""
+    one_hour_ago = datetime.now() - USER_RECORDS_MAX_AGE
+    hour_ago_iso = one_hour_ago.isoformat()
+
+    # Escape single quotes in user_name
+    safe_user_name = user_name.replace("'", "\\'")[:100]
+
+    # Airtable filterByFormula търси по Име на потребителя и Дата (ISO формат)
+    return (
+        f"AND("
+        f"{{Име на потребителя}} = '{safe_user_name}',"
+        f"IS_AFTER({{Дата}}, '{hour_ago_iso}')"
+        f")"
+    )
+
+# Полетата, които показваме в списъците за /edit и /delete
+LISTING_FIELDS = ["Описание", "Сума (лв.)", "Сума (EUR)", "Сума (GBP)", "Сума (USD)", "Акаунт"]
+
+def user_records_params(user_name, page_size=MAX_USER_RECORDS):
+    """Параметри за записите на потребителя: само нужните полета, най-новите първи."""
+    return {
+        "filterByFormula": user_records_formula(user_name),
+        "fields[]": LISTING_FIELDS,
+        "sort[0][field]": "Дата",
+        "sort[0][direction]": "desc",
+        "pageSize": max(1, min(page_size, 100)),
+    }
+
+@traced
+def get_user_records_from_airtable(user_name, page_size=MAX_USER_RECORDS):
+    """
+    Генератор на записите от последните 60 минути за конкретен потребител, най-новите
+    първи. Следващата страница се изтегля само ако извикващият поиска още записи.
+    При включено и актуално локално копие (reports_mirror) Airtable не се пита.
+    """
+    if not user_name or not isinstance(user_name, str):
+        return
+
+    if reports_mirror is not None:
+        if reports_mirror_usable():
+            CACHE_EVENTS.inc(cache="reports_mirror", event="hit")
+            since = (datetime.now() - USER_RECORDS_MAX_AGE).timestamp()
+            yield from reports_mirror.user_records(user_name, since)
+            return
+        CACHE_EVENTS.inc(cache="reports_mirror", event="miss")
+
+    params = user_records_params(user_name, page_size)
+    try:
+        while True:
+            res = airtable.get(url_reports, params=params)
+            if res.status_code != 200:
+                print(f"❌ Грешка при извличане на записи: {res.status_code}")
+                return
+
+            data = res.json()
+            yield from data.get("records", [])
+
+            offset = data.get("offset")
+            if not offset:
+                return
+            params["offset"] = offset
     except requests.exceptions.Timeout:
         print(f"⏱️ Timeout при извличане на записи за: {user_name}")
-        return []
     except requests.exceptions.RequestException as e:
         print(f"❌ Грешка при връзка с Airtable: {e}")
-        return []
     except Exception as e:
         print(f"❌ Неочаквана грешка в get_user_records_from_airtable: {e}")
-        return []
+
+# Граматика на съобщенията "<сума> <валута> за <описание> от <акаунт>"
+MAX_TRANSACTION_LENGTH = 500  # символа на транзакция (ред)
+MAX_BATCH_TRANSACTIONS = 30  # транзакции в едно съобщение
+
+CURRENCY_ALIASES = {}
+for _code, _aliases in {
+    "BGN": ("лв", "lv", "лев", "лева", "bgn"),
+    "EUR": ("eur", "€", "евро", "evro"),
+    "GBP": ("gbp", "£", "паунд", "паунда", "paunda"),
+    "USD": ("usd", "$", "долар", "долара", "долари", "дол", "щ", "щатски", "щатски долари", "щатски долара",
+            "долар сащ", "долара сащ", "американски долар", "американски долари"),
+}.items():
+    for _alias in _aliases:
+        CURRENCY_ALIASES[_alias] = _code
+
+# Ключовите думи се разпознават само като отделни думи (на кирилица или латиница), изписани
+# с малки или само с главни букви: "Ot bank" и "From Point" са имена, а не "от"/"from"
+TRANSACTION_KEYWORD_RE = re.compile(r'(?<!\S)(за|za|for|от|ot|from)(?!\S)', re.IGNORECASE)
+DESCRIPTION_KEYWORDS = frozenset(("за", "za", "for"))
+# Сумата е цялото число в началото (и "1e5" като float()); "1.2.3" или "1e5.5" не са сума
+AMOUNT_CURRENCY_RE = re.compile(r'([-+]?\d+(?:[.,]\d+)?(?:[eE][-+]?\d+)?)(?![\d.,]|[eE][-+]?\d)\s*(.*)', re.DOTALL)
+EXPENSE_RE = re.compile(r'\b(?:razhod|plateno)\b', re.IGNORECASE)
+
+def parse_currency(currency_str):
+    """Код на валутата ("BGN", "EUR", ...) по изписването ѝ или None."""
+    cs = " ".join(currency_str.lower().split()).rstrip(".")
+    if not cs:
+        return None
+    code = CURRENCY_ALIASES.get(cs)
+    if code is None:
+        code = CURRENCY_ALIASES.get(cs.split(" ", 1)[0].rstrip("."))
+    return code
+
+def parse_amount_currency(segment):
+    """(сума, код на валутата) от "<сума> <валута>"; None за това, което не е разпознато."""
+    m = AMOUNT_CURRENCY_RE.match(segment.strip())
+    if not m or m.group(2)[:1].isdigit():
+        return None, None  # "1 000 лв": сумата е разпозната само отчасти
+    return float(m.group(1).replace(",", ".")), parse_currency(m.group(2))
 
 def parse_transaction(text):
     """
@@ -227,78 +1910,43 @@ def parse_transaction(text):
     text = text.strip()
 
     # Ограничаваме дължината на input
-    if len(text) > 500:
+    if len(text) > MAX_TRANSACTION_LENGTH:
         return None, None, "", None, False
 
-    # Разпознаване на латиница и кирилица за "за" и "от"
-    text = text.replace('za', 'за').replace('ot', 'от')
-
-    amount = None
-    currency_code = None
     description = ""
     account_name = None
-    is_expense = False  # Флаг, който показва дали е разход
-
-    # Отделяне на сегмента с акаунта (ако има "от ..." или "from ...")
-    pre_acc = text
-    if re.search(r'(?i)\bот\b', text):
-        parts = text.rsplit(" от ", 1)
-        pre_acc = parts[0].strip()
-        account_name = parts[1].strip() if len(parts) > 1 else ""
-    elif re.search(r'(?i)\bfrom\b', text):
-        parts = text.rsplit(" from ", 1)
-        pre_acc = parts[0].strip()
-        account_name = parts[1].strip() if len(parts) > 1 else ""
-
-    # Отделяне на описанието (ако има "за ..." или "for ...")
-    amount_currency_segment = pre_acc
-    if re.search(r'(?i)\bза\b', pre_acc):
-        parts = pre_acc.split(" за ", 1)  # разделя само при първото срещане на "за"
-        amount_currency_segment = parts[0].strip()
-        description = parts[1].strip() if len(parts) > 1 else ""
-    elif re.search(r'(?i)\bfor\b', pre_acc):
-        parts = pre_acc.split(" for ", 1)
-        amount_currency_segment = parts[0].strip()
-        description = parts[1].strip() if len(parts) > 1 else ""
 
-    # Определяне на разход или приход
-    if re.search(r'(?i)\brazhod\b', description) or re.search(r'(?i)\bplateno\b', description):
-        is_expense = True
-    elif re.search(r'(?i)\bprihod\b', description) or re.search(r'(?i)\bpostuplenie\b', description):
-        is_expense = False
+    # Едно минаване: първото "за"/"for" започва описанието, последното "от"/"from" - акаунта.
+    # Поредица ключови думи ("from ot bank", "от OT BANK") се дели при първата от тях -
+    # следващите са част от името на акаунта.
+    desc_match = None
+    acc_match = None
+    last_acc = None
+    for m in TRANSACTION_KEYWORD_RE.finditer(text):
+        word = m.group(1)
+        if not (word.islower() or word.isupper()):
+            continue
+        if word.lower() in DESCRIPTION_KEYWORDS:
+            if desc_match is None:
+                desc_match = m
+            continue
+        if last_acc is None or text[last_acc.end():m.start()].strip():
+            acc_match = m
+        last_acc = m
+
+    end = len(text)
+    if acc_match is not None:
+        account_name = text[acc_match.end():].strip()
+        end = acc_match.start()
+    if desc_match is not None and desc_match.start() < end:
+        description = text[desc_match.end():end].strip()
+        end = desc_match.start()
 
     # Извличане на сумата и валутата от първия сегмент (напр. "100 лв." или "250 EUR")
-    amount_str = ""
-    currency_str = ""
-    parts = amount_currency_segment.replace(",", ".").split()
-    if len(parts) >= 2:
-        amount_str = parts[0]
-        currency_str = parts[1]
-    else:
-        m = re.match(r'^(\d+(?:\.\d+)?)(\D+)$', amount_currency_segment.replace(",", "."))
-        if m:
-            amount_str = m.group(1)
-            currency_str = m.group(2)
-
-    amount_str = amount_str.strip()
-    currency_str = currency_str.strip().rstrip(".")
-    if currency_str:
-        cs = currency_str.lower()
-        # Разпознаване на валути с латиница и кирилица
-        if cs in ("лв", "lv", "лев", "лева", "bgn"):
-            currency_code = "BGN"
-        elif cs in ("eur", "€", "евро", "evro"):
-            currency_code = "EUR"
-        elif cs in ("gbp", "£", "паунд", "паунда", "paunda"):
-            currency_code = "GBP"
-        elif cs in ("usd", "$", "долар", "долара", "долари", "дол", "щ", "щатски", "щатски долари", "щатски долара", "долар сащ", "долара сащ", "американски долар", "американски долари"):
-            currency_code = "USD"
-
-    if amount_str:
-        try:
-            amount = float(amount_str)
-        except ValueError:
-            amount = None
+    amount, currency_code = parse_amount_currency(text[:end])
+
+    # Определяне на разход или приход
+    is_expense = bool(EXPENSE_RE.search(description))
 
     # Ако е разход, поставяме знак минус пред сумата
     if is_expense and amount is not None:
@@ -306,59 +1954,239 @@ def parse_transaction(text):
 
     return amount, currency_code, description, account_name, is_expense
 
+def parse_transactions(text):
+    """
+    Парсва съобщение с по една транзакция на ред (празните редове се пропускат).
+    Връща списък от (номер на ред, ред, резултат от parse_transaction).
+    """
+    if not text or not isinstance(text, str):
+        return []
+    return [(line_no, line.strip(), parse_transaction(line))
+            for line_no, line in enumerate(text.splitlines(), 1) if line.strip()]
+
+def is_valid_transaction(parsed):
+    amount, currency_code, description, _, _ = parsed
+    return amount is not None and currency_code is not None and description != ""
+
 def clean_string(s):
     """Премахва препинателни знаци и прави всичко малки букви."""
     return re.sub(r'[^\w\s]', '', s).lower()
-# Cache for transaction types with TTL
-transaction_types_cache = {"data": None, "timestamp": None, "ttl": 300}  # 5 minutes TTL (намален от 1 час)
+# Кеш на типовете транзакции ("ВИД ТРАНЗАКЦИЯ")
+TRANSACTION_TYPES_TTL = 300  # 5 минути, след това се обновява във фонов режим
 
-def clear_transaction_types_cache():
-    """Изчиства кеша на типовете транзакции."""
-    global transaction_types_cache
-    transaction_types_cache["data"] = None
-    transaction_types_cache["timestamp"] = None
-    # Clear lru_cache too
-    get_transaction_types.cache_clear()
-    print("🔄 Кешът на типовете транзакции е изчистен")
-
-@functools.lru_cache(maxsize=1)
-def get_transaction_types():
-    """Извлича типовете транзакции с кеширане."""
-    url_types = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/ВИД%20ТРАНЗАКЦИЯ"
-
-    types_dict = {}
+# Настройки на търсенето по типове транзакции
+SEARCH_MIN_COVERAGE = 0.6  # дял от биграмите на заявката, които трябва да се срещат в името
+SEARCH_MAX_PREFIX = 20
 
+def search_form(text):
+    """Форма за търсене: малки букви, кирилицата транслитерирана на латиница."""
+    text = text.lower()
     try:
-        # Check cache first
-        now = datetime.now()
-        if (transaction_types_cache["data"] is not None and
-            transaction_types_cache["timestamp"] is not None and
-            (now - transaction_types_cache["timestamp"]).total_seconds() < transaction_types_cache["ttl"]):
-            return transaction_types_cache["data"]
+        text = translit(text, "bg", reversed=True)
+    except Exception:
+        pass
+    return re.sub(r"[^a-z0-9]+", " ", text).strip()
 
-        res = requests.get(url_types, headers=headers, timeout=10)
+def _bigrams(form):
+    padded = f" {form} "
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
 
-        if res.status_code == 200:
-            data = res.json()
-            for record in data.get("records", []):
-                name = record["fields"].get("ТРАНЗАКЦИЯ")
-                if name:
-                    types_dict[name] = record["id"]
-
-            # Update cache
-            transaction_types_cache["data"] = types_dict
-            transaction_types_cache["timestamp"] = now
-            print(f"📦 Кешът е обновен с {len(types_dict)} типа транзакции")
+class TransactionTypeIndex:
+    """
+    Индекс за търсене по имената на типовете. Всички имена и заявки се сравняват в
+    латинска транслитерация, така че "hrana" намира "Храна". Има postings по префикс на
+    всяка дума и по биграми - биграмите дават толерантност към правописни грешки.
+    """
+
+    def __init__(self, sorted_keys):
+        self.keys = sorted_keys
+        self.forms = [search_form(key) for key in sorted_keys]
+        self.prefixes = defaultdict(set)  # префикс на дума -> {индекс}
+        self.bigrams = defaultdict(set)  # биграма -> {индекс}
+        for i, form in enumerate(self.forms):
+            for word in form.split():
+                for n in range(1, min(len(word), SEARCH_MAX_PREFIX) + 1):
+                    self.prefixes[word[:n]].add(i)
+            for gram in _bigrams(form):
+                self.bigrams[gram].add(i)
+
+    def _prefix_matches(self, words):
+        """Индексите, в които всяка дума от заявката е начало на дума от името."""
+        result = None
+        for word in words:
+            postings = self.prefixes.get(word[:SEARCH_MAX_PREFIX], set())
+            result = set(postings) if result is None else result & postings
+            if not result:
+                return set()
+        return result or set()
+
+    def search(self, query):
+        """Имената, които съвпадат със заявката, подредени по релевантност."""
+        form = search_form(query)
+        if not form:
+            return []
+
+        prefix_hits = self._prefix_matches(form.split())
+
+        # Покритие: колко от биграмите на заявката се срещат в името
+        coverage = {}
+        if len(form) > 1:
+            query_grams = _bigrams(form)
+            counts = Counter(itertools.chain.from_iterable(self.bigrams.get(gram, ()) for gram in query_grams))
+            total = len(query_grams)
+            needed = SEARCH_MIN_COVERAGE * total
+            coverage = {i: count / total for i, count in counts.items() if count >= needed}
+
+        scored = []
+        for i in prefix_hits | coverage.keys():
+            score = coverage.get(i, 0)
+            if form in self.forms[i]:
+                score += 2  # точно съвпадение на подниз
+            if i in prefix_hits:
+                score += 1  # всяка дума е начало на дума от името
+            scored.append((-score, self.keys[i]))
+        scored.sort()
+        return [key for _, key in scored]
+
+class TransactionTypesSnapshot:
+    """Снимка на типовете транзакции с предварително изчислени изгледи и индекс за търсене."""
+
+    def __init__(self, types_dict, version):
+        self.types = types_dict
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.sorted_keys = sorted(types_dict)
+        self.index = TransactionTypeIndex(self.sorted_keys)
+
+    def filter(self, keyword):
+        """Типовете, съвпадащи с keyword, подредени по релевантност."""
+        return {key: self.types[key] for key in self.index.search(keyword)}
+
+EMPTY_TRANSACTION_TYPES = TransactionTypesSnapshot({}, 0)
+
+class TransactionTypesCache:
+    """
+    Stale-while-revalidate кеш: връща текущата снимка веднага, а след изтичане на
+    TTL я обновява във фонова нишка. Неуспешни или празни зареждания не се кешират.
+    Само първото зареждане (когато още няма снимка) блокира извикващия.
+    """
+
+    def __init__(self, loader, ttl=TRANSACTION_TYPES_TTL):
+        self.loader = loader  # връща {име: record_id} или None при грешка
+        self.ttl = ttl
+        self.listeners = []  # извикват се с новата снимка след всяко обновяване
+        self.snapshot = None
+        self._version = 0
+        self._load_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._refreshing = False
+
+    def is_stale(self):
+        snapshot = self.snapshot
+        return snapshot is None or time.monotonic() - snapshot.loaded_at >= self.ttl
+
+    def store(self, types_dict):
+        """Публикува нова снимка. Празен резултат не замества текущата."""
+        if not types_dict:
+            return False
+        with self._state_lock:
+            self._version += 1
+            self.snapshot = TransactionTypesSnapshot(types_dict, self._version)
+        print(f"📦 Кешът е обновен с {len(types_dict)} типа транзакции")
+        for listener in self.listeners:
+            listener(self.snapshot)
+        return True
+
+    def begin_refresh(self):
+        """Запазва правото за фоново обновяване (само едно наведнъж)."""
+        with self._state_lock:
+            if self._refreshing:
+                return False
+            self._refreshing = True
+            return True
+
+    def end_refresh(self):
+        with self._state_lock:
+            self._refreshing = False
+
+    def refresh(self):
+        """Синхронно презареждане. Връща True при успех."""
+        with self._load_lock:
+            return self.store(self.loader())
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        finally:
+            self.end_refresh()
+
+    def get(self):
+        """Текущата снимка (EMPTY_TRANSACTION_TYPES, ако още не е заредена)."""
+        snapshot = self.snapshot
+        if snapshot is None:
+            CACHE_EVENTS.inc(cache="transaction_types", event="miss")
+            with self._load_lock:
+                if self.snapshot is None:
+                    self.store(self.loader())
+            return self.snapshot or EMPTY_TRANSACTION_TYPES
+
+        if self.is_stale():
+            # Stale-while-revalidate: връщаме старата снимка и обновяваме във фонов режим
+            CACHE_EVENTS.inc(cache="transaction_types", event="stale")
+            # Докато Airtable е недостъпен, просто връщаме последната снимка
+            if airtable.available() and self.begin_refresh():
+                threading.Thread(target=self._background_refresh, name="types-refresh", daemon=True).start()
         else:
-            print(f"⚠️ Неуспешна заявка към Airtable: {res.status_code}")
+            CACHE_EVENTS.inc(cache="transaction_types", event="hit")
+        return snapshot
+
+def parse_transaction_types(records):
+    """{ТРАНЗАКЦИЯ: record_id} от записите на таблицата 'ВИД ТРАНЗАКЦИЯ'."""
+    types_dict = {}
+    for record in records:
+        name = record["fields"].get("ТРАНЗАКЦИЯ")
+        if name:
+            types_dict[name] = record["id"]
+    return types_dict
+
+def load_transaction_types():
+    """Изтегля всички типове транзакции (всички страници). Връща None при грешка."""
+    url_types = airtable.table_url(TABLE_TRANSACTION_TYPES)
+    params = {"fields[]": ["ТРАНЗАКЦИЯ"], "pageSize": 100}
+    records = []
+
+    try:
+        while True:
+            res = airtable.get(url_types, params=params)
+            if res.status_code != 200:
+                print(f"⚠️ Неуспешна заявка към Airtable: {res.status_code}")
+                return None
+            data = res.json()
+            records.extend(data.get("records", []))
+            if not data.get("offset"):
+                return parse_transaction_types(records)
+            params["offset"] = data["offset"]
     except requests.exceptions.Timeout:
         print(f"⏱️ Timeout при зареждане на типове транзакции")
     except requests.exceptions.RequestException as e:
         print(f"❌ Грешка при зареждане на типове транзакции: {e}")
     except Exception as e:
-        print(f"❌ Неочаквана грешка в get_transaction_types: {e}")
+        print(f"❌ Неочаквана грешка в load_transaction_types: {e}")
+    return None
 
-    return types_dict
+transaction_types_cache = TransactionTypesCache(load_transaction_types)
+
+def clear_transaction_types_cache():
+    """Презарежда кеша на типовете транзакции (старата снимка остава при грешка)."""
+    transaction_types_cache.refresh()
+    print("🔄 Кешът на типовете транзакции е презареден")
+
+def get_transaction_types_snapshot():
+    return transaction_types_cache.get()
+
+def get_transaction_types():
+    """Извлича типовете транзакции с кеширане."""
+    return transaction_types_cache.get().types
 
 def get_transaction_type_options():
     """Извлича всички видове транзакции от таблицата 'ВИД ТРАНЗАКЦИЯ' - използва кеширането."""
@@ -368,23 +2196,24 @@ def handle_filter_input(message):
     keyword = message.text.strip().lower()
     user_id = message.chat.id
 
-    all_types = get_transaction_types()
-    filtered = {k: v for k, v in all_types.items() if keyword in k.lower()}
+    filtered = get_transaction_types_snapshot().filter(keyword)
 
     if not filtered:
         markup = types.InlineKeyboardMarkup()
         markup.add(types.InlineKeyboardButton("🔍 Опитай нова дума", callback_data="__filter"))
         markup.add(types.InlineKeyboardButton("📜 Покажи всички", callback_data="__reset"))
 
-        bot.send_message(user_id, "❌ Няма резултати за тази дума. Опитай отново:", reply_markup=markup)
+        send_message_nowait(user_id, "❌ Няма резултати за тази дума. Опитай отново:", reply_markup=markup)
         return
 
-    send_transaction_type_page(chat_id=user_id, page=0, filtered_types=filtered)
+    send_transaction_type_page(chat_id=user_id, page=0, filtered_types=filtered, filter_key=search_form(keyword))
+
+TYPE_PAGE_SIZE = 20
+TYPE_PAGE_CACHE_SIZE = 500
 
-def send_transaction_type_page(chat_id, page=0, filtered_types=None):
-    PAGE_SIZE = 20
-    all_types = filtered_types if filtered_types is not None else get_transaction_types()
-    sorted_keys = sorted(all_types.keys())
+def build_transaction_type_markup(sorted_keys, page=0):
+    """Клавиатурата за избор на ВИД за дадена страница (ключовете вече са подредени)."""
+    PAGE_SIZE = TYPE_PAGE_SIZE
     start = page * PAGE_SIZE
     end = start + PAGE_SIZE
     current_page_keys = sorted_keys[start:end]
@@ -411,19 +2240,84 @@ def send_transaction_type_page(chat_id, page=0, filtered_types=None):
         
     # 🔍 Филтър бутон със стил
     markup.add(types.InlineKeyboardButton("🔍 Въведи ключова дума 🔍", callback_data="__filter"))
+    return markup
 
-    # 📬 Изпращане на съобщението
-    msg = bot.send_message(chat_id, "📌 Моля, изберете ВИД на транзакцията:", reply_markup=markup)
+# Готови клавиатури по (версия на типовете, ключ на филтъра, страница)
+type_page_markup_cache = TTLCache(maxsize=TYPE_PAGE_CACHE_SIZE, ttl=24 * 3600, name="type_pages")
+transaction_types_cache.listeners.append(lambda snapshot: type_page_markup_cache.clear())
 
-    # 💾 Запазваме състоянието
-    user_pending_type[chat_id] = {
-        "msg_id": msg.message_id,
-        "options": all_types,
+def transaction_type_page(snapshot, page, filtered_types=None, filter_key=None, version=None):
+    """
+    (версия, типове, клавиатура) за страница. Без филтър се използва текущата снимка;
+    филтрираните типове идват от snapshot.filter() и вече са подредени по релевантност,
+    а version е версията на снимката, от която са филтрирани.
+    """
+    if filtered_types is None:
+        version, options, filter_key = snapshot.version, snapshot.types, None
+    else:
+        options = filtered_types
+        if version is None:
+            version = snapshot.version
+
+    cache_key = (version, filter_key, page)
+    markup = type_page_markup_cache.get(cache_key)
+    if markup is None:
+        sorted_keys = snapshot.sorted_keys if filtered_types is None else list(filtered_types)
+        markup = build_transaction_type_markup(sorted_keys, page)
+        type_page_markup_cache.set(cache_key, markup)
+    return version, options, markup
+
+def pending_type_state(msg_id, page, filtered_types, filter_key, version):
+    """Състоянието на потребителя докато избира ВИД (без филтър опциите са текущата снимка)."""
+    return {
+        "msg_id": msg_id,
         "page": page,
         "filtered": filtered_types,
+        "filter_key": filter_key,
+        "version": version,
         "selected": None
     }
 
+def send_transaction_type_page(chat_id, page=0, filtered_types=None, filter_key=None):
+    version, _, markup = transaction_type_page(
+        get_transaction_types_snapshot(), page, filtered_types, filter_key
+    )
+
+    # 📬 Изпращане на съобщението
+    msg = bot.send_message(chat_id, "📌 Моля, изберете ВИД на транзакцията:", reply_markup=markup)
+
+    # 💾 Запазваме състоянието
+    user_pending_type[chat_id] = pending_type_state(msg.message_id, page, filtered_types, filter_key, version)
+
+def pending_type_options(state, snapshot):
+    """Типовете, от които потребителят избира: филтрираните или всички от снимката."""
+    if state.get("filtered") is not None:
+        return state["filtered"]
+    return snapshot.types
+
+def turn_transaction_type_page(chat_id, page):
+    """Сменя страницата на вече изпратеното съобщение с един edit_message_reply_markup."""
+    state = user_pending_type[chat_id]
+    snapshot = get_transaction_types_snapshot()
+    last_page = max(0, (len(pending_type_options(state, snapshot)) - 1) // TYPE_PAGE_SIZE)
+    page = min(max(page, 0), last_page)
+    if page == state.get("page", 0):
+        return  # стар бутон - страницата не се променя
+    version, _, markup = transaction_type_page(
+        snapshot, page,
+        state.get("filtered"), state.get("filter_key"), state.get("version")
+    )
+    try:
+        bot.edit_message_reply_markup(chat_id, state["msg_id"], reply_markup=markup)
+    except Exception as e:
+        print(f"⚠️ Cannot edit keyboard: {e}")
+        send_transaction_type_page(chat_id, page, state.get("filtered"), state.get("filter_key"))
+        return
+
+    state["page"] = page
+    state["version"] = version
+    user_pending_type[chat_id] = state
+
 @bot.message_handler(commands=['settype'])
 def ask_transaction_type(message):
     send_transaction_type_page(chat_id=message.chat.id, page=0)
@@ -435,17 +2329,391 @@ def refresh_transaction_types(message):
 
     # Rate limiting
     if not rate_limiter.is_allowed(user_id):
-        bot.reply_to(message, "⏸️ Твърде много заявки. Моля, изчакайте малко.")
+        reply_to_nowait(message, "⏸️ Твърде много заявки. Моля, изчакайте малко.")
         return
 
     try:
         clear_transaction_types_cache()
         # Force reload
         types = get_transaction_types()
-        bot.reply_to(message, f"✅ Кешът е обновен! Намерени са {len(types)} типа транзакции.")
+        account_catalogue.refresh(full=True)
+        reply_to_nowait(message, f"✅ Кешът е обновен! Намерени са {len(types)} типа транзакции и {len(account_catalogue)} акаунта.")
     except Exception as e:
         print(f"❌ Error in refresh_transaction_types: {e}")
-        bot.reply_to(message, "❌ Грешка при обновяване на типовете транзакции.")
+        reply_to_nowait(message, "❌ Грешка при обновяване на типовете транзакции.")
+
+# Поле за сумата според валутата
+CURRENCY_AMOUNT_FIELDS = {
+    "BGN": "Сума (лв.)",
+    "EUR": "Сума (EUR)",
+    "GBP": "Сума (GBP)",
+    "USD": "Сума (USD)",
+}
+
+def build_report_fields(tx, selected_id, account_id):
+    """Подготвя полетата за запис в "Отчет Телеграм" от парсната транзакция."""
+    fields = {
+        "Дата": tx.get("datetime", datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+        "Описание": tx.get("description", "")[:500],
+        "Име на потребителя": tx.get("user_name", "")[:100],
+        "ВИД": [selected_id],
+    }
+
+    amount_field = CURRENCY_AMOUNT_FIELDS.get(tx.get("currency_code"))
+    if amount_field:
+        fields[amount_field] = tx.get("amount")
+
+    if account_id:
+        fields["Акаунт"] = [account_id]
+    else:
+        acc_name = tx.get("account_name", "")[:100]
+        fields["Описание"] = f"{fields['Описание']} (Акаунт: {acc_name})"
+    return fields
+
+REPORTS_BATCH_SIZE = 10  # максимумът на Airtable за една create заявка
+
+def remember_user_record(user_id, record_id):
+    """Добавя ID на нов запис към последните записи на потребителя."""
+    records = user_records.get(user_id)
+    if not isinstance(records, list):
+        records = []
+    records.append(record_id)
+    user_records[user_id] = records[-MAX_USER_RECORDS:]
+
+def forget_user_record(user_id, record_id):
+    """Премахва изтрит запис от последните записи на потребителя (записва обратно в store-а)."""
+    records = user_records.get(user_id)
+    if isinstance(records, list):
+        user_records[user_id] = [r for r in records if r != record_id]
+
+def pending_transactions(tx):
+    """Транзакциите, които чакат избор на ВИД (едно съобщение може да съдържа няколко)."""
+    return tx.get("batch") or [tx]
+
+# Текстово поле в "Отчет Телеграм" за ключа на идемпотентност (празно = без ключ).
+# Без него повторен опит или replay на журнала/outbox-а след timeout може да дублира отчет.
+REPORTS_IDEMPOTENCY_FIELD = os.getenv("REPORTS_IDEMPOTENCY_FIELD", "")
+
+# Грешки на Airtable от схемата на таблицата или правата: засягат всяка заявка, а не
+# конкретен отчет, и се оправят в базата, а не в данните
+AIRTABLE_SCHEMA_ERRORS = {
+    "UNKNOWN_FIELD_NAME", "NOT_FOUND", "TABLE_NOT_FOUND", "MODEL_ID_NOT_FOUND",
+    "INVALID_PERMISSIONS", "INVALID_PERMISSIONS_OR_MODEL_NOT_FOUND", "AUTHENTICATION_REQUIRED",
+}
+
+def airtable_error(res):
+    """(тип, съобщение) от грешката в отговора на Airtable или (None, None)."""
+    try:
+        error = res.json().get("error")
+    except (ValueError, AttributeError):
+        return None, None
+    if isinstance(error, dict):
+        return error.get("type"), error.get("message")
+    return error, None  # напр. {"error": "NOT_FOUND"}
+
+def is_unknown_idempotency_field(res):
+    """Airtable не познава полето за ключа (422 UNKNOWN_FIELD_NAME за него)."""
+    if not REPORTS_IDEMPOTENCY_FIELD or res.status_code != 422:
+        return False
+    error_type, message = airtable_error(res)
+    return error_type == "UNKNOWN_FIELD_NAME" and REPORTS_IDEMPOTENCY_FIELD in (message or "")
+
+def disable_reports_idempotency():
+    """Полето за ключа липсва в таблицата: отчетите се записват с обикновен POST."""
+    global REPORTS_IDEMPOTENCY_FIELD
+    if REPORTS_IDEMPOTENCY_FIELD:
+        print(f"🚨 Полето „{REPORTS_IDEMPOTENCY_FIELD}“ (REPORTS_IDEMPOTENCY_FIELD) липсва в \"Отчет Телеграм\" - "
+              f"отчетите се записват без ключ, повторните опити могат да ги дублират")
+        REPORTS_IDEMPOTENCY_FIELD = ""
+
+def check_reports_idempotency_field():
+    """При старта: полето за ключа съществува ли (иначе всеки upsert би върнал 422)."""
+    if not REPORTS_IDEMPOTENCY_FIELD:
+        if REPORTS_WRITE_BEHIND:
+            print("⚠️ Write-behind без REPORTS_IDEMPOTENCY_FIELD: повторните опити могат да дублират отчети")
+        return
+    try:
+        res = airtable.get(url_reports, params={"fields[]": [REPORTS_IDEMPOTENCY_FIELD], "maxRecords": 1})
+    except requests.exceptions.RequestException as e:
+        print(f"⚠️ Полето за ключа на отчетите не е проверено: {e}")
+        return
+    if is_unknown_idempotency_field(res):
+        disable_reports_idempotency()
+
+def assign_report_keys(pending, chat_id, message_id):
+    """Ключ на всяка чакаща транзакция от съобщението, от което е дошла."""
+    for index, tx in enumerate(pending_transactions(pending)):
+        tx["key"] = f"tg:{chat_id}:{message_id}:{index}"
+
+def report_keys(txs):
+    return [tx.get("key") or uuid.uuid4().hex for tx in txs]
+
+def reports_create_request(items):
+    """
+    (метод, тяло) на create заявка за партида [(полета, ключ)]. С REPORTS_IDEMPOTENCY_FIELD
+    това е upsert по ключа (PATCH с performUpsert): повторен опит, replay на журнала или
+    повторен импорт обновява вече създадения запис, вместо да добави дубликат, и
+    AirtableClient може да повтаря заявката и след timeout.
+    """
+    if not REPORTS_IDEMPOTENCY_FIELD:
+        return "POST", {"records": [{"fields": fields} for fields, _ in items]}
+    return "PATCH", {
+        "performUpsert": {"fieldsToMergeOn": [REPORTS_IDEMPOTENCY_FIELD]},
+        "records": [{"fields": {**fields, REPORTS_IDEMPOTENCY_FIELD: key}} for fields, key in items],
+    }
+
+def post_reports(items):
+    method, payload = reports_create_request(items)
+    res = airtable.request(method, url_reports, json=payload)
+    if is_unknown_idempotency_field(res):
+        # Полето е изтрито или преименувано след старта - записваме без ключ
+        disable_reports_idempotency()
+        method, payload = reports_create_request(items)
+        res = airtable.request(method, url_reports, json=payload)
+    return res
+
+def create_reports(user_id, fields_list, keys=None):
+    """
+    Записва отчетите в Airtable на партиди по REPORTS_BATCH_SIZE.
+    Връща броя на записаните; спира при първата неуспешна партида.
+    """
+    items = list(zip(fields_list, keys or [uuid.uuid4().hex for _ in fields_list]))
+    saved = 0
+    for start in range(0, len(items), REPORTS_BATCH_SIZE):
+        try:
+            res = post_reports(items[start:start + REPORTS_BATCH_SIZE])
+        except AirtableUnavailable:
+            if not saved:
+                raise
+            # Веригата се е отворила между партидите: останалите се записват по-късно от журнала
+            for fields, key in items[start:]:
+                report_outbox.append(user_id, fields, key)
+            return saved + len(items) - start
+        if res.status_code not in (200, 201):
+            print(f"❌ Airtable error: {res.status_code} - {res.text}")
+            break
+        created = res.json().get("records", [])
+        mirror_reports(created)
+        for record in created:
+            remember_user_record(user_id, record.get("id"))
+            saved += 1
+    return saved
+
+def saved_reports_text(saved, total):
+    if total == 1:
+        return "📌 Отчетът е записан успешно."
+    if saved == total:
+        return f"📌 Записани са {saved} отчета."
+    return f"⚠️ Записани са {saved} от {total} отчета."
+
+# Write-behind запис на отчетите
+REPORTS_WRITE_BEHIND = os.getenv("REPORTS_WRITE_BEHIND", "0") == "1"
+REPORTS_JOURNAL_PATH = os.getenv("REPORTS_JOURNAL_PATH", "reports_journal.db")
+REPORTS_FLUSH_INTERVAL = 2  # секунди
+REPORTS_OUTBOX_PATH = os.getenv("REPORTS_OUTBOX_PATH", "reports_outbox.db")
+OUTBOX_REPLAY_RATE = float(os.getenv("OUTBOX_REPLAY_RATE", "1"))  # партиди/сек към Airtable от журнала
+# След толкова секунди партида, взета от процес, който е спрял (срив, рестарт), може да се
+# вземе от друг. С голям запас над най-дългата заявка към Airtable с повторните опити.
+OUTBOX_CLAIM_TIMEOUT = int(os.getenv("OUTBOX_CLAIM_TIMEOUT", "300"))
+
+class ReportWriter:
+    """
+    Write-behind запис на отчети. Всяка потвърдена транзакция се добавя в журнал -
+    таблица в SQLite (WAL) - и потребителят получава отговор веднага. Фонова нишка
+    записва натрупаните отчети в Airtable на партиди по REPORTS_BATCH_SIZE, при
+    запълнена партида или на всеки flush_interval секунди. Журналът е общ за всички
+    процеси (gunicorn worker-и): всеки процес първо взема (claim) партидата в
+    транзакция и едва тогава я изпраща, така че една партида не се изпраща от два
+    процеса едновременно. Записаните редове се изтриват; незаписаните остават за
+    следващия flush или рестарт. Натрупаното по време на прекъсване на Airtable (или
+    останало от преди рестарта) се изпраща с най-много replay_rate партиди в секунда,
+    за да не заеме целия му лимит след възстановяването; обичайният write-behind
+    запис не се ограничава.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS report_journal ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, fields TEXT NOT NULL, key TEXT NOT NULL,"
+        " claimed_by TEXT, claimed_at REAL)",
+    )
+
+    def __init__(self, path, batch_size=REPORTS_BATCH_SIZE, flush_interval=REPORTS_FLUSH_INTERVAL,
+                 replay_rate=OUTBOX_REPLAY_RATE, claim_timeout=OUTBOX_CLAIM_TIMEOUT):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.claim_timeout = claim_timeout
+        self.replay_bucket = TokenBucket(replay_rate, capacity=1)
+        self._local = threading.local()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._backlog = False  # има натрупани отчети от прекъсване - изпращат се с replay_rate
+        self._schema_error = None  # последната грешка в схемата (за да не се повтаря алармата)
+        self._thread = None
+
+    def _conn(self):
+        """
+        Отделна връзка за всяка нишка. Файлът се отваря при първата употреба, а не
+        при import. synchronous=FULL: потвърденият на потребителя отчет не се губи
+        и при спиране на тока.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            self._local.conn = conn
+        return conn
+
+    def append(self, chat_id, fields, key=None):
+        """Записва отчета в журнала и го нарежда за изпращане."""
+        key = key or uuid.uuid4().hex
+        conn = self._conn()
+        with conn:
+            entry_id = conn.execute("INSERT INTO report_journal (chat_id, fields, key) VALUES (?, ?, ?)",
+                                    (chat_id, json.dumps(fields, ensure_ascii=False), key)).lastrowid
+        if len(self) >= self.batch_size:
+            self._wakeup.set()
+        return entry_id
+
+    def _claim(self, owner):
+        """
+        Взема до batch_size свободни реда (или взети от спрял процес) за owner.
+        Връща [(entry_id, {"chat_id": ..., "fields": ..., "key": ...})] по реда на добавяне.
+        """
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE report_journal SET claimed_by = ?, claimed_at = ? WHERE id IN ("
+                " SELECT id FROM report_journal WHERE claimed_by IS NULL OR claimed_at < ? ORDER BY id LIMIT ?)",
+                (owner, now, now - self.claim_timeout, self.batch_size))
+            rows = conn.execute("SELECT id, chat_id, fields, key FROM report_journal WHERE claimed_by = ? ORDER BY id",
+                                (owner,)).fetchall()
+        return [(entry_id, {"chat_id": chat_id, "fields": json.loads(fields), "key": key})
+                for entry_id, chat_id, fields, key in rows]
+
+    def _release(self, owner):
+        """Връща незаписаните редове от партидата за следващ опит."""
+        with self._conn() as conn:
+            conn.execute("UPDATE report_journal SET claimed_by = NULL, claimed_at = NULL WHERE claimed_by = ?",
+                         (owner,))
+
+    def _mark_done(self, entry_ids):
+        with self._conn() as conn:
+            conn.executemany("DELETE FROM report_journal WHERE id = ?", [(entry_id,) for entry_id in entry_ids])
+
+    def _post_batch(self, batch):
+        """Изпраща една партида. Връща False, ако трябва да се опита по-късно."""
+        try:
+            # Ключът е същият при replay след рестарт - записаното преди срива не се дублира
+            res = post_reports([(entry["fields"], entry["key"]) for _, entry in batch])
+        except requests.exceptions.RequestException as e:
+            print(f"❌ Грешка при batch запис на отчети: {e}")
+            return False
+
+        if res.status_code in (200, 201):
+            self._schema_error = None
+            created = res.json().get("records", [])
+            mirror_reports(created)
+            for (_, entry), record in zip(batch, created):
+                if entry.get("chat_id") is not None:
+                    remember_user_record(entry["chat_id"], record.get("id"))
+            self._mark_done([entry_id for entry_id, _ in batch])
+            return True
+
+        if res.status_code == 429 or res.status_code >= 500:
+            print(f"⚠️ Airtable {res.status_code} при batch запис, ще опитаме отново")
+            return False
+
+        error_type, message = airtable_error(res)
+        if res.status_code in (401, 403, 404) or error_type in AIRTABLE_SCHEMA_ERRORS:
+            # Проблем в схемата или правата, а не в отчета: остава в журнала, докато се оправи
+            if self._schema_error != error_type:
+                self._schema_error = error_type
+                print(f"🚨 Airtable {res.status_code} {error_type}: {message} - "
+                      f"{len(self)} отчета остават в журнала {self.path}")
+            return False
+        self._schema_error = None
+
+        # Невалидни данни: изпращаме поотделно, за да не блокира цялата партида
+        print(f"❌ Airtable error при batch запис: {res.status_code} - {res.text}")
+        if len(batch) > 1:
+            for item in batch:
+                if not self._post_batch([item]):
+                    return False
+            return True
+        entry_id, entry = batch[0]
+        self._mark_done([entry_id])
+        if entry.get("chat_id") is not None:
+            try:
+                send_message_nowait(entry["chat_id"], f"❌ Отчетът „{entry['fields'].get('Описание', '')[:50]}“ не беше записан в базата.")
+            except Exception as e:
+                print(f"❌ Cannot notify user: {e}")
+        return True
+
+    def flush(self):
+        """Изпраща всички свободни отчети на партиди. Връща True, ако няма какво повече да се изпрати."""
+        with self._flush_lock:
+            while True:
+                if not airtable.available():
+                    self._backlog = True
+                    return False  # circuit breaker-ът е отворен - изчакваме възстановяването
+                owner = uuid.uuid4().hex
+                batch = self._claim(owner)
+                if not batch:
+                    self._backlog = False
+                    return True
+                if self._backlog:
+                    self.replay_bucket.acquire()
+                try:
+                    if not self._post_batch(batch):
+                        self._backlog = True
+                        return False
+                finally:
+                    self._release(owner)
+
+    def _run(self):
+        if len(self):
+            self._backlog = True
+            print(f"♻️ {len(self)} незаписани отчета в журнала {self.path}")
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"❌ Неочаквана грешка при flush на отчетите: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="report-writer", daemon=True)
+            self._thread.start()
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM report_journal").fetchone()[0]
+
+report_writer = None
+if REPORTS_WRITE_BEHIND:
+    report_writer = ReportWriter(REPORTS_JOURNAL_PATH)
+
+# Локален outbox за отчетите, докато Airtable е недостъпен (при write-behind - самият журнал)
+report_outbox = report_writer or ReportWriter(REPORTS_OUTBOX_PATH)
+
+def queue_reports(user_id, fields_list, keys, offline):
+    """Записва отчетите в журнала за по-късно изпращане; връща текста за потребителя."""
+    for fields, key in zip(fields_list, keys):
+        report_outbox.append(user_id, fields, key)
+    if offline:
+        if len(fields_list) == 1:
+            return "📥 Базата е временно недостъпна. Отчетът е запазен и ще бъде записан автоматично."
+        return f"📥 Базата е временно недостъпна. {len(fields_list)} отчета са запазени и ще бъдат записани автоматично."
+    if len(fields_list) == 1:
+        return "📌 Отчетът е приет и ще бъде записан."
+    return f"📌 Приети са {len(fields_list)} отчета и ще бъдат записани."
 
 @bot.callback_query_handler(func=lambda call: True)
 def handle_transaction_type_selection(call):
@@ -466,37 +2734,15 @@ def handle_transaction_type_selection(call):
 
         if call.data == "FILTER_BY_KEYWORD":
             bot.answer_callback_query(call.id)
-            bot.send_message(user_id, "🔍 Въведи дума за филтриране:")
+            send_message_nowait(user_id, "🔍 Въведи дума за филтриране:")
             bot.register_next_step_handler(call.message, show_filtered_transaction_types)
             return
 
         # 🔄 Навигация и филтриране
-        if selected_label == "__prev":
+        if selected_label in ("__prev", "__next"):
             current_page = user_pending_type[user_id].get("page", 0)
-            new_page = max(current_page - 1, 0)
-            try:
-                bot.delete_message(user_id, user_pending_type[user_id]["msg_id"])
-            except Exception as e:
-                print(f"⚠️ Cannot delete message: {e}")
-            send_transaction_type_page(
-                chat_id=user_id,
-                page=new_page,
-                filtered_types=user_pending_type[user_id].get("filtered")
-            )
-            return
-
-        elif selected_label == "__next":
-            current_page = user_pending_type[user_id].get("page", 0)
-            new_page = current_page + 1
-            try:
-                bot.delete_message(user_id, user_pending_type[user_id]["msg_id"])
-            except Exception as e:
-                print(f"⚠️ Cannot delete message: {e}")
-            send_transaction_type_page(
-                chat_id=user_id,
-                page=new_page,
-                filtered_types=user_pending_type[user_id].get("filtered")
-            )
+            new_page = max(current_page - 1, 0) if selected_label == "__prev" else current_page + 1
+            turn_transaction_type_page(user_id, new_page)
             return
 
         elif selected_label == "__filter":
@@ -511,7 +2757,8 @@ def handle_transaction_type_selection(call):
             return
 
         # ✅ Проверка дали е валиден тип
-        user_options = user_pending_type[user_id].get("options", {})
+        state = user_pending_type[user_id]
+        user_options = pending_type_options(state, get_transaction_types_snapshot())
         if selected_label not in user_options:
             bot.answer_callback_query(call.id, "❌ Невалиден избор.")
             return
@@ -519,13 +2766,13 @@ def handle_transaction_type_selection(call):
         selected_id = user_options.get(selected_label)
 
         # 💾 Запази избора
-        user_pending_type[user_id]["selected"] = selected_id
-        user_pending_type[user_id]["selected_label"] = selected_label
-        user_state_timestamps[user_id] = datetime.now()
+        state["selected"] = selected_id
+        state["selected_label"] = selected_label
+        user_pending_type[user_id] = state
 
         # ✅ Покажи избраното
         try:
-            bot.edit_message_text(
+            edit_message_text_nowait(
                 chat_id=user_id,
                 message_id=user_pending_type[user_id]["msg_id"],
                 text=f"✅ Избра вид: {selected_label}"
@@ -535,59 +2782,40 @@ def handle_transaction_type_selection(call):
 
         # 📥 Ако има чакащи данни за транзакция — записваме в Airtable
         if user_id in pending_transaction_data:
-            tx = pending_transaction_data[user_id]
-            account_id = find_account(tx.get("account_name", ""))
-
-            fields = {
-                "Дата": tx.get("datetime", datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
-                "Описание": tx.get("description", "")[:500],
-                "Име на потребителя": tx.get("user_name", "")[:100],
-                "ВИД": [selected_id],
-            }
-
-            currency_code = tx.get("currency_code")
-            amount = tx.get("amount")
-
-            if currency_code == "BGN":
-                fields["Сума (лв.)"] = amount
-            elif currency_code == "EUR":
-                fields["Сума (EUR)"] = amount
-            elif currency_code == "GBP":
-                fields["Сума (GBP)"] = amount
-            elif currency_code == "USD":
-                fields["Сума (USD)"] = amount
-
-            if account_id:
-                fields["Акаунт"] = [account_id]
-            else:
-                acc_name = tx.get("account_name", "")[:100]
-                fields["Описание"] = f"{fields['Описание']} (Акаунт: {acc_name})"
-
-            data = {"fields": fields}
+            txs = pending_transactions(pending_transaction_data[user_id])
+            account_ids = {}
+            fields_list = []
+            for tx in txs:
+                account_name = tx.get("account_name", "")
+                if account_name not in account_ids:
+                    account_ids[account_name] = find_account(account_name)
+                fields_list.append(build_report_fields(tx, selected_id, account_ids[account_name]))
+            keys = report_keys(txs)
+
+            # Write-behind или недостъпен Airtable: записваме в журнала и отговаряме веднага
+            if report_writer is not None or not airtable.healthy():
+                accepted = queue_reports(user_id, fields_list, keys, offline=report_writer is None)
+                send_message_nowait(user_id, f"✅ Избра вид: {selected_label}\n{accepted}")
+                pending_transaction_data.pop(user_id, None)
+                user_pending_type.pop(user_id, None)
+                return
 
             try:
-                res_post = requests.post(url_reports, headers=headers, json=data, timeout=10)
-
-                if res_post.status_code in (200, 201):
-                    record_id = res_post.json().get("id")
-                    if user_id not in user_records:
-                        user_records[user_id] = []
-                    user_records[user_id].append(record_id)
-
-                    # Limit records per user
-                    if len(user_records[user_id]) > MAX_USER_RECORDS:
-                        user_records[user_id] = user_records[user_id][-MAX_USER_RECORDS:]
+                saved = create_reports(user_id, fields_list, keys)
 
-                    bot.send_message(user_id, f"✅ Избра вид: {selected_label}\n📌 Отчетът е записан успешно.")
+                if saved:
+                    send_message_nowait(user_id, f"✅ Избра вид: {selected_label}\n{saved_reports_text(saved, len(fields_list))}")
                 else:
-                    print(f"❌ Airtable error: {res_post.status_code}")
-                    bot.send_message(user_id, "❌ Грешка при записването в базата.")
+                    send_message_nowait(user_id, "❌ Грешка при записването в базата.")
+            except AirtableUnavailable:
+                # Веригата се е отворила точно преди заявката - нищо не е изпратено
+                send_message_nowait(user_id, f"✅ Избра вид: {selected_label}\n{queue_reports(user_id, fields_list, keys, offline=True)}")
             except requests.exceptions.Timeout:
                 print(f"⏱️ Timeout при записване на транзакция")
-                bot.send_message(user_id, "⏱️ Заявката отне твърде много време.")
+                send_message_nowait(user_id, "⏱️ Заявката отне твърде много време.")
             except requests.exceptions.RequestException as e:
                 print(f"❌ Request error: {e}")
-                bot.send_message(user_id, "❌ Грешка при връзка с базата.")
+                send_message_nowait(user_id, "❌ Грешка при връзка с базата.")
 
             # 🧹 Изчистваме временното състояние
             pending_transaction_data.pop(user_id, None)
@@ -608,147 +2836,110 @@ def handle_edit(message):
 
     # Rate limiting
     if not rate_limiter.is_allowed(user_id):
-        bot.reply_to(message, "⏸️ Твърде много заявки. Моля, изчакайте малко.")
+        reply_to_nowait(message, "⏸️ Твърде много заявки. Моля, изчакайте малко.")
         return
 
     user_name = message.from_user.first_name if message.from_user.first_name else "Unknown"
 
-    records = get_user_records_from_airtable(user_name)
+    records = list(itertools.islice(get_user_records_from_airtable(user_name), MAX_USER_RECORDS))
 
     if not records:
-        bot.reply_to(message, "❌ Няма записи за редактиране.")
+        reply_to_nowait(message, "❌ Няма записи за редактиране.")
         return
 
-    user_records[user_id] = [r["id"] for r in records[:MAX_USER_RECORDS]]
+    user_records[user_id] = [r["id"] for r in records]
 
     reply_text = "Вашите записи:\n"
-    for i, record in enumerate(records[:MAX_USER_RECORDS], 1):
-        record_id = record["id"]
-        fields = record.get("fields", {})
-        description = fields.get("Описание", "Без описание")[:100]
-        amount = fields.get("Сума (лв.)", fields.get("Сума (EUR)", fields.get("Сума (GBP)", fields.get("Сума (USD)", "?"))))
-        account_name = "?"
+    reply_text += format_records_listing(records)
 
-        # Ако има акаунт, извличаме името
-        account_ids = fields.get("Акаунт", [])
-        if isinstance(account_ids, list) and account_ids and len(account_ids) > 0:
-            try:
-                acc_res = requests.get(f"{url_accounts}/{account_ids[0]}", headers=headers, timeout=10)
-                if acc_res.status_code == 200:
-                    acc_data = acc_res.json()
-                    account_name = acc_data.get("fields", {}).get("REG", "?")[:50]
-            except requests.exceptions.Timeout:
-                print(f"⏱️ Timeout при извличане на акаунт")
-            except requests.exceptions.RequestException as e:
-                print(f"❌ Error fetching account: {e}")
-
-        full_text = f"{amount} {description} от {account_name}"
-        reply_text += f"{i}. {full_text[:150]}\n"
-
-    user_state_timestamps[user_id] = datetime.now()
     sent_msg = bot.reply_to(message, reply_text + "Изберете номер на запис за редактиране (напр. /edit 1):")
     bot.register_next_step_handler(sent_msg, process_edit_choice)
 
 
+def build_amount_update(new_amount_str):
+    """
+    Парсва "<сума> <валута>" при редакция на сума.
+    Връща (данни за PATCH, None) или (None, съобщение за грешка).
+    """
+    # Търсене на сума с валута
+    m = AMOUNT_CURRENCY_RE.fullmatch(new_amount_str.strip())
+    if not m or not m.group(2).strip():
+        return None, "❌ Моля, въведете валидна сума с валута. Пример: 100 лв., 250 EUR, 50 GBP."
+
+    # Преобразуване на сума в число
+    new_amount = float(m.group(1).replace(",", "."))
+
+    # Validate amount range
+    if new_amount < 0 or new_amount > 1_000_000_000:
+        return None, "❌ Сумата е извън допустимия диапазон."
+
+    # Преобразуване на валутата в код
+    new_currency_code = CURRENCY_ALIASES.get(" ".join(m.group(2).lower().split()).rstrip("."))
+    if not new_currency_code:
+        return None, "❌ Моля, въведете валидна валута: лв., EUR, GBP, USD."
+
+    # Записваме новата сума и валута в Airtable
+    new_data = {
+        "fields": {
+            CURRENCY_AMOUNT_FIELDS[new_currency_code]: new_amount,
+            "Валута": new_currency_code
+        }
+    }
+    return new_data, None
+
 def update_amount(message):
     """Обработва новата стойност на сумата и актуализира запис в Airtable."""
     user_id = message.chat.id
 
     # Check rate limiting
     if not rate_limiter.is_allowed(user_id):
-        bot.reply_to(message, "⏸️ Твърде много заявки. Моля, изчакайте малко.")
+        reply_to_nowait(message, "⏸️ Твърде много заявки. Моля, изчакайте малко.")
         return
 
     if user_id not in user_editing:
-        bot.reply_to(message, "❌ Не намерихме избрания запис за редактиране.")
+        reply_to_nowait(message, "❌ Не намерихме избрания запис за редактиране.")
         return
 
     record_id = user_editing[user_id].get('record_id')
     if not record_id:
-        bot.reply_to(message, "❌ Невалидно състояние на редактиране.")
+        reply_to_nowait(message, "❌ Невалидно състояние на редактиране.")
         return
 
     new_amount_str = message.text.strip() if message.text else ""
 
     if not new_amount_str or len(new_amount_str) > 50:
-        bot.reply_to(message, "❌ Невалидна дължина на сумата.")
+        reply_to_nowait(message, "❌ Невалидна дължина на сумата.")
         return
 
     try:
-        # Търсене на сума с валута
-        m = re.match(r'^(\d+(?:\.\d+)?)(\s*(лв|lv|лев|лева|bgn|eur|€|евро|evro|gbp|£|паунд|паунда|paunda))$', new_amount_str, re.IGNORECASE)
-        if not m:
-            bot.reply_to(message, "❌ Моля, въведете валидна сума с валута. Пример: 100 лв., 250 EUR, 50 GBP.")
-            return
-
-        amount_str = m.group(1)
-        currency_str = m.group(2).strip().lower()
-
-        # Преобразуване на сума в число
-        new_amount = float(amount_str)
-
-        # Validate amount range
-        if new_amount < 0 or new_amount > 1_000_000_000:
-            bot.reply_to(message, "❌ Сумата е извън допустимия диапазон.")
+        new_data, error = build_amount_update(new_amount_str)
+        if error:
+            reply_to_nowait(message, error)
             return
 
-        # Преобразуване на валутата в код
-        currency_map = {
-            "bgn": ("лв", "lv", "лев", "лева", "bgn"),
-            "eur": ("eur", "€", "евро", "evro"),
-            "gbp": ("gbp", "£", "паунд", "паунда", "paunda"),
-            "usd": ("usd", "$", "долар", "долара", "долари", "дол", "щ", "щатски", "щатски долари", "щатски долара", "долар сащ", "долара сащ", "американски долар", "американски долари")
-        }
-
-        new_currency_code = None
-        for code, aliases in currency_map.items():
-            if currency_str in aliases:
-                new_currency_code = code.upper()
-                break
-
-        if not new_currency_code:
-            bot.reply_to(message, "❌ Моля, въведете валидна валута: лв., EUR, GBP, USD.")
-            return
-
-        # Записваме новата сума и валута в Airtable
-        if new_currency_code == "BGN":
-            field_name = "Сума (лв.)"
-        elif new_currency_code == "EUR":
-            field_name = "Сума (EUR)"
-        elif new_currency_code == "GBP":
-            field_name = "Сума (GBP)"
-        elif new_currency_code == "USD":
-            field_name = "Сума (USD)"
-
-        new_data = {
-            "fields": {
-                field_name: new_amount,
-                "Валута": new_currency_code
-            }
-        }
-
-        res_put = requests.patch(f"{url_reports}/{record_id}", headers=headers, json=new_data, timeout=10)
+        res_put = airtable.patch(f"{url_reports}/{record_id}", json=new_data)
 
         if res_put.status_code == 200:
-            bot.reply_to(message, "✅ Сумата и валутата са успешно актуализирани.")
+            mirror_reports([res_put.json()])
+            reply_to_nowait(message, "✅ Сумата и валутата са успешно актуализирани.")
             user_editing.pop(user_id, None)
         else:
             print(f"❌ Airtable error: {res_put.status_code} - {res_put.text}")
-            bot.reply_to(message, "❌ Грешка при актуализирането на сумата и валутата.")
+            reply_to_nowait(message, "❌ Грешка при актуализирането на сумата и валутата.")
             user_editing.pop(user_id, None)
 
     except ValueError as e:
         print(f"❌ ValueError in update_amount: {e}")
-        bot.reply_to(message, "❌ Моля, въведете валидна сума.")
+        reply_to_nowait(message, "❌ Моля, въведете валидна сума.")
     except requests.exceptions.Timeout:
         print(f"⏱️ Timeout при актуализиране на сума")
-        bot.reply_to(message, "⏱️ Заявката отне твърде много време. Опитайте отново.")
+        reply_to_nowait(message, "⏱️ Заявката отне твърде много време. Опитайте отново.")
     except requests.exceptions.RequestException as e:
         print(f"❌ Request error in update_amount: {e}")
-        bot.reply_to(message, "❌ Грешка при връзка с базата данни.")
+        reply_to_nowait(message, "❌ Грешка при връзка с базата данни.")
     except Exception as e:
         print(f"❌ Unexpected error in update_amount: {e}")
-        bot.reply_to(message, "❌ Възникна неочаквана грешка.")
+        reply_to_nowait(message, "❌ Възникна неочаквана грешка.")
         
 @bot.message_handler(commands=['delete'])
 def handle_delete(message):
@@ -756,43 +2947,22 @@ def handle_delete(message):
 
     # Rate limiting
     if not rate_limiter.is_allowed(user_id):
-        bot.reply_to(message, "⏸️ Твърде много заявки. Моля, изчакайте малко.")
+        reply_to_nowait(message, "⏸️ Твърде много заявки. Моля, изчакайте малко.")
         return
 
     user_name = message.from_user.first_name if message.from_user.first_name else "Unknown"
 
-    records = get_user_records_from_airtable(user_name)
+    records = list(itertools.islice(get_user_records_from_airtable(user_name), MAX_USER_RECORDS))
 
     if not records:
-        bot.reply_to(message, "❌ Няма записи за изтриване.")
+        reply_to_nowait(message, "❌ Няма записи за изтриване.")
         return
 
-    user_records[user_id] = [r["id"] for r in records[:MAX_USER_RECORDS]]
+    user_records[user_id] = [r["id"] for r in records]
 
     reply_text = "Вашите записи за изтриване:\n"
-    for i, record in enumerate(records[:MAX_USER_RECORDS], 1):
-        record_id = record["id"]
-        fields = record.get("fields", {})
-        description = fields.get("Описание", "Без описание")[:100]
-        amount = fields.get("Сума (лв.)", fields.get("Сума (EUR)", fields.get("Сума (GBP)", fields.get("Сума (USD)", "?"))))
-        account_name = "?"
+    reply_text += format_records_listing(records)
 
-        account_ids = fields.get("Акаунт", [])
-        if isinstance(account_ids, list) and account_ids and len(account_ids) > 0:
-            try:
-                acc_res = requests.get(f"{url_accounts}/{account_ids[0]}", headers=headers, timeout=10)
-                if acc_res.status_code == 200:
-                    acc_data = acc_res.json()
-                    account_name = acc_data.get("fields", {}).get("REG", "?")[:50]
-            except requests.exceptions.Timeout:
-                print(f"⏱️ Timeout при извличане на акаунт")
-            except requests.exceptions.RequestException as e:
-                print(f"❌ Error fetching account: {e}")
-
-        full_text = f"{amount} {description} от {account_name}"
-        reply_text += f"{i}. {full_text[:150]}\n"
-
-    user_state_timestamps[user_id] = datetime.now()
     sent_msg = bot.reply_to(message, reply_text + "Изберете номер на запис за изтриване (напр. /delete 1):")
     bot.register_next_step_handler(sent_msg, process_delete_choice)
 
@@ -803,25 +2973,25 @@ def process_delete_choice(message):
     user_id = message.chat.id
 
     if not message.text:
-        bot.reply_to(message, "❌ Невалидно съобщение.")
+        reply_to_nowait(message, "❌ Невалидно съобщение.")
         return
 
     try:
         # Избор на запис за изтриване (по номер)
         parts = message.text.split()
         if len(parts) < 2:
-            bot.reply_to(message, "❌ Моля, въведете валиден номер на запис.")
+            reply_to_nowait(message, "❌ Моля, въведете валиден номер на запис.")
             return
 
         record_index = int(parts[1]) - 1  # Преобразуваме в индекс
 
         if user_id not in user_records:
-            bot.reply_to(message, "❌ Няма записи за изтриване.")
+            reply_to_nowait(message, "❌ Няма записи за изтриване.")
             return
 
         user_record_list = user_records[user_id]
         if not isinstance(user_record_list, list) or not (0 <= record_index < len(user_record_list)):
-            bot.reply_to(message, "❌ Невалиден номер на запис.")
+            reply_to_nowait(message, "❌ Невалиден номер на запис.")
             return
 
         record_id = user_record_list[record_index]
@@ -830,28 +3000,36 @@ def process_delete_choice(message):
         delete_url = f"{url_reports}/{record_id}"
 
         try:
-            res_delete = requests.delete(delete_url, headers=headers, timeout=10)
+            res_delete = airtable.delete(delete_url)
 
             if res_delete.status_code == 200:
-                bot.reply_to(message, "✅ Записът беше изтрит успешно.")
+                mirror_report_deleted(record_id)
+                reply_to_nowait(message, "✅ Записът беше изтрит успешно.")
                 # Премахваме записа от списъка на потребителя
-                user_record_list.remove(record_id)
+                forget_user_record(user_id, record_id)
             else:
                 print(f"❌ Delete error: {res_delete.status_code}")
-                bot.reply_to(message, "❌ Грешка при изтриването на записа.")
+                reply_to_nowait(message, "❌ Грешка при изтриването на записа.")
         except requests.exceptions.Timeout:
             print(f"⏱️ Timeout при изтриване на запис")
-            bot.reply_to(message, "⏱️ Заявката отне твърде много време.")
+            reply_to_nowait(message, "⏱️ Заявката отне твърде много време.")
         except requests.exceptions.RequestException as e:
             print(f"❌ Request error in delete: {e}")
-            bot.reply_to(message, "❌ Грешка при връзка с базата.")
+            reply_to_nowait(message, "❌ Грешка при връзка с базата.")
 
     except (ValueError, IndexError) as e:
         print(f"❌ Parse error in process_delete_choice: {e}")
-        bot.reply_to(message, "❌ Моля, въведете валиден номер на запис.")
+        reply_to_nowait(message, "❌ Моля, въведете валиден номер на запис.")
     except Exception as e:
         print(f"❌ Unexpected error in process_delete_choice: {e}")
-        bot.reply_to(message, "❌ Възникна неочаквана грешка.")       
+        reply_to_nowait(message, "❌ Възникна неочаквана грешка.")       
+
+def set_editing_field(user_id, field):
+    """Запомня кое поле на избрания запис се редактира."""
+    state = user_editing.get(user_id)
+    if state is not None:
+        state['field'] = field
+        user_editing[user_id] = state
 
 # Функция за обработка на полето за редактиране (описание, сума или акаунт)
 def process_edit_field(message):
@@ -859,19 +3037,19 @@ def process_edit_field(message):
     field_to_edit = message.text.lower()
 
     if field_to_edit == "описание":
-        user_editing[user_id]['field'] = 'описание'
-        bot.reply_to(message, "Моля, въведете новото описание за този запис:")
+        set_editing_field(user_id, 'описание')
+        reply_to_nowait(message, "Моля, въведете новото описание за този запис:")
         bot.register_next_step_handler(message, process_new_description)
     elif field_to_edit == "сума":
-        user_editing[user_id]['field'] = 'сума'
-        bot.reply_to(message, "Моля, въведете новата стойност за сумата:")
+        set_editing_field(user_id, 'сума')
+        reply_to_nowait(message, "Моля, въведете новата стойност за сумата:")
         bot.register_next_step_handler(message, update_amount)  # Извикваме update_amount за сума
     elif field_to_edit == "акаунт":
-        user_editing[user_id]['field'] = 'акаунт'
-        bot.reply_to(message, "Моля, въведете новия акаунт:")
+        set_editing_field(user_id, 'акаунт')
+        reply_to_nowait(message, "Моля, въведете новия акаунт:")
         bot.register_next_step_handler(message, process_new_account)  # Извикваме process_new_account за акаунт
     else:
-        bot.reply_to(message, "❌ Моля, въведете една от следните опции: описание, сума, акаунт.")
+        reply_to_nowait(message, "❌ Моля, въведете една от следните опции: описание, сума, акаунт.")
         bot.register_next_step_handler(message, process_edit_field)
 
 # Обработчик за избор на запис
@@ -886,12 +3064,12 @@ def process_edit_choice(message):
             # Записваме кой запис ще редактираме и кой поле се редактира
             user_editing[user_id] = {'record_id': record_id, 'field': None}
             # Изпращаме заявка за редактиране на този запис в Airtable
-            bot.reply_to(message, "Моля, въведете какво искате да промените: описание, сума или акаунт.")
+            reply_to_nowait(message, "Моля, въведете какво искате да промените: описание, сума или акаунт.")
             bot.register_next_step_handler(message, process_edit_field)
         else:
-            bot.reply_to(message, "❌ Невалиден номер на запис. Моля, въведете валиден номер.")
+            reply_to_nowait(message, "❌ Невалиден номер на запис. Моля, въведете валиден номер.")
     except ValueError:
-        bot.reply_to(message, "❌ Моля, въведете валиден номер на запис.")
+        reply_to_nowait(message, "❌ Моля, въведете валиден номер на запис.")
 
 def process_new_description(message):
     """Обновява описание в Airtable."""
@@ -905,17 +3083,24 @@ def process_new_description(message):
 
         # Записваме новото описание в Airtable
         new_data = {"fields": {"Описание": new_description}}
-        res_put = requests.patch(f"{url_reports}/{record_id}", headers=headers, json=new_data)
+        try:
+            res_put = airtable.patch(f"{url_reports}/{record_id}", json=new_data)
+        except requests.exceptions.RequestException as e:
+            print(f"❌ Request error in process_new_description: {e}")
+            reply_to_nowait(message, "❌ Грешка при връзка с базата.")
+            user_editing.pop(user_id, None)
+            return
 
         if res_put.status_code == 200:
-            bot.reply_to(message, "✅ Записът е редактиран успешно.")
+            mirror_reports([res_put.json()])
+            reply_to_nowait(message, "✅ Записът е редактиран успешно.")
             del user_editing[user_id]  # Изтриваме записа от избраните за редактиране
         else:
             print(f"Error response: {res_put.status_code} - {res_put.text}")  # Печатаме отговора от Airtable
-            bot.reply_to(message, "❌ Грешка при редактирането на записа.")
+            reply_to_nowait(message, "❌ Грешка при редактирането на записа.")
             del user_editing[user_id]
     else:
-        bot.reply_to(message, "❌ Не намерихме избрания запис за редактиране.")
+        reply_to_nowait(message, "❌ Не намерихме избрания запис за редактиране.")
 
        # Обработчик за новата сума с валута - използва update_amount
 def process_new_amount(message):
@@ -926,17 +3111,12 @@ def process_new_amount(message):
 def process_new_currency(message, new_amount):
     """Обновява валутата в Airtable."""
     user_id = message.chat.id
-    new_currency = message.text.strip().lower()
+    new_currency = " ".join(message.text.lower().split()).rstrip(".")
 
     # Преобразуваме валутата към формат за Airtable
-    if new_currency in ["лв", "lv", "лев", "лева", "bgn"]:
-        new_currency_code = "BGN"
-    elif new_currency in ["eur", "€", "евро", "evro"]:
-        new_currency_code = "EUR"
-    elif new_currency in ["gbp", "£", "паунд", "паунда", "paunda"]:
-        new_currency_code = "GBP"
-    else:
-        bot.reply_to(message, "❌ Моля, въведете валидна валута: лв., EUR, GBP.")
+    new_currency_code = CURRENCY_ALIASES.get(new_currency)
+    if not new_currency_code:
+        reply_to_nowait(message, "❌ Моля, въведете валидна валута: лв., EUR, GBP, USD.")
         return
 
     # Актуализираме данните за сумата и валутата в Airtable
@@ -944,34 +3124,29 @@ def process_new_currency(message, new_amount):
     if user_id in user_editing:
         record_id = user_editing[user_id]['record_id']
 
-        # Determine field name based on currency
-        if new_currency_code == "BGN":
-            field_name = "Сума (лв.)"
-        elif new_currency_code == "EUR":
-            field_name = "Сума (EUR)"
-        elif new_currency_code == "GBP":
-            field_name = "Сума (GBP)"
-        elif new_currency_code == "USD":
-            field_name = "Сума (USD)"
-        else:
-            field_name = "Сума (лв.)"  # default
-
         new_data = {
             "fields": {
-                field_name: new_amount,
+                CURRENCY_AMOUNT_FIELDS[new_currency_code]: new_amount,
                 "Валута": new_currency_code  # Добавяме полето за валута
             }
         }
 
-        res_put = requests.patch(f"{url_reports}/{record_id}", headers=headers, json=new_data)
+        try:
+            res_put = airtable.patch(f"{url_reports}/{record_id}", json=new_data)
+        except requests.exceptions.RequestException as e:
+            print(f"❌ Request error in process_new_currency: {e}")
+            reply_to_nowait(message, "❌ Грешка при връзка с базата.")
+            user_editing.pop(user_id, None)
+            return
         if res_put.status_code == 200:
-            bot.reply_to(message, "✅ Сумата и валутата са успешно актуализирани.")
+            mirror_reports([res_put.json()])
+            reply_to_nowait(message, "✅ Сумата и валутата са успешно актуализирани.")
             del user_editing[user_id]  # Изтриваме записа от избраните за редактиране
         else:
-            bot.reply_to(message, "❌ Грешка при актуализирането на сумата и валутата.")
+            reply_to_nowait(message, "❌ Грешка при актуализирането на сумата и валутата.")
             del user_editing[user_id]
     else:
-        bot.reply_to(message, "❌ Не намерихме избрания запис за редактиране.")
+        reply_to_nowait(message, "❌ Не намерихме избрания запис за редактиране.")
 
         
 def process_new_account(message):
@@ -979,41 +3154,357 @@ def process_new_account(message):
     user_id = message.chat.id
     if user_id in user_editing and user_editing[user_id]['field'] == 'акаунт':
         record_id = user_editing[user_id]['record_id']
-        new_account = message.text.strip().lower()  # Преобразуваме в малки букви
-
-        # Нормализираме входа: премахваме специални символи
-        normalized_input = re.sub(r"[^0-9A-Za-z]+", " ", new_account).strip().lower()
-        keywords = normalized_input.split()
-
-        # Създаване на формулата за търсене по ключови думи с логика AND
-        formula = "AND(" + ", ".join([f"SEARCH('{term}', LOWER({{REG}})) > 0" for term in keywords]) + ")"
-        params = {"filterByFormula": formula}
+        new_account = message.text.strip()
 
-        # Търсене на акаунта в Airtable ("ВСИЧКИ АКАУНТИ") по колоната REG с частично съвпадение
-        res = requests.get(url_accounts, headers=headers, params=params)
+        # Търсене на акаунта по колоната REG с частично съвпадение (през локалния каталог)
+        account_id = find_account(new_account)
 
-        if res.status_code == 200:
-            data = res.json()
-            records = data.get("records", [])
-            if len(records) > 0:
-                account_id = records[0]["id"]  # ID на намерен акаунт
-                # Актуализираме акаунта в Airtable
-                new_data = {"fields": {"Акаунт": [account_id]}}
-                res_put = requests.patch(f"{url_reports}/{record_id}", headers=headers, json=new_data)
-                if res_put.status_code == 200:
-                    bot.reply_to(message, "✅ Акаунтът е актуализиран успешно.")
-                else:
-                    bot.reply_to(message, "❌ Грешка при актуализирането на акаунта.")
+        if account_id:
+            # Актуализираме акаунта в Airtable
+            new_data = {"fields": {"Акаунт": [account_id]}}
+            try:
+                res_put = airtable.patch(f"{url_reports}/{record_id}", json=new_data)
+            except requests.exceptions.RequestException as e:
+                print(f"❌ Request error in process_new_account: {e}")
+                reply_to_nowait(message, "❌ Грешка при връзка с базата.")
+                return
+            if res_put.status_code == 200:
+                mirror_reports([res_put.json()])
+                reply_to_nowait(message, "✅ Акаунтът е актуализиран успешно.")
             else:
-                bot.reply_to(message, "❌ Не намерихме акаунт с това име.")
+                reply_to_nowait(message, "❌ Грешка при актуализирането на акаунта.")
         else:
-            bot.reply_to(message, "❌ Грешка при търсенето на акаунт.")
+            reply_to_nowait(message, "❌ Не намерихме акаунт с това име.")
     else:
-        bot.reply_to(message, "❌ Не намерихме избрания запис за редактиране.")
+        reply_to_nowait(message, "❌ Не намерихме избрания запис за редактиране.")
         
 def get_transaction_types_from_airtable():
             return list(get_transaction_type_options().keys())
     
+def make_pending_transaction(amount, currency_code, description, account_name, is_expense, user_name, current_datetime):
+    """Транзакцията, която чака избор на ВИД."""
+    return {
+        "amount": amount,
+        "currency_code": currency_code,
+        "description": description[:500],
+        "account_name": account_name[:100] if account_name else "",
+        "is_expense": is_expense,
+        "user_name": user_name[:100],
+        "datetime": current_datetime,
+    }
+
+def build_pending_transactions(text, user_name, current_datetime):
+    """
+    Парсва съобщението (по една транзакция на ред) до чакащи данни за pending_transaction_data.
+    Връща (данни, None, None) или (None, текст на отговора, parse_mode) при грешка.
+    """
+    parsed_lines = parse_transactions(text)
+    if len(parsed_lines) > MAX_BATCH_TRANSACTIONS:
+        return None, f"⚠️ Твърде много редове (макс. {MAX_BATCH_TRANSACTIONS} транзакции в съобщение).", None
+
+    invalid = [(line_no, line) for line_no, line, parsed in parsed_lines if not is_valid_transaction(parsed)]
+    if len(parsed_lines) > 1 and invalid:
+        # Без Markdown - редовете са текст от потребителя
+        bad_lines = "\n".join(f"{line_no}: {line[:50]}" for line_no, line in invalid)
+        return None, (f"⚠️ Неразпознати редове:\n{bad_lines}\n\n"
+                      "Всеки ред трябва да е във формат като:\n100 лв. за <описание> от <акаунт>"), None
+    if not parsed_lines or invalid:
+        return None, ("⚠️ Неразпознат формат. Моля, използвайте формат като:\n"
+                      "`100 лв. за <описание> от <акаунт>`"), "Markdown"
+
+    txs = [make_pending_transaction(amount, currency_code, description, account_name, is_expense, user_name, current_datetime)
+           for _, _, (amount, currency_code, description, account_name, is_expense) in parsed_lines]
+    return (txs[0] if len(txs) == 1 else {"batch": txs}), None, None
+
+# Импорт на отчети от CSV файл (/import)
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024  # лимитът на Telegram за getFile
+IMPORT_MAX_ROWS = 10000
+IMPORT_PROGRESS_INTERVAL = 3  # секунди между обновяванията на статус съобщението
+IMPORT_MAX_BATCH_FAILURES = 3  # поредни неуспешни партиди, след които спираме
+TELEGRAM_FILE_URL = TELEGRAM_API_URL + "/file/bot{token}/{path}"
+
+# Заглавия на колоните (на български или английски) -> поле
+IMPORT_COLUMNS = {
+    "дата": "date", "date": "date",
+    "сума": "amount", "amount": "amount",
+    "валута": "currency", "currency": "currency",
+    "описание": "description", "description": "description",
+    "акаунт": "account", "account": "account",
+    "вид": "type", "type": "type",
+    "транзакция": "text", "text": "text",
+}
+IMPORT_DATE_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d", "%d.%m.%Y %H:%M", "%d.%m.%Y", "%d/%m/%Y")
+IMPORT_HELP = ("📥 Изпратете CSV файл с колони:\n"
+               "Вид, Сума, Валута, Описание, Акаунт, Дата (по избор)\n"
+               "или Вид и Транзакция (напр. \"100 лв за храна от ДСК\").\n"
+               "Разделител: запетая или точка и запетая.")
+
+active_imports = set()  # чатове с импорт в момента
+
+def parse_import_date(value):
+    """Датата от CSV във формата на "Дата" или None, ако не е разпозната."""
+    for fmt in IMPORT_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).strftime("%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            continue
+    return None
+
+def open_telegram_file(file_path):
+    """Отваря качен в Telegram файл като поток от текстови редове (без да го чете целия)."""
+    res = requests.get(TELEGRAM_FILE_URL.format(token=TELEGRAM_BOT_TOKEN, path=file_path),
+                       stream=True, timeout=AIRTABLE_TIMEOUT)
+    res.raise_for_status()
+    res.raw.decode_content = True
+    return res, io.TextIOWrapper(res.raw, encoding="utf-8-sig", errors="replace", newline="")
+
+class ReportImporter:
+    """
+    Импорт на отчети от CSV поток. Редовете се четат един по един, проверяват се по
+    правилата на parse_transaction, акаунтите и видовете се търсят в кешовете, а
+    валидните редове се записват в Airtable на партиди по REPORTS_BATCH_SIZE.
+    Неуспешните редове се записват във временен CSV файл с колона "Грешка".
+    """
+
+    def __init__(self, user_name, on_progress=None, progress_interval=IMPORT_PROGRESS_INTERVAL):
+        self.user_name = user_name
+        self.on_progress = on_progress
+        self.progress_interval = progress_interval
+        self.rows = 0
+        self.saved = 0
+        self.failed = 0
+        self.failed_path = None
+        self._failed_file = None
+        self._failed_writer = None
+        self._header = None
+        self._delimiter = ","
+        self._batch = []  # [(ред от CSV, полета за Airtable, ключ)]
+        self._source = None
+        self._batch_failures = 0
+        self._last_progress = time.monotonic()
+        self._account_ids = {}
+        snapshot = get_transaction_types_snapshot()
+        self._types = {name.lower(): record_id for name, record_id in snapshot.types.items()}
+
+    def _fail(self, row, error):
+        if self._failed_writer is None:
+            self._failed_file = tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False,
+                                                            encoding="utf-8-sig", newline="")
+            self.failed_path = self._failed_file.name
+            self._failed_writer = csv.writer(self._failed_file, delimiter=self._delimiter)
+            self._failed_writer.writerow(self._header + ["Грешка"])
+        self._failed_writer.writerow(row + [error])
+        self.failed += 1
+
+    def _account_id(self, account_name):
+        if account_name not in self._account_ids:
+            self._account_ids[account_name] = find_account(account_name) if account_name else None
+        return self._account_ids[account_name]
+
+    def _build_fields(self, columns, row):
+        """Полетата за Airtable от един ред или (None, грешка)."""
+        values = {field: row[i].strip() for field, i in columns.items() if i < len(row)}
+
+        type_id = self._types.get(values.get("type", "").lower())
+        if not type_id:
+            return None, "Непознат вид"
+
+        if values.get("text"):
+            parsed = parse_transaction(values["text"])
+        else:
+            amount, currency_code = parse_amount_currency(f"{values.get('amount', '')} {values.get('currency', '')}")
+            description = values.get("description", "")
+            is_expense = bool(EXPENSE_RE.search(description))
+            if is_expense and amount is not None:
+                amount = -amount
+            parsed = (amount, currency_code, description, values.get("account") or None, is_expense)
+        if not is_valid_transaction(parsed):
+            return None, "Невалидна сума, валута или описание"
+
+        current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if values.get("date"):
+            current_datetime = parse_import_date(values["date"])
+            if current_datetime is None:
+                return None, "Невалидна дата"
+
+        amount, currency_code, description, account_name, is_expense = parsed
+        tx = make_pending_transaction(amount, currency_code, description, account_name, is_expense,
+                                      self.user_name, current_datetime)
+        return build_report_fields(tx, type_id, self._account_id(tx["account_name"])), None
+
+    def _post(self, batch):
+        """Записва партида; при отказ на Airtable за данните опитва редовете поотделно."""
+        try:
+            res = post_reports([(fields, key) for _, fields, key in batch])
+        except requests.exceptions.RequestException as e:
+            print(f"❌ Грешка при импорт на партида: {e}")
+            self._batch_failures += 1
+            for row, _, _ in batch:
+                self._fail(row, "Грешка при връзка с базата")
+            return
+
+        if res.status_code in (200, 201):
+            self._batch_failures = 0
+            created = res.json().get("records", [])
+            mirror_reports(created)
+            self.saved += len(created)
+            return
+
+        print(f"❌ Airtable error при импорт: {res.status_code} - {res.text}")
+        if res.status_code == 422 and len(batch) > 1:
+            for item in batch:
+                self._post([item])
+            return
+        self._batch_failures += 1
+        for row, _, _ in batch:
+            self._fail(row, f"Airtable {res.status_code}")
+
+    def _flush(self):
+        if self._batch:
+            self._post(self._batch)
+            self._batch = []
+
+    def _progress(self, force=False):
+        now = time.monotonic()
+        if self.on_progress and (force or now - self._last_progress >= self.progress_interval):
+            self._last_progress = now
+            try:
+                self.on_progress(self)
+            except Exception as e:
+                print(f"⚠️ Cannot report import progress: {e}")
+
+    def run(self, lines, source=None):
+        """
+        Импортира CSV от итератор по редове. Връща False, ако заглавният ред е невалиден.
+        source (file_unique_id) прави ключовете на редовете еднакви при повторен импорт на файла.
+        """
+        self._source = source or uuid.uuid4().hex
+        lines = iter(lines)
+        first_line = next(lines, "")
+        if first_line.count(";") > first_line.count(","):
+            self._delimiter = ";"
+        reader = csv.reader(itertools.chain([first_line], lines), delimiter=self._delimiter)
+
+        self._header = next(reader, [])
+        columns = {}
+        for i, name in enumerate(self._header):
+            field = IMPORT_COLUMNS.get(name.strip().lower())
+            if field and field not in columns:
+                columns[field] = i
+        if "type" not in columns or ("text" not in columns and "amount" not in columns):
+            return False
+
+        for row in reader:
+            if not any(cell.strip() for cell in row):
+                continue
+            self.rows += 1
+            if self.rows > IMPORT_MAX_ROWS or self._batch_failures >= IMPORT_MAX_BATCH_FAILURES:
+                self._fail(row, "Не е обработен")
+                continue
+
+            fields, error = self._build_fields(columns, row)
+            if error:
+                self._fail(row, error)
+            else:
+                self._batch.append((row, fields, f"import:{self._source}:{self.rows}"))
+                if len(self._batch) >= REPORTS_BATCH_SIZE:
+                    self._flush()
+            self._progress()
+
+        self._flush()
+        self._progress(force=True)
+        return True
+
+    def close(self):
+        if self._failed_file is not None:
+            self._failed_file.close()
+
+    def cleanup(self):
+        self.close()
+        if self.failed_path and os.path.exists(self.failed_path):
+            os.remove(self.failed_path)
+
+def import_progress_text(importer, done=False):
+    if done:
+        return f"✅ Импортът приключи: {importer.saved} записани, {importer.failed} с грешка (от {importer.rows} реда)."
+    return f"⏳ Импорт: {importer.rows} реда обработени, {importer.saved} записани, {importer.failed} с грешка..."
+
+def run_import(chat_id, file_id, status_msg_id, user_name):
+    """Изпълнява импорта (във фонова нишка) и изпраща файла с неуспешните редове."""
+    def on_progress(importer):
+        edit_message_text_nowait(import_progress_text(importer), chat_id=chat_id, message_id=status_msg_id)
+
+    importer = ReportImporter(user_name, on_progress)
+    try:
+        telegram_file = bot.get_file(file_id)
+        res, lines = open_telegram_file(telegram_file.file_path)
+        with res:
+            if not importer.run(lines, telegram_file.file_unique_id):
+                edit_message_text_nowait("❌ Липсват колони \"Вид\" и \"Сума\" (или \"Транзакция\").\n\n" + IMPORT_HELP,
+                                      chat_id=chat_id, message_id=status_msg_id)
+                return
+        importer.close()
+        edit_message_text_nowait(import_progress_text(importer, done=True), chat_id=chat_id, message_id=status_msg_id)
+        if importer.failed_path:
+            with open(importer.failed_path, "rb") as f:
+                bot.send_document(chat_id, f, visible_file_name="import_errors.csv",
+                                  caption="📎 Редовете, които не бяха записани. Поправете ги и ги изпратете отново с /import.")
+        print(f"📥 Импорт за {chat_id}: {importer.saved} записани, {importer.failed} с грешка")
+    except requests.exceptions.RequestException as e:
+        print(f"❌ Грешка при изтегляне на файла за импорт: {e}")
+        send_message_nowait(chat_id, "❌ Файлът не можа да бъде изтеглен.")
+    except Exception as e:
+        print(f"❌ Неочаквана грешка в run_import: {e}")
+        send_message_nowait(chat_id, "❌ Възникна грешка при импорта.")
+    finally:
+        importer.cleanup()
+        active_imports.discard(chat_id)
+
+def check_import_document(message):
+    """Проверява каченият файл за /import. Връща текст на грешка или None."""
+    document = message.document
+    if message.content_type != "document" or document is None:
+        return "❌ Очаквах CSV файл. Изпратете /import, за да опитате отново."
+    if not (document.file_name or "").lower().endswith(".csv"):
+        return "❌ Поддържат се само CSV файлове."
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        return "❌ Файлът е твърде голям (макс. 20 MB)."
+    return None
+
+@bot.message_handler(commands=['import'])
+def handle_import(message):
+    user_id = message.chat.id
+    if not rate_limiter.is_allowed(user_id):
+        reply_to_nowait(message, "⏸️ Твърде много заявки. Моля, изчакайте малко.")
+        return
+    if user_id in active_imports:
+        reply_to_nowait(message, "⏳ Вече тече импорт. Моля, изчакайте да приключи.")
+        return
+    msg = bot.reply_to(message, IMPORT_HELP)
+    bot.register_next_step_handler(msg, handle_import_document)
+
+@bot.message_handler(content_types=['document'], func=lambda message: (message.caption or "").startswith("/import"))
+def handle_import_document(message):
+    user_id = message.chat.id
+    error = check_import_document(message)
+    if error:
+        reply_to_nowait(message, error)
+        return
+    if user_id in active_imports:
+        reply_to_nowait(message, "⏳ Вече тече импорт. Моля, изчакайте да приключи.")
+        return
+
+    active_imports.add(user_id)
+    try:
+        status = bot.reply_to(message, "⏳ Импортът започна...")
+        user_name = message.from_user.first_name if message.from_user.first_name else "Unknown"
+        threading.Thread(target=run_import, args=(user_id, message.document.file_id, status.message_id, user_name),
+                         name=f"import-{user_id}", daemon=True).start()
+    except Exception as e:
+        active_imports.discard(user_id)
+        print(f"❌ Грешка при стартиране на импорт: {e}")
+        reply_to_nowait(message, "❌ Възникна грешка при импорта.")
+
 # Обработчик за съобщения с финансови отчети
 @bot.message_handler(func=lambda message: True)
 def handle_message(message):
@@ -1023,69 +3514,550 @@ def handle_message(message):
 
         # Rate limiting
         if not rate_limiter.is_allowed(user_id):
-            bot.reply_to(message, "⏸️ Твърде много заявки. Моля, изчакайте малко.")
+            reply_to_nowait(message, "⏸️ Твърде много заявки. Моля, изчакайте малко.")
             return
 
-        # Input validation
-        if not message.text or len(message.text) > 500:
-            bot.reply_to(message, "⚠️ Съобщението е празно или твърде дълго (макс. 500 символа).")
+        # Input validation (по 500 символа на ред, до MAX_BATCH_TRANSACTIONS реда)
+        if not message.text or len(message.text) > MAX_TRANSACTION_LENGTH * MAX_BATCH_TRANSACTIONS:
+            reply_to_nowait(message, "⚠️ Съобщението е празно или твърде дълго.")
             return
 
         text = message.text
         user_name = message.from_user.first_name if message.from_user.first_name else "Unknown"
         current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        # 📌 ПЪРВО парсваме съобщението
-        amount, currency_code, description, account_name, is_expense = parse_transaction(text)
-
-        if amount is None or currency_code is None or description == "":
-            reply_text = ("⚠️ Неразпознат формат. Моля, използвайте формат като:\n"
-                          "`100 лв. за <описание> от <акаунт>`")
-            bot.reply_to(message, reply_text, parse_mode="Markdown")
+        # 📌 ПЪРВО парсваме съобщението (по една транзакция на ред)
+        pending, reply_text, parse_mode = build_pending_transactions(text, user_name, current_datetime)
+        if pending is None:
+            reply_to_nowait(message, reply_text, parse_mode=parse_mode)
             return
 
         # 📌 2. Проверката за избран ВИД
         if user_id not in user_pending_type or not user_pending_type[user_id].get("selected"):
             # 💾 Записваме парснатата транзакция, за да я използваме след избора
-            pending_transaction_data[user_id] = {
-                "amount": amount,
-                "currency_code": currency_code,
-                "description": description[:500],
-                "account_name": account_name[:100] if account_name else "",
-                "is_expense": is_expense,
-                "user_name": user_name[:100],
-                "datetime": current_datetime,
-            }
+            assign_report_keys(pending, user_id, message.message_id)
+            pending_transaction_data[user_id] = pending
 
-            user_state_timestamps[user_id] = datetime.now()
             send_transaction_type_page(chat_id=user_id, page=0)
 
     except Exception as e:
         print(f"❌ Грешка в handle_message: {e}")
         if user_id:
             try:
-                bot.reply_to(message, "❌ Възникна грешка при обработка на съобщението.")
+                reply_to_nowait(message, "❌ Възникна грешка при обработка на съобщението.")
             except Exception as inner_e:
                 print(f"❌ Cannot reply to message: {inner_e}")      
 
 
-WEBHOOK_URL = f"{os.getenv('WEBHOOK_BASE_URL')}/bot{TELEGRAM_BOT_TOKEN}"
+def timed_handler(fn):
+    """Мери времето на handler-а и го отбелязва като текущ за изходящите заявки в нишката."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        previous = getattr(handler_context, "name", None)
+        handler_context.name = fn.__name__
+        started = time.monotonic()
+        error = None
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            duration = time.monotonic() - started
+            HANDLER_LATENCY.observe(duration, handler=fn.__name__)
+            trace = current_trace()
+            if trace is not None:
+                trace.add_span("handler", started, duration, handler=fn.__name__, error=error)
+            handler_context.name = previous
+    return wrapper
+
+for _handler in bot.message_handlers + bot.callback_query_handlers:
+    _handler["function"] = timed_handler(_handler["function"])
+
+def resolve_next_step(name):
+    """Next-step handler по име (от ConversationHandlerBackend), с измерване на времето."""
+    callback = globals().get(name)
+    return timed_handler(callback) if callback is not None else None
+
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL")
+WEBHOOK_URL = f"{WEBHOOK_BASE_URL}/bot{TELEGRAM_BOT_TOKEN}" if WEBHOOK_BASE_URL else None
+
+def ensure_webhook(url=WEBHOOK_URL):
+    """
+    Настройва webhook-а само ако Telegram сочи към друг адрес (сравнява с getWebhookInfo),
+    така че рестартите не го свалят. Връща True, ако е бил сменен.
+    """
+    if not url:
+        print("⚠️ WEBHOOK_BASE_URL не е зададен, webhook-ът не е настроен")
+        return False
+    try:
+        info = bot.get_webhook_info()
+        if info.url == url:
+            print("🔗 Webhook-ът вече е настроен")
+            return False
+        bot.set_webhook(url=url)
+    except Exception as e:
+        print(f"❌ Грешка при настройка на webhook-а: {e}")
+        return False
+    print("🔗 Webhook-ът е настроен")
+    return True
+
+def warm_up():
+    """Зарежда типовете транзакции и каталога с акаунти. Връща True, ако и двете са успешни."""
+    started = time.monotonic()
+    ok = transaction_types_cache.refresh()
+    ok = account_catalogue.refresh() and ok
+    elapsed = time.monotonic() - started
+    if ok:
+        print(f"🔥 Кешовете са загрети за {elapsed:.2f} s ({time.monotonic() - PROCESS_STARTED:.2f} s след старта)")
+    else:
+        print(f"⚠️ Загряването е непълно след {elapsed:.2f} s, кешовете ще се заредят при нужда")
+    return ok
+
+# Импортът на модула не прави мрежови заявки: фоновите задачи към Airtable тръгват
+# едва когато сървърът приема заявки (start_services)
+_services_lock = threading.Lock()
+_services_started = False
+
+def start_services():
+    """
+    Стартира във фонов режим загряването на кешовете, периодичната синхронизация и
+    write-behind записа. Извиква се след като сървърът приема заявки (или при първата
+    заявка); повторните извиквания не правят нищо.
+    """
+    global _services_started
+    with _services_lock:
+        if _services_started:
+            return False
+        _services_started = True
+
+    accepting = time.monotonic() - PROCESS_STARTED
+    print(f"🚀 Ботът приема заявки {accepting:.2f} s след старта")
+
+    def run():
+        try:
+            warm_up()
+            check_reports_idempotency_field()
+        except Exception as e:
+            print(f"❌ Грешка при загряване на кешовете: {e}")
+        finally:
+            account_catalogue.start(delay=account_catalogue.sync_interval)
+            if reports_mirror is not None:
+                reports_mirror.start()
+            report_outbox.start()
 
-# Настройваме webhook-а
-bot.remove_webhook()
-time.sleep(1)
-bot.set_webhook(url=WEBHOOK_URL)
+    threading.Thread(target=run, name="warm-up", daemon=True).start()
+    return True
 
-from flask import Flask, request
+from flask import Flask, request, jsonify
 
 app = Flask(__name__)
 
+# Настройки на обработката на update-и
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "100"))  # на worker
+UPDATE_BACKPRESSURE = os.getenv("UPDATE_BACKPRESSURE", "reject")  # reject | block | drop
+UPDATE_BLOCK_TIMEOUT = 5  # секунди чакане при "block", преди да откажем
+
+def get_update_chat_id(update):
+    """Връща chat_id на update-а (за разпределяне по worker-и) или None."""
+    for attr in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        msg = getattr(update, attr, None)
+        if msg is not None:
+            return msg.chat.id
+    call = getattr(update, "callback_query", None)
+    if call is not None:
+        if call.message is not None:
+            return call.message.chat.id
+        return call.from_user.id
+    return None
+
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", "10000"))  # помнени update_id-та
+
+class UpdateDeduplicator:
+    """
+    Последните size update_id-та: кръгов буфер (deque) за реда на изхвърляне и set за
+    проверката. Telegram изпраща update-а отново, ако webhook-ът не е отговорил навреме,
+    и повторението се разпознава, преди да стигне до handler-ите.
+    """
+
+    def __init__(self, size=UPDATE_DEDUP_SIZE):
+        self.size = size
+        self._order = deque()
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def seen(self, update_id):
+        """True, ако update_id вече е получен; иначе го запомня."""
+        with self._lock:
+            if update_id in self._seen:
+                return True
+            self._seen.add(update_id)
+            self._order.append(update_id)
+            if len(self._order) > self.size:
+                self._seen.discard(self._order.popleft())
+            return False
+
+    def forget(self, update_id):
+        """За отказан update: Telegram ще го изпрати отново и тогава трябва да мине."""
+        with self._lock:
+            if update_id not in self._seen:
+                return
+            self._seen.discard(update_id)
+            if self._order[-1] == update_id:
+                self._order.pop()
+            else:
+                self._order.remove(update_id)
+
+    def __len__(self):
+        return len(self._seen)
+
+class SQLiteUpdateDeduplicator:
+    """
+    Същият интерфейс като UpdateDeduplicator, но в базата на CONVERSATION_BACKEND=sqlite:
+    повторението се разпознава, и когато Telegram го изпрати към друг процес. update_id
+    на Telegram растат, затова таблицата се ограничава до последните size по id.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS seen_updates (update_id INTEGER PRIMARY KEY)",
+    )
+
+    def __init__(self, path, size=UPDATE_DEDUP_SIZE):
+        self.path = path
+        self.size = size
+        self._local = threading.local()
+        conn = self._conn()
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+
+    def _conn(self):
+        """Отделна връзка за всяка нишка (sqlite3 връзките не се споделят между нишки)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def seen(self, update_id):
+        """True, ако update_id вече е получен (от който и да е процес); иначе го запомня."""
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            inserted = conn.execute("INSERT OR IGNORE INTO seen_updates (update_id) VALUES (?)",
+                                    (update_id,)).rowcount
+            if inserted:
+                conn.execute("DELETE FROM seen_updates WHERE update_id <= (SELECT MAX(update_id) FROM seen_updates) - ?",
+                             (self.size,))
+        return not inserted
+
+    def forget(self, update_id):
+        """За отказан update: Telegram ще го изпрати отново и тогава трябва да мине."""
+        with self._conn() as conn:
+            conn.execute("DELETE FROM seen_updates WHERE update_id = ?", (update_id,))
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM seen_updates").fetchone()[0]
+
+def create_update_deduplicator(backend=CONVERSATION_BACKEND):
+    """При общо състояние (sqlite) и помнените update-и са общи; иначе - в паметта на процеса."""
+    if backend == "sqlite":
+        return SQLiteUpdateDeduplicator(CONVERSATION_DB_PATH)
+    return UpdateDeduplicator()
+
+update_deduplicator = create_update_deduplicator()
+
+class UpdateDispatcher:
+    """
+    Ограничен пул от worker-и за update-ите. Всеки чат винаги попада в един и същи
+    worker, така че съобщенията от един чат се обработват строго по ред, а
+    различните чатове - паралелно. Когато опашката на worker-а е пълна,
+    backpressure определя поведението: "reject" връща отказ (Telegram ще изпрати
+    update-а отново), "block" чака до block_timeout секунди, "drop" го изхвърля.
+    """
+
+    def __init__(self, process, workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE,
+                 backpressure=UPDATE_BACKPRESSURE, block_timeout=UPDATE_BLOCK_TIMEOUT, deduplicator=None):
+        if backpressure not in ("reject", "block", "drop"):
+            raise ValueError(f"Unknown backpressure mode: {backpressure}")
+        self.process = process
+        self.deduplicator = deduplicator
+        self.backpressure = backpressure
+        self.block_timeout = block_timeout
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(max(1, workers))]
+        self.threads = []
+
+    def start(self):
+        if self.threads:
+            return
+        for i, q in enumerate(self.queues):
+            thread = threading.Thread(target=self._worker, args=(q,), name=f"update-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _worker(self, q):
+        while True:
+            update, on_done, trace = q.get()
+            trace.add_span("queue", trace.started, time.monotonic() - trace.started)
+            handler_context.trace = trace
+            try:
+                self.process(update)
+            except Exception as e:
+                print(f"❌ Грешка при обработка на update {update.update_id} (trace {trace.trace_id}): {e}")
+                # Необработеният update трябва да мине, когато дойде отново
+                if self.deduplicator is not None:
+                    self.deduplicator.forget(update.update_id)
+            finally:
+                handler_context.trace = None
+                q.task_done()
+                UPDATES_IN_FLIGHT.dec()
+                slow_traces.record(trace)
+                if on_done is not None:
+                    on_done(update)
+
+    def submit(self, update, on_done=None, block=False, deduplicate=True):
+        """
+        Нарежда update-а за обработка. Връща False, ако е отказан поради претоварване.
+        on_done(update) се извиква, когато update-ът е обработен (или изхвърлен).
+        block=True чака без ограничение, докато има място (за long polling-а).
+        Повторно получен update се приема, без да се обработва отново. deduplicate=False
+        за update-и, които със сигурност не са обработени (необработените от checkpoint-а
+        след рестарт) - те вече са отбелязани като получени преди срива.
+        """
+        if deduplicate and self.deduplicator is not None and self.deduplicator.seen(update.update_id):
+            UPDATES.inc(result="duplicate")
+            print(f"♻️ Повторен update {update.update_id} - пропускаме го")
+            if on_done is not None:
+                on_done(update)
+            return True
+        chat_id = get_update_chat_id(update)
+        shard_key = chat_id if chat_id is not None else update.update_id
+        q = self.queues[hash(shard_key) % len(self.queues)]
+        item = (update, on_done, Trace(update.update_id, chat_id))
+        try:
+            # Броим преди put - worker-ът може да приключи, преди put да е върнал
+            UPDATES_IN_FLIGHT.inc()
+            if block:
+                q.put(item)
+            elif self.backpressure == "block":
+                q.put(item, timeout=self.block_timeout)
+            else:
+                q.put_nowait(item)
+            UPDATES.inc(result="accepted")
+            return True
+        except queue.Full:
+            UPDATES_IN_FLIGHT.dec()
+            if self.backpressure == "drop":
+                UPDATES.inc(result="dropped")
+                print(f"⚠️ Опашката е пълна, update {update.update_id} е изхвърлен")
+                if on_done is not None:
+                    on_done(update)
+                return True
+            UPDATES.inc(result="rejected")
+            print(f"⚠️ Опашката е пълна, update {update.update_id} е отказан")
+            if self.deduplicator is not None:
+                self.deduplicator.forget(update.update_id)
+            return False
+
+    def pending(self):
+        return sum(q.qsize() for q in self.queues)
+
+update_dispatcher = UpdateDispatcher(lambda update: bot.process_new_updates([update]),
+                                     deduplicator=update_deduplicator)
+update_dispatcher.start()
+
+metrics.gauge("bot_update_queue_depth", "Update-и в опашките на worker-ите", function=lambda: update_dispatcher.pending())
+metrics.gauge("bot_conversations_active", "Потребители с активен разговор", function=lambda: len(conversations))
+metrics.gauge("bot_airtable_circuit_open", "1, ако circuit breaker-ът за Airtable е отворен",
+              function=lambda: int(airtable.breaker.state == CircuitBreaker.OPEN))
+metrics.gauge("bot_reports_outbox_pending", "Отчети в журнала, чакащи запис в Airtable", function=lambda: len(report_outbox))
+metrics.gauge("bot_uptime_seconds", "Секунди от старта на процеса", function=lambda: round(time.monotonic() - PROCESS_STARTED, 3))
+
+@app.before_request
+def ensure_services():
+    # При стартиране през WSGI сървър (без __main__) фоновите задачи тръгват с първата заявка
+    if not _services_started:
+        start_services()
+
 @app.route(f"/bot{TELEGRAM_BOT_TOKEN}", methods=['POST'])
 def receive_update():
-    json_str = request.get_data().decode('utf-8')
-    update = telebot.types.Update.de_json(json_str)
-    bot.process_new_updates([update])
+    try:
+        json_str = request.get_data().decode('utf-8')
+        update = telebot.types.Update.de_json(json_str)
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"⚠️ Невалиден update: {e}")
+        return "Bad Request", 400
+    if update is None:
+        return "Bad Request", 400
+
+    if not update_dispatcher.submit(update):
+        return "Service Unavailable", 503
     return "OK", 200
 
+@app.route("/metrics")
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return "Unauthorized", 401
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # без него /admin/* е изключен
+
+@app.route("/admin/traces")
+def admin_traces():
+    """Последните бавни update-и: ?limit=20&chat_id=123"""
+    if not ADMIN_TOKEN:
+        return "Not Found", 404
+    if request.headers.get("Authorization") != f"Bearer {ADMIN_TOKEN}":
+        return "Unauthorized", 401
+    limit = request.args.get("limit", type=int)
+    chat_id = request.args.get("chat_id", type=int)
+    return jsonify({
+        "threshold_ms": round(slow_traces.threshold * 1000, 1),
+        "traces": slow_traces.recent(limit, chat_id),
+    })
+
+# Long polling (вместо webhook): локално стартиране или зад firewall
+POLLING_LIMIT = int(os.getenv("POLLING_LIMIT", "100"))  # update-и в един getUpdates (1-100)
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", "30"))  # секунди long poll
+POLLING_ALLOWED_UPDATES = [u.strip() for u in os.getenv("POLLING_ALLOWED_UPDATES", "message,callback_query").split(",") if u.strip()]
+POLLING_STATE_PATH = os.getenv("POLLING_STATE_PATH", "polling_state.db")
+POLLING_MAX_BACKOFF = 60
+
+class PollingCheckpoint:
+    """
+    Трайно състояние на long polling-а в SQLite (WAL): следващият offset за getUpdates
+    и получените, но още необработени update-и. Update-ите се записват преди offset-ът
+    да ги потвърди пред Telegram и се трият след обработка, така че след рестарт
+    необработените се пускат отново, а обработените - не.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS polling_offset (id INTEGER PRIMARY KEY CHECK (id = 1), next_offset INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS polling_inbox (update_id INTEGER PRIMARY KEY, payload TEXT NOT NULL)",
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+
+    def _conn(self):
+        """Отделна връзка за всяка нишка (sqlite3 връзките не се споделят между нишки)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self):
+        """(следващ offset или None, необработените update-и по ред)."""
+        conn = self._conn()
+        row = conn.execute("SELECT next_offset FROM polling_offset WHERE id = 1").fetchone()
+        rows = conn.execute("SELECT payload FROM polling_inbox ORDER BY update_id").fetchall()
+        return (row[0] if row else None), [json.loads(payload) for payload, in rows]
+
+    def receive(self, updates, next_offset):
+        """Записва получените update-и и новия offset в една транзакция."""
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT OR IGNORE INTO polling_inbox (update_id, payload) VALUES (?, ?)",
+                             [(item["update_id"], json.dumps(item, ensure_ascii=False)) for item in updates])
+            conn.execute("INSERT INTO polling_offset (id, next_offset) VALUES (1, ?) "
+                         "ON CONFLICT (id) DO UPDATE SET next_offset = excluded.next_offset", (next_offset,))
+
+    def done(self, update_id):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM polling_inbox WHERE update_id = ?", (update_id,))
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM polling_inbox").fetchone()[0]
+
+class UpdatePoller:
+    """
+    Long polling с getUpdates, който подава update-ите в същия UpdateDispatcher като
+    webhook-а. Следващият getUpdates тръгва веднага щом партидата е записана в
+    checkpoint-а и наредена, без да чака обработката ѝ. При пълни опашки поллерът
+    спира да тегли, докато worker-ите освободят място.
+    """
+
+    def __init__(self, dispatcher, checkpoint, limit=POLLING_LIMIT, timeout=POLLING_TIMEOUT,
+                 allowed_updates=POLLING_ALLOWED_UPDATES):
+        self.dispatcher = dispatcher
+        self.checkpoint = checkpoint
+        self.limit = max(1, min(limit, 100))
+        self.timeout = timeout
+        self.allowed_updates = allowed_updates
+        self._stopped = threading.Event()
+
+    def _done(self, update):
+        try:
+            self.checkpoint.done(update.update_id)
+        except sqlite3.Error as e:
+            print(f"❌ Грешка при checkpoint на update {update.update_id}: {e}")
+
+    def _submit(self, item, replay=False):
+        # Пълна опашка спира polling-а, вместо да отказва: update-ът вече е потвърден пред Telegram.
+        # При replay update-ът е в inbox-а, защото не е обработен - deduplicator-ът (общ при
+        # CONVERSATION_BACKEND=sqlite) го помни отпреди срива и не бива да го спира.
+        self.dispatcher.submit(telebot.types.Update.de_json(item), self._done, block=True, deduplicate=not replay)
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        offset, pending = self.checkpoint.load()
+        if pending:
+            print(f"♻️ Възстановени {len(pending)} необработени update-а")
+            for item in pending:
+                self._submit(item, replay=True)
+
+        print(f"📡 Long polling: limit={self.limit}, timeout={self.timeout}s, allowed_updates={self.allowed_updates}")
+        failures = 0
+        while not self._stopped.is_set():
+            try:
+                updates = telebot.apihelper.get_updates(
+                    TELEGRAM_BOT_TOKEN, offset=offset, limit=self.limit,
+                    allowed_updates=self.allowed_updates, long_polling_timeout=self.timeout)
+            except Exception as e:
+                failures += 1
+                delay = min(POLLING_MAX_BACKOFF, 2 ** failures)
+                print(f"❌ Грешка при getUpdates: {e} (нов опит след {delay} s)")
+                self._stopped.wait(delay)
+                continue
+            failures = 0
+            if not updates:
+                continue
+
+            # Записваме преди следващият getUpdates да ги потвърди с новия offset
+            offset = updates[-1]["update_id"] + 1
+            self.checkpoint.receive(updates, offset)
+            for item in updates:
+                self._submit(item)
+
+def run_polling():
+    """Стартира бота с long polling. Telegram не позволява getUpdates при активен webhook."""
+    info = bot.get_webhook_info()
+    if info.url:
+        print("⚠️ Активен webhook - премахваме го за long polling")
+        bot.remove_webhook()
+    start_services()
+    UpdatePoller(update_dispatcher, PollingCheckpoint(POLLING_STATE_PATH)).run()
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
+    if "--polling" in sys.argv[1:]:
+        run_polling()
+    else:
+        from werkzeug.serving import make_server
+
+        # Сокетът слуша още след make_server - загряването и webhook-ът не забавят приемането
+        server = make_server("0.0.0.0", int(os.environ.get("PORT", 5000)), app, threaded=True)
+        start_services()
+        ensure_webhook()
+        server.serve_forever()